@@ -0,0 +1,105 @@
+import argparse
+
+from benchmarks.fake_ollama import FakeOllamaServer
+from benchmarks.harness import (
+    print_results,
+    temporary_persistent_storage,
+    use_fake_ollama,
+    write_results,
+)
+
+SUITES = ["recall_storage", "archival_storage", "agent", "summarisation", "server"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmarks the agent step loop, storage and server endpoints against a local fake Ollama server.",
+    )
+    parser.add_argument(
+        "--suites", nargs="+", choices=SUITES, default=SUITES, help="Suites to run"
+    )
+    parser.add_argument(
+        "--history-sizes",
+        nargs="+",
+        type=int,
+        default=[0, 100, 1000],
+        help="Number of messages already in the conversation",
+    )
+    parser.add_argument("--repeat", type=int, default=10, help="Timed runs per case")
+    parser.add_argument(
+        "--chat-latency",
+        type=float,
+        default=0.0,
+        help="Seconds the fake server waits before answering a chat request",
+    )
+    parser.add_argument(
+        "--chunk-latency",
+        type=float,
+        default=0.0,
+        help="Seconds between streamed chat chunks",
+    )
+    parser.add_argument(
+        "--embed-latency",
+        type=float,
+        default=0.0,
+        help="Seconds the fake server waits before answering an embed request",
+    )
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    with (
+        FakeOllamaServer(
+            chat_latency=args.chat_latency,
+            chunk_latency=args.chunk_latency,
+            embed_latency=args.embed_latency,
+        ) as fake_server,
+        temporary_persistent_storage(),
+    ):
+        use_fake_ollama(fake_server.url)
+
+        # Imported only now, since these end up importing host.py
+        from benchmarks.bench_agent import (
+            run_agent_step_benchmarks,
+            run_summarisation_benchmarks,
+        )
+        from benchmarks.bench_server import run_server_benchmarks
+        from benchmarks.bench_storage import (
+            run_archival_storage_benchmarks,
+            run_recall_storage_benchmarks,
+        )
+
+        results = []
+        for suite in args.suites:
+            print(f"Running {suite} benchmarks...")
+            match suite:
+                case "recall_storage":
+                    results += run_recall_storage_benchmarks(
+                        args.history_sizes, args.repeat
+                    )
+                case "archival_storage":
+                    results += run_archival_storage_benchmarks(
+                        args.history_sizes, args.repeat, fake_server
+                    )
+                case "agent":
+                    results += run_agent_step_benchmarks(
+                        args.history_sizes, args.repeat, fake_server
+                    )
+                case "summarisation":
+                    results += run_summarisation_benchmarks(args.repeat, fake_server)
+                case "server":
+                    results += run_server_benchmarks(
+                        args.history_sizes, args.repeat, fake_server
+                    )
+
+    print_results(results)
+    if args.output:
+        write_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
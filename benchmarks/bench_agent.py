@@ -0,0 +1,157 @@
+from os import path
+from random import Random
+
+from benchmarks.bench_storage import random_text
+from benchmarks.harness import create_benchmark_conv, measure, remove_conv
+
+PERSONAS_PATH = path.join(path.dirname(path.dirname(__file__)), "llm_os", "personas")
+
+
+def create_benchmark_agent(conv_name):
+    # Same wiring as init_agent in server.py, without the agent cache
+    from config import CONFIG
+    from llm_os.agent import Agent
+    from llm_os.functions.load_functions import FUNCTION_REGISTRY
+    from llm_os.interface import ServerInterface
+    from llm_os.memory.archival_storage import ArchivalStorage
+    from llm_os.memory.file_storage import FileStorage
+    from llm_os.memory.recall_storage import RecallStorage
+    from llm_os.memory.working_context import WorkingContext
+    from llm_os.prompts.gpt_system import get_system_text
+    from llm_os.tokenisers import get_tokeniser_and_context_window
+    from llm_os.web_interface import WebInterface
+
+    with open(path.join(PERSONAS_PATH, "agents", "base.txt"), "r") as f:
+        agent_persona_str = f.read()
+    with open(path.join(PERSONAS_PATH, "humans", "base_human.txt"), "r") as f:
+        human_persona_str = f.read()
+
+    (
+        in_context_function_dats,
+        out_of_context_function_dats,
+        out_of_context_function_sets,
+    ) = FUNCTION_REGISTRY.get_function_dats()
+
+    return Agent(
+        ServerInterface(),
+        WebInterface(),
+        conv_name,
+        CONFIG["model_name"],
+        in_context_function_dats,
+        out_of_context_function_dats,
+        out_of_context_function_sets,
+        get_system_text("llm_agent_chat"),
+        WorkingContext(
+            CONFIG["model_name"], conv_name, agent_persona_str, 1, human_persona_str
+        ),
+        ArchivalStorage(conv_name),
+        RecallStorage(conv_name),
+        FileStorage(
+            conv_name, get_tokeniser_and_context_window(CONFIG["model_name"])[0]
+        ),
+    )
+
+
+def append_user_message(agent, rng, no_words=30):
+    agent.memory.append_messaged_to_fq_and_rs(
+        {
+            "type": "user",
+            "user_id": 1,
+            "message": {"role": "user", "content": random_text(rng, no_words)},
+        }
+    )
+
+
+def fill_fifo_queue(agent, history_size, rng):
+    # Stops early rather than pushing the queue past the flush limit, so that step timings are not dominated by summarisation
+    from llm_os.constants import WARNING_TOKEN_FRAC
+
+    for _ in range(history_size):
+        if agent.memory.main_ctx_message_seq_no_tokens > int(
+            0.9 * WARNING_TOKEN_FRAC * agent.memory.ctx_window
+        ):
+            break
+        append_user_message(agent, rng)
+
+
+def run_agent_step_benchmarks(history_sizes, repeat, fake_server):
+    results = []
+    for history_size in history_sizes:
+        conv_name = create_benchmark_conv()
+        rng = Random(history_size)
+        try:
+            agent = create_benchmark_agent(conv_name)
+            fill_fifo_queue(agent, history_size, rng)
+            params = {"history": len(agent.memory.fifo_queue)}
+
+            def step(_):
+                append_user_message(agent, rng)
+                fake_server.reset_stats()
+                agent.step(1)
+                agent.interface.server_message_stack = []
+                return {"inference": fake_server.request_seconds["chat"]}
+
+            def change_fifo_queue():
+                # Pops and pushes back the oldest message, so the next count follows a change to the head user buffer
+                agent.memory.push_oldest_messaged_to_fq(
+                    agent.memory.pop_oldest_messaged_from_fq()
+                )
+
+            results.append(measure("agent.step", step, repeat, params))
+            results.append(
+                measure(
+                    "memory.main_ctx_message_seq",
+                    lambda _: agent.memory.main_ctx_message_seq,
+                    repeat,
+                    params,
+                )
+            )
+            results.append(
+                measure(
+                    "memory.main_ctx_no_tokens",
+                    lambda _: agent.memory.main_ctx_message_seq_no_tokens,
+                    repeat,
+                    params,
+                    setup=change_fifo_queue,
+                )
+            )
+            agent.close()
+        finally:
+            remove_conv(conv_name)
+
+    return results
+
+
+def run_summarisation_benchmarks(repeat, fake_server):
+    from llm_os.constants import WARNING_TOKEN_FRAC
+
+    conv_name = create_benchmark_conv()
+    rng = Random(0)
+    try:
+        agent = create_benchmark_agent(conv_name)
+
+        def fill():
+            while agent.memory.main_ctx_message_seq_no_tokens <= int(
+                WARNING_TOKEN_FRAC * agent.memory.ctx_window
+            ):
+                append_user_message(agent, rng, 200)
+
+        def summarise(_):
+            fake_server.reset_stats()
+            agent.summarise_messages_in_place()
+            agent.interface.server_message_stack = []
+            return {"inference": fake_server.request_seconds["chat"]}
+
+        results = [
+            measure(
+                "agent.summarise_messages_in_place",
+                summarise,
+                repeat,
+                {"ctx_window": agent.memory.ctx_window},
+                setup=fill,
+            )
+        ]
+        agent.close()
+        return results
+    finally:
+        remove_conv(conv_name)
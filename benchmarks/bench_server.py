@@ -0,0 +1,120 @@
+import json
+import time
+from random import Random
+
+from benchmarks.bench_agent import fill_fifo_queue
+from benchmarks.bench_storage import random_text
+from benchmarks.harness import measure, remove_conv
+
+
+def create_agent(client):
+    return (
+        client.post(
+            "/agent",
+            json={
+                "agent_persona_name": "base.txt",
+                "human_persona_name": "base_human.txt",
+            },
+        )
+        .raise_for_status()
+        .json()["conv_name"]
+    )
+
+
+def delete_agent(client, conv_name):
+    # The endpoint only unloads the agent unless the conversation directory is already empty
+    client.request("DELETE", "/agent", json={"conv_name": conv_name})
+    remove_conv(conv_name)
+
+
+def run_server_benchmarks(history_sizes, repeat, fake_server):
+    from fastapi.testclient import TestClient
+
+    import server
+
+    results = []
+    with TestClient(server.app) as client:
+        results.append(
+            measure(
+                "GET /conversation-ids",
+                lambda _: client.get("/conversation-ids").raise_for_status(),
+                repeat,
+            )
+        )
+
+        created_conv_names = []
+        try:
+            results.append(
+                measure(
+                    "POST /agent",
+                    lambda _: created_conv_names.append(create_agent(client)),
+                    max(1, repeat // 5),
+                    trace_allocations=False,
+                )
+            )
+        finally:
+            for conv_name in created_conv_names:
+                delete_agent(client, conv_name)
+
+        for history_size in history_sizes:
+            rng = Random(history_size)
+            conv_name = None
+            try:
+                conv_name = create_agent(client)
+                fill_fifo_queue(server.get_agent(conv_name), history_size, rng)
+                params = {"history": history_size}
+
+                def send_message(_):
+                    # Time to first streamed line and time for the whole NDJSON stream
+                    fake_server.reset_stats()
+                    start_time = time.perf_counter()
+                    first_line_seconds = None
+                    with client.stream(
+                        "POST",
+                        "/messages/send",
+                        json={
+                            "conv_name": conv_name,
+                            "user_id": 1,
+                            "message": random_text(rng, 30),
+                        },
+                    ) as response:
+                        for line in response.iter_lines():
+                            if line and first_line_seconds is None:
+                                first_line_seconds = time.perf_counter() - start_time
+                                json.loads(line)
+                    return {
+                        "first_line": first_line_seconds or 0.0,
+                        "inference": fake_server.request_seconds["chat"],
+                    }
+
+                results.append(
+                    measure("POST /messages/send", send_message, repeat, params)
+                )
+                results.append(
+                    measure(
+                        "POST /messages/send/no-heartbeat",
+                        lambda _: client.post(
+                            "/messages/send/no-heartbeat",
+                            json={
+                                "conv_name": conv_name,
+                                "user_id": 1,
+                                "message": random_text(rng, 30),
+                            },
+                        ).raise_for_status(),
+                        repeat,
+                        params,
+                    )
+                )
+            finally:
+                if conv_name is not None:
+                    delete_agent(client, conv_name)
+
+        results.append(
+            measure(
+                "GET /agents/cache-stats",
+                lambda _: client.get("/agents/cache-stats").raise_for_status(),
+                repeat,
+            )
+        )
+
+    return results
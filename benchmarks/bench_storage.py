@@ -0,0 +1,117 @@
+from datetime import date
+from random import Random
+
+from benchmarks.harness import measure, create_benchmark_conv, remove_conv
+
+WORDS = (
+    "memory agent user message summary archive recall function schema context "
+    "window token embedding search date python server stream weather music "
+    "travel cooking garden project deadline meeting birthday holiday"
+).split()
+
+
+def random_text(rng, no_words):
+    return " ".join(rng.choice(WORDS) for _ in range(no_words))
+
+
+def fill_recall_storage(recall_storage, history_size, rng):
+    for i in range(history_size):
+        role = "user" if i % 2 == 0 else "assistant"
+        recall_storage.insert(
+            {
+                "type": role,
+                "user_id": 1,
+                "message": {"role": role, "content": random_text(rng, 30)},
+            }
+        )
+
+
+def run_recall_storage_benchmarks(history_sizes, repeat):
+    from llm_os.memory.recall_storage import RecallStorage
+
+    results = []
+    for history_size in history_sizes:
+        conv_name = create_benchmark_conv()
+        rng = Random(history_size)
+        try:
+            recall_storage = RecallStorage(conv_name)
+            fill_recall_storage(recall_storage, history_size, rng)
+            params = {"history": history_size}
+            today = date.today().isoformat()
+
+            results.append(
+                measure(
+                    "recall_storage.insert",
+                    lambda _: recall_storage.insert(
+                        {
+                            "type": "user",
+                            "user_id": 1,
+                            "message": {"role": "user", "content": random_text(rng, 30)},
+                        }
+                    ),
+                    repeat,
+                    params,
+                )
+            )
+            results.append(
+                measure(
+                    "recall_storage.text_search",
+                    lambda _: recall_storage.text_search(
+                        " ".join(rng.sample(WORDS, 2)), 1, 10, 0
+                    ),
+                    repeat,
+                    params,
+                )
+            )
+            results.append(
+                measure(
+                    "recall_storage.date_search",
+                    lambda _: recall_storage.date_search(today, today, 1, 10, 0),
+                    repeat,
+                    params,
+                )
+            )
+            results.append(
+                measure(
+                    "recall_storage.load",
+                    lambda _: RecallStorage(conv_name),
+                    max(1, repeat // 5),
+                    params,
+                )
+            )
+        finally:
+            remove_conv(conv_name)
+
+    return results
+
+
+def run_archival_storage_benchmarks(history_sizes, repeat, fake_server):
+    from llm_os.memory.archival_storage import ArchivalStorage
+
+    results = []
+    for history_size in history_sizes:
+        conv_name = create_benchmark_conv()
+        rng = Random(history_size)
+        try:
+            archival_storage = ArchivalStorage(conv_name)
+            for _ in range(history_size):
+                archival_storage.insert(1, random_text(rng, 60))
+            params = {"history": history_size}
+
+            def insert(_):
+                fake_server.reset_stats()
+                archival_storage.insert(1, random_text(rng, 60))
+                return {"embed": fake_server.request_seconds["embed"]}
+
+            def search(_):
+                fake_server.reset_stats()
+                archival_storage.search(" ".join(rng.sample(WORDS, 3)), 1, 10, 0)
+                return {"embed": fake_server.request_seconds["embed"]}
+
+            results.append(measure("archival_storage.insert", insert, repeat, params))
+            results.append(measure("archival_storage.search", search, repeat, params))
+            archival_storage.close()
+        finally:
+            remove_conv(conv_name)
+
+    return results
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import struct
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+CANNED_RESPONSE = {
+    "emotions": [["calm", 5.0]],
+    "thoughts": ["The user said something, I should reply."],
+    "function_call": {
+        "name": "send_message",
+        "arguments": {"message": "This is a canned benchmark response."},
+    },
+}
+CANNED_SUMMARY = "I talked with the user about a few things during the benchmark."
+EMBEDDING_DIMENSIONS = 768
+
+
+def deterministic_embedding(text, dimensions=EMBEDDING_DIMENSIONS):
+    # Same text always maps to the same unit-length vector
+    values = []
+    counter = 0
+    while len(values) < dimensions:
+        digest = hashlib.sha256(f"{counter}\n{text}".encode("UTF-8")).digest()
+        values += [v / 2**31 - 1.0 for v in struct.unpack("<8I", digest)]
+        counter += 1
+    values = values[:dimensions]
+    norm = sum(v * v for v in values) ** 0.5 or 1.0
+    return [v / norm for v in values]
+
+
+class FakeOllamaServer:
+    """Deterministic local stand-in for the Ollama /api/chat and /api/embed endpoints."""
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        chat_latency=0.0,
+        embed_latency=0.0,
+        chunk_latency=0.0,
+        chat_responses=None,
+        record_chat_requests=False,
+    ):
+        self.chat_latency = chat_latency  # Seconds before the first chat chunk
+        self.embed_latency = embed_latency  # Seconds per embed request
+        self.chunk_latency = chunk_latency  # Seconds between streamed chat chunks
+        # Responses are given out in order and cycled; summarisation requests always get CANNED_SUMMARY
+        self.chat_responses = [
+            json.dumps(response)
+            for response in (chat_responses or [CANNED_RESPONSE])
+        ]
+
+        self.lock = Lock()
+        self.record_chat_requests = record_chat_requests
+        self.chat_requests = []  # Messages of every chat request, if recorded
+        self.no_chat_requests = 0
+        self.no_embed_requests = 0
+        self.no_embedded_texts = 0
+        self.request_seconds = {"chat": 0.0, "embed": 0.0}
+
+        self.httpd = ThreadingHTTPServer((host, port), self.__make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset_stats(self):
+        with self.lock:
+            self.no_chat_requests = 0
+            self.no_embed_requests = 0
+            self.no_embedded_texts = 0
+            self.request_seconds = {"chat": 0.0, "embed": 0.0}
+
+    def next_chat_response(self, messages):
+        with self.lock:
+            self.no_chat_requests += 1
+            i = self.no_chat_requests - 1
+            if self.record_chat_requests:
+                self.chat_requests.append(messages)
+
+        # Both summarisation prompts start this way, the agent's system prompt does not
+        if messages and messages[0]["content"].lstrip().startswith("Your job is to"):
+            return CANNED_SUMMARY
+        return self.chat_responses[i % len(self.chat_responses)]
+
+    def add_request_seconds(self, kind, seconds):
+        with self.lock:
+            self.request_seconds[kind] += seconds
+
+    def __make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def read_body(self):
+                length = int(self.headers.get("Content-Length", 0))
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def send_json(self, dat):
+                body = json.dumps(dat).encode("UTF-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_chunk(self, dat):
+                body = (json.dumps(dat) + "\n").encode("UTF-8")
+                self.wfile.write(f"{len(body):X}\r\n".encode("ascii") + body + b"\r\n")
+                self.wfile.flush()
+
+            def do_GET(self):
+                if self.path == "/api/tags":
+                    self.send_json({"models": []})
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                start_time = time.perf_counter()
+                if self.path == "/api/chat":
+                    self.handle_chat(self.read_body())
+                    server.add_request_seconds("chat", time.perf_counter() - start_time)
+                elif self.path == "/api/embed":
+                    self.handle_embed(self.read_body())
+                    server.add_request_seconds(
+                        "embed", time.perf_counter() - start_time
+                    )
+                else:
+                    self.send_error(404)
+
+            def handle_chat(self, dat):
+                content = server.next_chat_response(dat.get("messages", []))
+                time.sleep(server.chat_latency)
+
+                model = dat.get("model", "fake")
+                if not dat.get("stream", True):
+                    self.send_json(
+                        {
+                            "model": model,
+                            "message": {"role": "assistant", "content": content},
+                            "done": True,
+                        }
+                    )
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for i in range(0, len(content), 16):
+                    self.send_chunk(
+                        {
+                            "model": model,
+                            "message": {
+                                "role": "assistant",
+                                "content": content[i : i + 16],
+                            },
+                            "done": False,
+                        }
+                    )
+                    if server.chunk_latency:
+                        time.sleep(server.chunk_latency)
+                self.send_chunk(
+                    {
+                        "model": model,
+                        "message": {"role": "assistant", "content": ""},
+                        "done": True,
+                    }
+                )
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+            def handle_embed(self, dat):
+                texts = dat.get("input", [])
+                if isinstance(texts, str):
+                    texts = [texts]
+                with server.lock:
+                    server.no_embed_requests += 1
+                    server.no_embedded_texts += len(texts)
+                time.sleep(server.embed_latency)
+                self.send_json(
+                    {
+                        "model": dat.get("model", "fake"),
+                        "embeddings": [deterministic_embedding(text) for text in texts],
+                    }
+                )
+
+        return Handler
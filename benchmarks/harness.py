@@ -0,0 +1,185 @@
+import gc
+import json
+import shutil
+import statistics
+import time
+import tracemalloc
+from contextlib import contextmanager
+from os import mkdir, path
+from tempfile import mkdtemp
+from uuid import uuid4
+
+PERSISTENT_STORAGE_PATH = None  # Set by temporary_persistent_storage
+
+
+def use_fake_ollama(server_url):
+    # Must run before anything imports host.py, which creates the Ollama clients from CONFIG at import time
+    import config
+
+    if config.CONFIG is None:
+        config.CONFIG = {
+            "server_url": server_url,
+            "model_name": "openhermes",
+            "google_api_key": "",
+            "google_prog_search_engine_id": "",
+            "huggingface_user_access_token": None,
+            "tokenisers_path": "",
+        }
+    config.CONFIG["server_url"] = server_url
+
+
+def use_stub_tokenisers():
+    # Registers word-level tokenisers in place of the Hugging Face ones (the chat model's and those used for splitting), so that nothing is downloaded; token counts are only roughly those of the real model
+    # Must run after use_fake_ollama and before any tokeniser is loaded
+    from config import CONFIG
+    from tokenizers import Tokenizer
+    from tokenizers.models import WordLevel
+    from tokenizers.pre_tokenizers import Whitespace
+    from transformers import PreTrainedTokenizerFast
+
+    from llm_os.tokenisers import get_registered_tokeniser
+
+    tokenizer = Tokenizer(WordLevel({"[UNK]": 0}, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = Whitespace()
+    for repo_id in ["nomic-ai/nomic-embed-text-v1.5", "Qwen/Qwen2.5-0.5B-Instruct"]:
+        get_registered_tokeniser(("tokenizers", repo_id), lambda: tokenizer)
+
+    chat_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        unk_token="[UNK]",
+        chat_template="{% for message in messages %}{{ message['role'] }}: {{ message['content'] }}\n{% endfor %}",
+    )
+    get_registered_tokeniser(
+        ("model", CONFIG["model_name"]),
+        lambda: (
+            chat_tokenizer,
+            8192,
+            lambda text: len(chat_tokenizer.encode(text)),
+            lambda conv: len(chat_tokenizer.apply_chat_template(conv)),
+        ),
+    )
+
+
+@contextmanager
+def temporary_persistent_storage():
+    # Must be entered before anything imports llm_os storage modules, which read PERSISTENT_STORAGE_PATH at import time
+    # Conversations, the embedding cache and the function schema index all live in a fresh directory that is deleted afterwards, so fake embeddings never reach the real persistent_storage
+    global PERSISTENT_STORAGE_PATH
+    import llm_os.constants
+
+    PERSISTENT_STORAGE_PATH = mkdtemp(prefix="llm_agent_benchmarks-")
+    llm_os.constants.PERSISTENT_STORAGE_PATH = PERSISTENT_STORAGE_PATH
+    try:
+        yield PERSISTENT_STORAGE_PATH
+    finally:
+        shutil.rmtree(PERSISTENT_STORAGE_PATH, ignore_errors=True)
+
+
+def create_benchmark_conv():
+    conv_name = f"benchmark@{uuid4().hex}"
+    mkdir(path.join(PERSISTENT_STORAGE_PATH, conv_name))
+    return conv_name
+
+
+def remove_conv(conv_name):
+    shutil.rmtree(path.join(PERSISTENT_STORAGE_PATH, conv_name), ignore_errors=True)
+
+
+class BenchmarkResult:
+    def __init__(self, name, params, durations, peak_bytes, allocated_bytes, extra):
+        self.name = name
+        self.params = params
+        self.durations = durations
+        self.peak_bytes = peak_bytes
+        self.allocated_bytes = allocated_bytes
+        self.extra = extra
+
+    @property
+    def mean(self):
+        return statistics.fmean(self.durations)
+
+    @property
+    def p50(self):
+        return statistics.median(self.durations)
+
+    @property
+    def p95(self):
+        if len(self.durations) < 2:
+            return self.durations[0]
+        return statistics.quantiles(self.durations, n=20)[-1]
+
+    @property
+    def throughput(self):
+        return len(self.durations) / sum(self.durations) if sum(self.durations) else 0
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "params": self.params,
+            "repeat": len(self.durations),
+            "mean_ms": self.mean * 1000,
+            "p50_ms": self.p50 * 1000,
+            "p95_ms": self.p95 * 1000,
+            "ops_per_s": self.throughput,
+            "peak_kib": self.peak_bytes / 1024,
+            "allocated_kib": self.allocated_bytes / 1024,
+            **self.extra,
+        }
+
+
+def measure(name, func, repeat=10, params=None, setup=None, trace_allocations=True):
+    # func(state) is timed; setup() runs untimed before each call and its return value is passed to func
+    # Allocations are traced in one extra call so that tracemalloc does not skew the timings
+    durations = []
+    phases = {}
+
+    gc.collect()
+    for _ in range(repeat):
+        state = setup() if setup else None
+        start_time = time.perf_counter()
+        res = func(state)
+        durations.append(time.perf_counter() - start_time)
+
+        # Benchmarks can report their own per-phase timings by returning a dict of seconds
+        if isinstance(res, dict):
+            for phase, seconds in res.items():
+                phases.setdefault(phase, []).append(seconds)
+
+    peak_bytes = 0
+    allocated_bytes = 0
+    if trace_allocations:
+        state = setup() if setup else None
+        tracemalloc.start()
+        func(state)
+        allocated_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    extra = {
+        f"{phase}_mean_ms": statistics.fmean(seconds_list) * 1000
+        for phase, seconds_list in phases.items()
+    }
+    return BenchmarkResult(
+        name, params or {}, durations, peak_bytes, allocated_bytes, extra
+    )
+
+
+def print_results(results):
+    for result in results:
+        dat = result.to_dict()
+        params = ", ".join(f"{key}={value}" for key, value in dat["params"].items())
+        print(
+            f"{dat['name']:<32} {params:<24} "
+            f"mean {dat['mean_ms']:9.3f} ms  p50 {dat['p50_ms']:9.3f} ms  p95 {dat['p95_ms']:9.3f} ms  "
+            f"{dat['ops_per_s']:9.1f} ops/s  peak {dat['peak_kib']:9.1f} KiB"
+        )
+        phases = [
+            f"{key[:-len('_mean_ms')]} {value:.3f} ms"
+            for key, value in result.extra.items()
+        ]
+        if phases:
+            print(f"{'':<32} {'':<24} phases: " + ", ".join(phases))
+
+
+def write_results(results, output_path):
+    with open(output_path, "w") as f:
+        f.write(json.dumps([result.to_dict() for result in results], indent=2))
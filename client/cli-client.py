@@ -92,8 +92,27 @@ class CLIInterface:
         print(emojize(f":thought_balloon: {msg}"), end=end, flush=True)
 
     @staticmethod
-    def assistant_message(msg: str, end="\n"):
-        print(emojize(f":robot: {msg}"), end=end, flush=True)
+    def partial_assistant_message(msg: str, is_start: bool):
+        if is_start:
+            print(emojize(":robot: "), end="", flush=True)
+        print(msg, end="", flush=True)
+
+    @staticmethod
+    def end_partial_assistant_message():
+        print(flush=True)
+
+    @staticmethod
+    def retract_partial_assistant_message():
+        # The streamed message above was rejected and never sent; the agent will retry
+        print(
+            emojize(":wastebasket: Discarded the message above (it was not sent)"),
+            flush=True,
+        )
+
+    @staticmethod
+    def assistant_message(msg: str, end="\n", was_streamed=False):
+        if not was_streamed:  # Already printed through partial messages
+            print(emojize(f":robot: {msg}"), end=end, flush=True)
 
         if READ_SENT_MESSAGES:
             if not msg.strip():
@@ -269,7 +288,11 @@ if __name__ == "__main__":
         ) as resp:
             for line in resp.iter_lines():
                 json_obj = json.loads(line)
-                if td := json_obj.get("total_duration", None):
+                if partial_message := json_obj.get("partial_server_message", None):
+                    getattr(CLIInterface, partial_message["type"])(
+                        **partial_message["arguments"]
+                    )
+                elif td := json_obj.get("total_duration", None):
                     print(f"Time taken for agent response: {td}s")
                     print("\n\n", end="")
                 else:
@@ -315,7 +338,13 @@ if __name__ == "__main__":
                     ) as resp:
                         for line in resp.iter_lines():
                             json_obj = json.loads(line)
-                            if td := json_obj.get("total_duration", None):
+                            if partial_message := json_obj.get(
+                                "partial_server_message", None
+                            ):
+                                getattr(CLIInterface, partial_message["type"])(
+                                    **partial_message["arguments"]
+                                )
+                            elif td := json_obj.get("total_duration", None):
                                 print(f"Time taken for agent response: {td}s")
                                 print("\n\n", end="")
                             else:
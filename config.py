@@ -23,12 +23,15 @@ def get_config():
         "Keys_and_IDs", "huggingface_user_access_token"
     )
 
+    tokenisers_path = config.get("Paths", "tokenisers_path", fallback="")
+
     return {
         "server_url": server_url,
         "model_name": model_name,
         "google_api_key": google_api_key,
         "google_prog_search_engine_id": google_prog_search_engine_id,
         "huggingface_user_access_token": huggingface_user_access_token,
+        "tokenisers_path": tokenisers_path,
     }
 
 
@@ -87,5 +90,13 @@ if __name__ == "__main__":
         "huggingface_user_access_token": huggingface_user_access_token,
     }
 
+    tokenisers_path = input(
+        "Please input local tokeniser directory (leave blank to download tokenisers from Hugging Face): "
+    ).strip()
+
+    config["Paths"] = {
+        "tokenisers_path": tokenisers_path,
+    }
+
     with open(path.join(path.dirname(__file__), "config.ini"), "w") as configfile:
         config.write(configfile)
@@ -1,8 +1,18 @@
 from os import path
 
+import httpx
 import ollama
 
 from config import CONFIG
+from llm_os.constants import MAX_CONCURRENT_AGENT_STEPS
 
 HOST_URL = CONFIG["server_url"]
 HOST = ollama.Client(HOST_URL)
+ASYNC_HOST = ollama.AsyncClient(
+    HOST_URL,
+    limits=httpx.Limits(  # One pooled keep-alive connection per concurrent agent step
+        max_connections=MAX_CONCURRENT_AGENT_STEPS,
+        max_keepalive_connections=MAX_CONCURRENT_AGENT_STEPS,
+        keepalive_expiry=60,
+    ),
+)
@@ -1,13 +1,17 @@
 import json
+import traceback
+from asyncio import get_running_loop
 from collections import deque
-from functools import reduce
-from os import path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from random import choice
+from time import perf_counter
 
 import json5
 import regex
-from host import HOST
-from pydantic import BaseModel, confloat
+from host import ASYNC_HOST, HOST
+from pydantic import BaseModel, StrictStr, ValidationError, confloat
 from typing_extensions import TypedDict
 
 from llm_os.constants import (
@@ -15,12 +19,12 @@ from llm_os.constants import (
     FLUSH_TOKEN_FRAC,
     FUNCTION_PARAM_NAME_REQ_HEARTBEAT,
     INFERENCE_STRICTNESS,
-    JSON_TO_PY_TYPE_MAP,
+    BACKGROUND_SUMMARISATION_THREAD_POOL_SIZE,
     LAST_N_MESSAGES_TO_PRESERVE,
     MEMORY_EDITING_FUNCTIONS,
-    PY_TO_JSON_TYPE_MAP,
     SEND_MESSAGE_FUNCTION_NAME,
     SHOW_DEBUG_MESSAGES,
+    STREAM_AGENT_RESPONSES,
     TRUNCATION_TOKEN_FRAC,
     WARNING__MESSAGE_SINCE_LAST_CONSCIOUS_MEMORY_EDIT__COUNT,
     WARNING_TOKEN_FRAC,
@@ -31,36 +35,145 @@ from llm_os.memory.file_storage import FileStorage
 from llm_os.memory.memory import Memory
 from llm_os.memory.recall_storage import RecallStorage
 from llm_os.memory.working_context import WorkingContext
-from llm_os.prompts.llm_os_summarize import get_summarise_system_prompt
+from llm_os.metrics import (
+    CONTEXT_FILL_RATIO,
+    FUNCTION_CALL_DURATION,
+    FUNCTION_CALL_REJECTIONS,
+    LLM_TOKENS,
+    METRICS,
+    STEPS,
+    SUMMARISATION_DURATION,
+    SUMMARISATIONS,
+)
+from llm_os.prompts.llm_os_summarize import (
+    get_merge_summaries_system_prompt,
+    get_summarise_system_prompt,
+)
+from llm_os.tracing import Trace
 from llm_os.web_interface import WebInterface
 
 
+SUMMARISATION_EXECUTOR = ThreadPoolExecutor(
+    max_workers=BACKGROUND_SUMMARISATION_THREAD_POOL_SIZE
+)
+
+
 class FunctionCall(TypedDict):
     name: str
     arguments: dict
 
 
-class LLMResponse(BaseModel):
-    emotions: list[tuple[str, confloat(ge=1.0, le=10.0)]]
-    thoughts: list[str]
+class LLMResponseInnerState(BaseModel):
+    # Strict, so that booleans and numeric strings are rejected rather than coerced
+    emotions: list[tuple[StrictStr, confloat(ge=1.0, le=10.0, strict=True)]]
+    thoughts: list[StrictStr]
+
+
+class LLMResponse(LLMResponseInnerState):
     function_call: FunctionCall
 
 
+# Only depends on the model, so it is built once rather than on every structured output request
+LLM_RESPONSE_JSON_SCHEMA = LLMResponse.model_json_schema()
+
+
 class DuplicateKeyError(Exception):
     pass
 
 
 def dict_raise_on_duplicates(ordered_pairs):
     """Reject duplicate keys."""
-    d = {}
-    for k, v in ordered_pairs:
-        if k in d:
-            raise DuplicateKeyError(f"'{k}'")
-        else:
-            d[k] = v
+    d = dict(ordered_pairs)
+    if len(d) != len(ordered_pairs):
+        seen = set()
+        for k, _ in ordered_pairs:
+            if k in seen:
+                raise DuplicateKeyError(f"'{k}'")
+            seen.add(k)
     return d
 
 
+def loads_llm_output(content, object_pairs_hook=None):
+    # Model output is almost always strict JSON, which the C accelerated json module parses much faster than json5
+    # json5 is only used for the rest (comments, trailing commas, single quotes, ...)
+    # A DuplicateKeyError raised by the hook during the strict parse is final, since json5 would find the same duplicate
+    try:
+        return json.loads(content, object_pairs_hook=object_pairs_hook)
+    except json.JSONDecodeError:
+        return json5.loads(content, object_pairs_hook=object_pairs_hook)
+
+
+SEND_MESSAGE_ARGUMENT_START_PATTERN = regex.compile(
+    r'"function_call"\s*:\s*\{\s*"name"\s*:\s*"'
+    + SEND_MESSAGE_FUNCTION_NAME
+    + r'"\s*,\s*"arguments"\s*:\s*\{\s*"message"\s*:\s*"'
+)
+
+
+JSON_STRING_BODY_PATTERN = regex.compile(r'(?:[^"\\]+|\\.)*', regex.DOTALL)
+
+
+def decode_partial_json_string(raw):
+    # Decodes the longest prefix of the body of a JSON string that does not end part-way through an escape sequence
+    # Returns (decoded, number of characters of raw decoded)
+    for no_chars_to_trim in range(min(len(raw), 6) + 1):
+        no_raw_chars = len(raw) - no_chars_to_trim
+        try:
+            decoded = json.loads('"' + raw[:no_raw_chars] + '"')
+        except ValueError:
+            continue
+        if decoded and "\ud800" <= decoded[-1] <= "\udbff":
+            # Wait for the low surrogate (the high one is always escaped as \uXXXX)
+            return decoded[:-1], no_raw_chars - 6
+        return decoded, no_raw_chars
+    return "", 0
+
+
+class SendMessageStreamExtractor:
+    """Incrementally extracts the 'send_message' message argument from a partially generated response."""
+
+    def __init__(self):
+        # Offsets into the response are kept between calls, so that each chunk is only scanned and decoded once
+        self.scan_pos = 0  # Where to resume looking for the start of the argument, then for its closing quote
+        self.message_start = None
+        self.message_end = None
+        self.decode_pos = (
+            None  # Characters of the argument before this have been decoded
+        )
+        self.no_chars_streamed = 0
+
+    @property
+    def has_streamed(self):
+        return self.no_chars_streamed > 0
+
+    def feed(self, content):
+        # content is the whole response so far; returns the message text that has become available since the last call
+        if self.message_start is None:
+            match = SEND_MESSAGE_ARGUMENT_START_PATTERN.search(
+                content, self.scan_pos, partial=True
+            )
+            if match is None:
+                self.scan_pos = len(content)
+                return ""
+            if match.partial:  # The start of the argument may still be being generated
+                self.scan_pos = match.start()
+                return ""
+            self.message_start = self.decode_pos = self.scan_pos = match.end()
+
+        if self.message_end is None:
+            # Stops at the closing quote, or before a trailing backslash whose escape is not complete yet
+            self.scan_pos = JSON_STRING_BODY_PATTERN.match(content, self.scan_pos).end()
+            if self.scan_pos < len(content) and content[self.scan_pos] == '"':
+                self.message_end = self.scan_pos
+
+        decoded, no_raw_chars = decode_partial_json_string(
+            content[self.decode_pos : self.message_end or len(content)]
+        )
+        self.decode_pos += no_raw_chars
+        self.no_chars_streamed += len(decoded)
+        return decoded
+
+
 class Agent:
     def __init__(
         self,
@@ -77,13 +190,6 @@ class Agent:
         recall_storage: RecallStorage,
         file_storage: FileStorage,
     ):
-        self.misc_info_path = path.join(
-            path.dirname(path.dirname(__file__)),
-            "persistent_storage",
-            conv_name,
-            "misc_info.json",
-        )
-
         self.interface = interface
         self.web_interface = web_interface
 
@@ -107,39 +213,51 @@ class Agent:
         self.__conscious_memory_write_alr_forced = False
         self.__messages_since_last_conscious_memory_write = 0
         self.__memory_write_function_forced = False
-        if path.exists(self.misc_info_path):
-            self.__save_misc_info_path_dat_to_misc_info_vars()
+        self.__pending_summarisation = None  # (messages being summarised, future)
+        self.closed = False
+        self.__trace = None
+        self.last_step_trace = None
+        self.__function_call_executed = False
+
+        self.memory.state_store.register("misc_info", lambda: self.misc_info)
+        misc_info = self.memory.state_store.load("misc_info")
+        if misc_info is not None:
+            self.__save_misc_info_to_misc_info_vars(misc_info)
         else:
             self.__write_misc_info_vars_to_misc_info_path_dat()
 
-    def __save_misc_info_path_dat_to_misc_info_vars(self):
-        with open(self.misc_info_path, "r") as f:
-            misc_info = json.loads(f.read())
-            self.__memory_pressure_warning_alr_given = misc_info[
-                "memory_pressure_warning_alr_given"
-            ]
-            self.__conscious_memory_write_alr_forced = misc_info[
-                "conscious_memory_write_alr_forced"
-            ]
-            self.__messages_since_last_conscious_memory_write = misc_info[
-                "messages_since_last_conscious_memory_write"
-            ]
-            self.__memory_write_function_forced = misc_info[
-                "memory_write_function_forced"
-            ]
+    @property
+    def misc_info(self):
+        return {
+            "memory_pressure_warning_alr_given": self.__memory_pressure_warning_alr_given,
+            "conscious_memory_write_alr_forced": self.__conscious_memory_write_alr_forced,
+            "messages_since_last_conscious_memory_write": self.__messages_since_last_conscious_memory_write,
+            "memory_write_function_forced": self.__memory_write_function_forced,
+        }
+
+    def __save_misc_info_to_misc_info_vars(self, misc_info):
+        self.__memory_pressure_warning_alr_given = misc_info[
+            "memory_pressure_warning_alr_given"
+        ]
+        self.__conscious_memory_write_alr_forced = misc_info[
+            "conscious_memory_write_alr_forced"
+        ]
+        self.__messages_since_last_conscious_memory_write = misc_info[
+            "messages_since_last_conscious_memory_write"
+        ]
+        self.__memory_write_function_forced = misc_info["memory_write_function_forced"]
 
     def __write_misc_info_vars_to_misc_info_path_dat(self):
-        if not path.exists(self.misc_info_path):
-            f = open(self.misc_info_path, "x")
-            f.close()
-        with open(self.misc_info_path, "w") as f:
-            misc_info = {
-                "memory_pressure_warning_alr_given": self.__memory_pressure_warning_alr_given,
-                "conscious_memory_write_alr_forced": self.__conscious_memory_write_alr_forced,
-                "messages_since_last_conscious_memory_write": self.__messages_since_last_conscious_memory_write,
-                "memory_write_function_forced": self.__memory_write_function_forced,
-            }
-            f.write(json.dumps(misc_info))
+        # Deferred until the end of the step when called during one
+        self.memory.state_store.mark_dirty("misc_info")
+
+    def close(self):
+        # Flushes persistent state and releases storage clients (the agent must not be used afterwards)
+        self.closed = True  # A background summary that is already running cannot be cancelled, so it must not be swapped in afterwards
+        self.cancel_background_summarisation()
+        self.__write_misc_info_vars_to_misc_info_path_dat()
+        self.memory.close()
+        METRICS.remove_conv(self.conv_name)  # Keeps the number of series bounded by the number of loaded agents
 
     @property
     def memory_pressure_warning_alr_given(self):
@@ -196,6 +314,22 @@ class Agent:
             },
         }
 
+    def __timed_function_call(self, function_name, function, arguments):
+        self.__function_call_executed = True
+        start_time = perf_counter()
+        failed = True
+        try:
+            with self.__span("function_call", function=function_name):
+                result = function(**arguments)
+            failed = False
+            return result
+        finally:
+            FUNCTION_CALL_DURATION.observe(
+                perf_counter() - start_time,
+                function=function_name,
+                failed=str(failed).lower(),
+            )
+
     def __call_function(self, user_id, function_call, is_first_message=False):
         # Returns: res_messageds, heartbeat_request, function_failed
         res_messageds = []
@@ -285,11 +419,7 @@ class Agent:
             return res_messageds, True, True  # Sends heartbeat request so LLM can retry
 
         # Step 2: Check if function exists
-        function_dats = dict(
-            self.memory.in_context_function_dats,
-            **self.memory.out_of_context_function_dats,
-        )
-        called_function_dat = function_dats.get(called_function_name, None)
+        called_function_dat = self.memory.function_dats.get(called_function_name, None)
         if not called_function_dat:
             interface_message = f'Function "{called_function_name}" does not exist.'
             res_messageds.append(
@@ -299,70 +429,14 @@ class Agent:
 
             return res_messageds, True, True  # Sends heartbeat request so LLM can retry
 
-        # Step 3: Get Python function and function schema
+        # Step 3: Get Python function
         called_function = called_function_dat["python_function"]
-        called_function_schema = called_function_dat["json_schema"]
-        called_function_parameters = called_function_schema["parameters"]["properties"]
-        called_function_required_parameter_names = called_function_schema["parameters"][
-            "required"
-        ]
 
         # Step 4: Valiate arguments
-        ## Check if required arguments are present
-        called_function_parameter_names = called_function_parameters.keys()
-        for argument in called_function_arguments.keys():
-            if argument not in called_function_parameter_names:
-                interface_message = f'Function "{called_function_name}" does not accept argument "{argument}".'
-                res_messageds.append(
-                    Agent.package_tool_response(user_id, interface_message, True)
-                )
-                self.interface.function_res_message(interface_message, True)
-
-                return (
-                    res_messageds,
-                    True,
-                    True,
-                )  # Sends heartbeat request so LLM can retry
-
-        if len(called_function_arguments) < len(
-            called_function_required_parameter_names
-        ):
-            interface_message = f'Function "{called_function_name}" requires at least {len(called_function_required_parameter_names)} arguments ({len(called_function_arguments)} given, missing arguments are {list(set(called_function_required_parameter_names)-set(called_function_arguments))}).'
-            if (
-                function_call.get("request_heartbeat", (None, 0)) != (None, 0)
-                and "request_heartbeat" in called_function_required_parameter_names
-            ):
-                interface_message += ' Please move the "request_heartbeat" argument into the "arguments" field.'
-
-            res_messageds.append(
-                Agent.package_tool_response(user_id, interface_message, True)
-            )
-            self.interface.function_res_message(interface_message, True)
-
-            return res_messageds, True, True  # Sends heartbeat request so LLM can retry
-        if len(called_function_arguments) > len(called_function_parameter_names):
-            interface_message = f'Function "{called_function_name}" can take at most {len(called_function_parameter_names)} arguments ({len(called_function_arguments)} given).'
-            res_messageds.append(
-                Agent.package_tool_response(user_id, interface_message, True)
-            )
-            self.interface.function_res_message(interface_message, True)
-
-            return res_messageds, True, True  # Sends heartbeat request so LLM can retry
-
-        if not set(called_function_required_parameter_names).issubset(
-            set(called_function_arguments.keys())
-        ):
-            required_arguments_str = ",".join(
-                map(
-                    lambda arg_name: f"'{arg_name}'",
-                    called_function_required_parameter_names,
-                )
-            )
-            given_arguments_str = ",".join(
-                map(lambda arg_name: f"'{arg_name}'", called_function_arguments.keys())
-            )
-
-            interface_message = f'Function "{called_function_name}" requires at least the arguments {required_arguments_str} ({given_arguments_str} given).'
+        interface_message = called_function_dat["argument_validator"].validate(
+            called_function_arguments, function_call
+        )
+        if interface_message:
             res_messageds.append(
                 Agent.package_tool_response(user_id, interface_message, True)
             )
@@ -370,70 +444,6 @@ class Agent:
 
             return res_messageds, True, True  # Sends heartbeat request so LLM can retry
 
-        ## Check if arguments are of the correct type
-        for argument_name, argument_value in called_function_arguments.items():
-            required_param_type = called_function_parameters[argument_name]["type"]
-
-            if type(argument_value) is list:
-                if required_param_type != "array":
-                    interface_message = f'Function "{called_function_name}" does not accept argument "{argument_name}" of type "array" (expected type "{required_param_type}").'
-                    res_messageds.append(
-                        Agent.package_tool_response(user_id, interface_message, True)
-                    )
-                    self.interface.function_res_message(interface_message, True)
-
-                    return (
-                        res_messageds,
-                        True,
-                        True,
-                    )  # Sends heartbeat request so LLM can retry
-                param_array_field_type = JSON_TO_PY_TYPE_MAP["array"].__args__[0]
-                all_arg_elem_correct_type = reduce(
-                    lambda x, y: x and y,
-                    map(lambda x: type(x) is param_array_field_type, argument_value),
-                    True,
-                )
-                if not all_arg_elem_correct_type:
-                    interface_message = f'Function "{called_function_name}" does not accept argument "{argument_name}" of type "array" (some or all elements are not of type {PY_TO_JSON_TYPE_MAP[param_array_field_type]}).'
-                    res_messageds.append(
-                        Agent.package_tool_response(user_id, interface_message, True)
-                    )
-                    self.interface.function_res_message(interface_message, True)
-
-                    return (
-                        res_messageds,
-                        True,
-                        True,
-                    )  # Sends heartbeat request so LLM can retry
-                continue
-
-            argument_value_type = PY_TO_JSON_TYPE_MAP.get(type(argument_value), None)
-            if required_param_type == "array":
-                interface_message = f'Function "{called_function_name}" does not accept argument "{argument_name}" of type "{argument_value_type}" (expected type "array").'
-                res_messageds.append(
-                    Agent.package_tool_response(user_id, interface_message, True)
-                )
-                self.interface.function_res_message(interface_message, True)
-
-                return (
-                    res_messageds,
-                    True,
-                    True,
-                )  # Sends heartbeat request so LLM can retry
-
-            if argument_value_type != required_param_type:
-                interface_message = f'Function "{called_function_name}" does not accept argument "{argument_name}" of type "{argument_value_type}" (expected type "{required_param_type}").'
-                res_messageds.append(
-                    Agent.package_tool_response(user_id, interface_message, True)
-                )
-                self.interface.function_res_message(interface_message, True)
-
-                return (
-                    res_messageds,
-                    True,
-                    True,
-                )  # Sends heartbeat request so LLM can retry
-
         # Step 5: Call function
         called_heartbeat_request = called_function_arguments.get(
             FUNCTION_PARAM_NAME_REQ_HEARTBEAT, None
@@ -463,7 +473,9 @@ class Agent:
             self.interface.function_call_message(
                 called_function_name, called_function_arguments
             )
-            called_function_result = called_function(**called_function_arguments)
+            called_function_result = self.__timed_function_call(
+                called_function_name, called_function, called_function_arguments
+            )
         except Exception as e:
             res_messageds.append(Agent.package_tool_response(user_id, str(e), True))
             self.interface.function_res_message(str(e), True)
@@ -484,50 +496,214 @@ class Agent:
 
         return res_messageds, called_heartbeat_request, False
 
-    def __handle_emotions(self, emotion_list):
-        if type(emotion_list) is not list:
-            return f"Failed to parse emotions: 'emotion' field's value is not a list."
-
-        for emotion in emotion_list:
-            if (type(emotion) is not tuple and type(emotion) is not list) or len(
-                emotion
-            ) != 2:
-                return f"All items in your generated object's 'emotions' field must be tuples containing type of emotion (str) and its intensity (float between 1 and 10 inclusive)."
-
-        for emotion_type, emotion_intensity in emotion_list:
-            if type(emotion_type) is not str or (
-                type(emotion_intensity) is not float
-                and type(emotion_intensity) is not int
+    @staticmethod
+    def __inner_state_error_message(validation_error):
+        # Maps pydantic's errors onto the messages the model has always been given; emotions are reported before thoughts
+        errors = validation_error.errors()
+        emotion_errors = [error for error in errors if error["loc"][0] == "emotions"]
+        if emotion_errors:
+            error = emotion_errors[0]
+            if len(error["loc"]) == 1 and error["type"] == "list_type":
+                return f"Failed to parse emotions: 'emotion' field's value is not a list."
+            if len(error["loc"]) == 3 and error["type"] in (
+                "greater_than_equal",
+                "less_than_equal",
             ):
-                return f"All items in your generated object's 'emotions' field must be tuples containing type of emotion (str) and its intensity (float between 1 and 10 inclusive)."
-            if not (1.0 <= emotion_intensity <= 10.0):
                 return f"Intensity of all emotions must be between 1 and 10 inclusive"
+            return f"All items in your generated object's 'emotions' field must be tuples containing type of emotion (str) and its intensity (float between 1 and 10 inclusive)."
 
-        for emotion_type, emotion_intensity in emotion_list:
+        error = errors[0]
+        if len(error["loc"]) == 1 and error["type"] == "list_type":
+            return f"Failed to parse thoughts: 'thoughts' field's value is not a list."
+        return f"All items in your generated object's 'thoughts' field must be strings."
+
+    def __handle_inner_state(self, emotion_list, thought_list):
+        try:
+            inner_state = LLMResponseInnerState.model_validate(
+                {"emotions": emotion_list, "thoughts": thought_list}
+            )
+        except ValidationError as e:
+            fail_message = self.__inner_state_error_message(e)
+            if all(error["loc"][0] == "thoughts" for error in e.errors()):
+                # Valid emotions were still shown when only the thoughts were rejected
+                for emotion_type, emotion_intensity in emotion_list:
+                    self.interface.inner_emotion(emotion_type, emotion_intensity)
+            return fail_message
+
+        for emotion_type, emotion_intensity in inner_state.emotions:
             self.interface.inner_emotion(emotion_type, emotion_intensity)
+        for thought in inner_state.thoughts:
+            self.interface.internal_monologue(thought)
 
         return None
 
-    def __handle_thoughts(self, thought_list):
-        if type(thought_list) is not list:
-            return f"Failed to parse thoughts: 'thoughts' field's value is not a list."
+    def __generate_response_content(
+        self, messages, response_format, stream_send_message
+    ):
+        if not STREAM_AGENT_RESPONSES or not stream_send_message:
+            response = HOST.chat(
+                model=self.model_name,
+                messages=messages,
+                format=response_format,
+                options={"num_ctx": self.memory.ctx_window},
+            )
+            self.__record_llm_token_usage(response)
+            return response["message"]["content"]
 
-        for thought in thought_list:
-            if type(thought) is not str:
-                return f"All items in your generated object's 'thoughts' field must be strings."
+        extractor = SendMessageStreamExtractor()
+        result_content = ""
+        for chunk in HOST.chat(
+            model=self.model_name,
+            messages=messages,
+            format=response_format,
+            options={"num_ctx": self.memory.ctx_window},
+            stream=True,
+        ):
+            result_content += chunk["message"]["content"]
+            self.__stream_partial_assistant_message(extractor, result_content)
+            if chunk.get("done"):
+                self.__record_llm_token_usage(chunk)
 
-        for thought in thought_list:
-            self.interface.internal_monologue(thought)
+        if extractor.has_streamed:
+            self.interface.end_partial_assistant_message()
 
-        return None
+        return result_content
+
+    async def __agenerate_response_content(
+        self, messages, response_format, stream_send_message
+    ):
+        if not STREAM_AGENT_RESPONSES or not stream_send_message:
+            response = await ASYNC_HOST.chat(
+                model=self.model_name,
+                messages=messages,
+                format=response_format,
+                options={"num_ctx": self.memory.ctx_window},
+            )
+            self.__record_llm_token_usage(response)
+            return response["message"]["content"]
+
+        extractor = SendMessageStreamExtractor()
+        result_content = ""
+        async for chunk in await ASYNC_HOST.chat(
+            model=self.model_name,
+            messages=messages,
+            format=response_format,
+            options={"num_ctx": self.memory.ctx_window},
+            stream=True,
+        ):
+            result_content += chunk["message"]["content"]
+            self.__stream_partial_assistant_message(extractor, result_content)
+            if chunk.get("done"):
+                self.__record_llm_token_usage(chunk)
+
+        if extractor.has_streamed:
+            self.interface.end_partial_assistant_message()
+
+        return result_content
+
+    def __record_llm_token_usage(self, response):
+        # Ollama reports token counts on the final response (or final streamed chunk)
+        LLM_TOKENS.inc(
+            response.get("prompt_eval_count") or 0,
+            conv_name=self.conv_name,
+            direction="in",
+        )
+        LLM_TOKENS.inc(
+            response.get("eval_count") or 0, conv_name=self.conv_name, direction="out"
+        )
+
+    def __can_stream_send_message(self, is_first_message):
+        # send_message text is only streamed when __call_function would not reject a send_message call outright; any other rejection (bad JSON, inner state or arguments) is retracted once the step has finished
+        if is_first_message:
+            return SEND_MESSAGE_FUNCTION_NAME in FIRST_MESSAGE_COMPULSORY_FUNCTION_SET
+        return (
+            not self.conscious_memory_write_alr_forced
+            or SEND_MESSAGE_FUNCTION_NAME in MEMORY_EDITING_FUNCTIONS
+        )
+
+    def __stream_partial_assistant_message(self, extractor, result_content):
+        is_start = not extractor.has_streamed
+        delta = extractor.feed(result_content)
+        if delta:
+            self.interface.partial_assistant_message(delta, is_start)
+
+    def __span(self, name, **attributes):
+        if self.__trace is None:
+            return nullcontext()
+        return self.__trace.span(name, **attributes)
+
+    def __start_trace(self, user_id, is_first_message):
+        self.__trace = Trace(
+            "agent.step",
+            conv_name=self.conv_name,
+            user_id=user_id,
+            is_first_message=is_first_message,
+        )
+
+    def __end_trace(self):
+        self.__trace.end()
+        self.last_step_trace = self.__trace
+        self.__trace = None
 
     def step(self, user_id, is_first_message=False) -> str:
+        self.__start_trace(user_id, is_first_message)
+        self.memory.state_store.begin_batch()
+        try:
+            messages, response_format = self.__prepare_step(user_id)
+            with self.__span("llm_inference"):
+                result_content = self.__generate_response_content(
+                    messages,
+                    response_format,
+                    self.__can_stream_send_message(is_first_message),
+                )
+            return self.__finish_step(user_id, result_content, is_first_message)
+        finally:
+            # Streamed text whose send_message call did not go through
+            self.interface.retract_partial_assistant_message()
+            self.__commit_step_state()
+            self.__end_trace()
+
+    async def astep(self, user_id, is_first_message=False, executor=None):
+        # Same as step, but LLM inference is awaited on the async client; memory, storage and function calls still run synchronously on the executor
+        loop = get_running_loop()
+        self.__start_trace(user_id, is_first_message)
+        self.memory.state_store.begin_batch()
+        try:
+            messages, response_format = await loop.run_in_executor(
+                executor, self.__prepare_step, user_id
+            )
+            with self.__span("llm_inference"):
+                result_content = await self.__agenerate_response_content(
+                    messages,
+                    response_format,
+                    self.__can_stream_send_message(is_first_message),
+                )
+            return await loop.run_in_executor(
+                executor,
+                partial(self.__finish_step, user_id, result_content, is_first_message),
+            )
+        finally:
+            # Streamed text whose send_message call did not go through
+            self.interface.retract_partial_assistant_message()
+            await loop.run_in_executor(executor, self.__commit_step_state)
+            self.__end_trace()
+
+    def __commit_step_state(self):
+        # Everything the step changed in fifo_queue.json, working_context.json, misc_info.json and summary_tree.json is written here, once
+        with self.__span("state_persistence"):
+            self.memory.state_store.end_batch()
+
+    def __prepare_step(self, user_id):
         # note: all messageds must be in the form {'type': type, 'user_id': user_id, 'message': {'role': role, 'content': content}}
         ##*Step 1: Bring current human working memory block into context if needed
-        self.memory.working_context.submit_used_human_id(user_id)
+        with self.__span("working_context"):
+            self.memory.working_context.submit_used_human_id(user_id)
 
         ##*Step 2: Check memory pressure
-        if self.memory.main_ctx_message_seq_no_tokens > int(
+        self.apply_background_summarisation_if_ready()
+        with self.__span("token_counting"):
+            main_ctx_message_seq_no_tokens = self.memory.main_ctx_message_seq_no_tokens
+        if main_ctx_message_seq_no_tokens > int(
             FLUSH_TOKEN_FRAC * self.memory.ctx_window
         ):
             self.summarise_messages_in_place()
@@ -544,31 +720,20 @@ class Agent:
 
         match INFERENCE_STRICTNESS:
             case 0:  # no constraints
-                response = HOST.chat(
-                    model=self.model_name,
-                    messages=self.memory.main_ctx_message_seq,
-                    options={"num_ctx": self.memory.ctx_window},
-                )
+                response_format = None
             case 1:  # JSON mode
-                response = HOST.chat(
-                    model=self.model_name,
-                    messages=self.memory.main_ctx_message_seq,
-                    format="json",
-                    options={"num_ctx": self.memory.ctx_window},
-                )
+                response_format = "json"
             case 2:  # structured output
-                response = HOST.chat(
-                    model=self.model_name,
-                    messages=self.memory.main_ctx_message_seq,
-                    format=LLMResponse.model_json_schema(),
-                    options={"num_ctx": self.memory.ctx_window},
-                )
+                response_format = LLM_RESPONSE_JSON_SCHEMA
 
             case _:
                 raise ValueError("Invalid inference strictness (must be from 0-2)")
 
-        result_content = response["message"]["content"]
+        with self.__span("prompt_rendering"):
+            main_ctx_message_seq = self.memory.main_ctx_message_seq
+        return main_ctx_message_seq, response_format
 
+    def __finish_step(self, user_id, result_content, is_first_message):
         if SHOW_DEBUG_MESSAGES:
             self.interface.debug_message(f"Got result:\n{result_content}")
 
@@ -581,9 +746,10 @@ class Agent:
         ]
 
         try:
-            json_result = json5.loads(
-                result_content, object_pairs_hook=dict_raise_on_duplicates
-            )
+            with self.__span("json_parsing"):
+                json_result = loads_llm_output(
+                    result_content, object_pairs_hook=dict_raise_on_duplicates
+                )
             if type(json_result) is not dict:
                 raise RuntimeError
         except (RuntimeError, ValueError):
@@ -623,9 +789,10 @@ class Agent:
                 and json_result.get("thoughts", None)
                 and json_result.get("function_call", None)
             ):
-                ##*Step 4: Handle emotions
-                emotion_list = json_result["emotions"]
-                fail_message = self.__handle_emotions(emotion_list)
+                ##*Step 4 & 5: Handle emotions and thoughts
+                fail_message = self.__handle_inner_state(
+                    json_result["emotions"], json_result["thoughts"]
+                )
 
                 if fail_message:
                     res_messageds.append(
@@ -642,32 +809,27 @@ class Agent:
                     heartbeat_request = True
                     function_failed = False
                 else:
-                    ##*Step 5: Handle thoughts
-                    thought_list = json_result["thoughts"]
-                    fail_message = self.__handle_thoughts(thought_list)
-
-                    if fail_message:
-                        res_messageds.append(
-                            {
-                                "type": "system",
-                                "user_id": user_id,
-                                "message": {
-                                    "role": "user",
-                                    "content": fail_message,
-                                },
-                            }
+                    ##*Step 6: Handle function call
+                    self.__function_call_executed = False
+                    d_res_messageds, heartbeat_request, function_failed = (
+                        self.__call_function(
+                            user_id, json_result["function_call"], is_first_message
+                        )
+                    )
+                    res_messageds += d_res_messageds
+                    if function_failed and not self.__function_call_executed:
+                        function_name = (
+                            json_result["function_call"].get("name")
+                            if type(json_result["function_call"]) is dict
+                            else None
                         )
-                        self.interface.system_message(fail_message)
-                        heartbeat_request = True
-                        function_failed = False
-                    else:
-                        ##*Step 6: Handle function call
-                        d_res_messageds, heartbeat_request, function_failed = (
-                            self.__call_function(
-                                user_id, json_result["function_call"], is_first_message
+                        FUNCTION_CALL_REJECTIONS.inc(
+                            function=(
+                                function_name
+                                if type(function_name) is str
+                                else ""
                             )
                         )
-                        res_messageds += d_res_messageds
 
             elif unidentified_keys:
                 surround_with_single_quotes = lambda s: f"'{s}'"
@@ -702,9 +864,12 @@ class Agent:
             not is_first_message
         ):  # *This if statement is here because first message only accepts a limited range of functions
             had_just_sent_mpw = False
-            if (
-                not self.memory_pressure_warning_alr_given
-                and self.memory.main_ctx_message_seq_no_tokens
+            with self.__span("token_counting"):
+                main_ctx_message_seq_no_tokens = (
+                    self.memory.main_ctx_message_seq_no_tokens
+                )
+            if not self.memory_pressure_warning_alr_given and (
+                main_ctx_message_seq_no_tokens
                 > int(WARNING_TOKEN_FRAC * self.memory.ctx_window)
             ):
                 interface_message = f"Warning: Memory pressure has exceeded {WARNING_TOKEN_FRAC*100}% of the context window. Please store important information from your recent conversation history into your core memory or archival storage by calling functions. You MUST finish updating your memory before doing other necessary tasks!"
@@ -728,7 +893,7 @@ class Agent:
                 self.memory_write_function_forced = True
                 heartbeat_request = True
                 had_just_sent_mpw = True
-            elif self.memory.main_ctx_message_seq_no_tokens > int(
+            elif main_ctx_message_seq_no_tokens > int(
                 FLUSH_TOKEN_FRAC * self.memory.ctx_window
             ):
                 self.summarise_messages_in_place()
@@ -763,8 +928,32 @@ class Agent:
             had_just_sent_mpw = False
 
         ##*Step 9: Update memory
-        for messaged in res_messageds:
-            self.memory.append_messaged_to_fq_and_rs(messaged)
+        with self.__span("recall_persistence"):
+            for messaged in res_messageds:
+                self.memory.append_messaged_to_fq_and_rs(messaged)
+
+        with self.__span("token_counting"):
+            main_ctx_message_seq_no_tokens = self.memory.main_ctx_message_seq_no_tokens
+        # Only once the memory pressure warning has been given and the agent has written its memory, so that messages are not evicted before it could save them; past FLUSH_TOKEN_FRAC they are summarised synchronously regardless
+        if (
+            main_ctx_message_seq_no_tokens
+            > int(WARNING_TOKEN_FRAC * self.memory.ctx_window)
+            and self.memory_pressure_warning_alr_given
+            and not self.memory_write_function_forced
+        ):
+            self.start_background_summarisation()
+
+        CONTEXT_FILL_RATIO.set(
+            main_ctx_message_seq_no_tokens / self.memory.ctx_window,
+            conv_name=self.conv_name,
+        )
+        if function_failed:
+            step_outcome = "function_failed"
+        elif not any(messaged["type"] == "tool" for messaged in res_messageds):
+            step_outcome = "invalid_response"
+        else:
+            step_outcome = "ok"
+        STEPS.inc(conv_name=self.conv_name, outcome=step_outcome)
 
         ##*Step 10: Return response
         return res_messageds, heartbeat_request, function_failed
@@ -837,7 +1026,9 @@ class Agent:
                 )
             else:
                 try:
-                    message_content_dict = json5.loads(messaged["message"]["content"])
+                    message_content_dict = loads_llm_output(
+                        messaged["message"]["content"]
+                    )
                 except ValueError:
                     translated_messages.append(
                         f"❮ERRONEOUS ASSISTANT MESSAGE for conversation with user with id '{messaged['user_id']}'❯ {messaged['message']['content']}"
@@ -857,17 +1048,8 @@ class Agent:
             {"role": "user", "content": "\n\n".join(translated_messages)},
         ]
 
-    def summarise_messages_in_place(self):
-        if SHOW_DEBUG_MESSAGES:
-            print(
-                f"Memory pressure has exceeded {FLUSH_TOKEN_FRAC*100}% of the context window ({self.memory.main_ctx_message_seq_no_tokens}/{FLUSH_TOKEN_FRAC * self.memory.ctx_window} tokens). Flushing message queue..."
-            )
-
-        self.interface.memory_message(
-            f"Memory pressure has exceeded {FLUSH_TOKEN_FRAC*100}% of the context window. Flushing message queue..."
-        )
-        assert self.memory.main_ctx_message_seq[0]["role"] == "system"
-
+    def __select_messages_to_be_summarised(self):
+        # Picks the oldest FIFO segment whose eviction brings memory pressure down to TRUNCATION_TOKEN_FRAC; the queue is left unchanged
         messages_to_be_summarised = deque()
 
         while (
@@ -875,47 +1057,203 @@ class Agent:
             > int(TRUNCATION_TOKEN_FRAC * self.memory.ctx_window)
             and len(self.memory.fifo_queue) > LAST_N_MESSAGES_TO_PRESERVE
         ):
-            self.memory.no_messages_in_queue -= 1
-            messages_to_be_summarised.appendleft(self.memory.fifo_queue.popleft())
+            messages_to_be_summarised.append(self.memory.pop_oldest_messaged_from_fq())
 
         while (
-            self.memory.main_ctx_message_seq_no_tokens
+            messages_to_be_summarised
+            and self.memory.main_ctx_message_seq_no_tokens
             < int(WARNING_TOKEN_FRAC * self.memory.ctx_window)
             and self.memory.fifo_queue[0]["type"] != "user"
         ):
-            self.memory.no_messages_in_queue += 1
-            self.memory.fifo_queue.appendleft(messages_to_be_summarised.popleft())
+            self.memory.push_oldest_messaged_to_fq(messages_to_be_summarised.pop())
 
-        summary_message_seq = Agent.summary_message_seq(messages_to_be_summarised)
+        for messaged in reversed(messages_to_be_summarised):
+            self.memory.push_oldest_messaged_to_fq(messaged)
 
-        if SHOW_DEBUG_MESSAGES:
-            print("Got summary message sequence")
+        return list(messages_to_be_summarised)
 
+    def __chat_summary(self, summary_message_seq):
         result = HOST.chat(
             model=self.model_name,
             messages=summary_message_seq,
             options={"num_ctx": self.memory.ctx_window},
         )
-        result_content = result["message"]["content"]
+        self.__record_llm_token_usage(result)
+        return result["message"]["content"]
+
+    def __merge_summaries(self, summaries):
+        return self.__chat_summary(
+            [
+                {"role": "system", "content": get_merge_summaries_system_prompt()},
+                {"role": "user", "content": "\n\n".join(summaries)},
+            ]
+        )
+
+    def __summarise(self, messages_to_be_summarised, mode="synchronous"):
+        start_time = perf_counter()
+        try:
+            return self.__build_summary_tree_state(messages_to_be_summarised)
+        except Exception:
+            # Background failures are recorded when the result is collected
+            if mode != "background":
+                SUMMARISATIONS.inc(outcome="failed")
+            raise
+        finally:
+            SUMMARISATION_DURATION.observe(perf_counter() - start_time, mode=mode)
+
+    def __build_summary_tree_state(self, messages_to_be_summarised):
+        # Only newly evicted messages are summarised; the previous summary message is rebuilt from the cached summary tree
+        new_messageds = [
+            messaged
+            for messaged in messages_to_be_summarised
+            if not messaged.get("is_summary", False)
+        ]
+        summary_message_seq = Agent.summary_message_seq(new_messageds)
+
+        if SHOW_DEBUG_MESSAGES:
+            print("Got summary message sequence")
+
+        summary_tree_state = self.memory.summary_tree.with_segment(
+            len(new_messageds),
+            self.__chat_summary(summary_message_seq),
+            self.__merge_summaries,
+        )
+
+        if SHOW_DEBUG_MESSAGES:
+            print("Got new summary tree")
+
+        return summary_tree_state
+
+    @staticmethod
+    def has_new_messages_to_summarise(messages_to_be_summarised):
+        return any(
+            not messaged.get("is_summary", False)
+            for messaged in messages_to_be_summarised
+        )
+
+    def start_background_summarisation(self):
+        # Summarises the oldest FIFO segment ahead of time so that flushing does not stall a step
+        if self.__pending_summarisation is not None:
+            return
+
+        messages_to_be_summarised = self.__select_messages_to_be_summarised()
+        if not Agent.has_new_messages_to_summarise(messages_to_be_summarised):
+            return
 
         if SHOW_DEBUG_MESSAGES:
-            print("Got new recursive summary")
+            print(
+                f"Memory pressure has exceeded {WARNING_TOKEN_FRAC*100}% of the context window. Summarising {len(messages_to_be_summarised)} messages in the background..."
+            )
+
+        self.__pending_summarisation = (
+            messages_to_be_summarised,
+            SUMMARISATION_EXECUTOR.submit(
+                self.__summarise, messages_to_be_summarised, "background"
+            ),
+        )
+
+    def apply_background_summarisation_if_ready(self):
+        # Returns whether a summary was swapped into the FIFO queue
+        if self.__pending_summarisation is None:
+            return False
+
+        messages_to_be_summarised, future = self.__pending_summarisation
+        if not future.done():
+            return False
+
+        self.__pending_summarisation = None
+        try:
+            summary_tree_state = future.result()
+        except Exception:
+            Agent.report_background_summarisation_error()
+            return False
+
+        return self.__swap_in_summary(messages_to_be_summarised, summary_tree_state)
+
+    @staticmethod
+    def report_background_summarisation_error():
+        # Must be called from the except block handling the error
+        SUMMARISATIONS.inc(outcome="failed")
+        print("Background summarisation error")
+        traceback.print_exc()
+
+    def cancel_background_summarisation(self):
+        if self.__pending_summarisation is not None:
+            self.__pending_summarisation[1].cancel()
+            self.__pending_summarisation = None
+
+    def __swap_in_summary(self, messages_to_be_summarised, summary_tree_state):
+        if self.closed:
+            return False
+
+        # The summarised segment must still be at the front of the queue (it is stale if the queue was flushed in the meantime)
+        fifo_queue = self.memory.fifo_queue
+        if len(fifo_queue) < len(messages_to_be_summarised) or any(
+            fifo_queue[i] is not messaged
+            for i, messaged in enumerate(messages_to_be_summarised)
+        ):
+            SUMMARISATIONS.inc(outcome="stale")
+            return False
 
-        self.memory.fifo_queue.appendleft(
+        for _ in messages_to_be_summarised:
+            self.memory.pop_oldest_messaged_from_fq()
+
+        self.memory.summary_tree.commit(summary_tree_state)
+        self.memory.push_oldest_messaged_to_fq(
             {
                 "type": "system",
+                "is_summary": True,
                 "message": {
                     "role": "user",
                     "content": (
                         f"Note: prior messages ({self.memory.total_no_messages-self.memory.no_messages_in_queue} of {self.memory.total_no_messages}) have been hidden from view due to conversation memory constraints.\n"
-                        + f"The following is a summary of the previous {len(summary_message_seq)} messages:\n{result_content}"
+                        + f"The following are summaries of the previous {len(self.memory.summary_tree)} hidden messages:\n{str(self.memory.summary_tree)}"
                     ),
                 },
             }
         )
-        self.memory.no_messages_in_queue += 1
 
         self.memory.write_fq_to_fq_path()
+        self.memory_pressure_warning_alr_given = False
+
+        SUMMARISATIONS.inc(outcome="applied")
+
+        if SHOW_DEBUG_MESSAGES:
+            print("Swapped summary into message queue!")
+
+        return True
+
+    def summarise_messages_in_place(self):
+        with self.__span("summarisation"):
+            self.__summarise_messages_in_place()
+
+    def __summarise_messages_in_place(self):
+        if SHOW_DEBUG_MESSAGES:
+            print(
+                f"Memory pressure has exceeded {FLUSH_TOKEN_FRAC*100}% of the context window ({self.memory.main_ctx_message_seq_no_tokens}/{FLUSH_TOKEN_FRAC * self.memory.ctx_window} tokens). Flushing message queue..."
+            )
+
+        self.interface.memory_message(
+            f"Memory pressure has exceeded {FLUSH_TOKEN_FRAC*100}% of the context window. Flushing message queue..."
+        )
+        assert self.memory.main_ctx_message_seq[0]["role"] == "system"
+
+        # Synchronous fallback: wait for the background summary if one is in flight, otherwise summarise now
+        if self.__pending_summarisation is not None:
+            messages_to_be_summarised, future = self.__pending_summarisation
+            self.__pending_summarisation = None
+            try:
+                if self.__swap_in_summary(messages_to_be_summarised, future.result()):
+                    return
+            except Exception:
+                Agent.report_background_summarisation_error()
+
+        messages_to_be_summarised = self.__select_messages_to_be_summarised()
+        if not Agent.has_new_messages_to_summarise(messages_to_be_summarised):
+            return
+        self.__swap_in_summary(
+            messages_to_be_summarised, self.__summarise(messages_to_be_summarised)
+        )
 
         if SHOW_DEBUG_MESSAGES:
             print("summarise_messages_in_place function success!")
@@ -1,7 +1,11 @@
+from os import path
+
 # Inference constants
 INFERENCE_STRICTNESS = (
     2  # * 0 -> no constraints, 1 -> json mode, 2 -> (RECOMMENDED) structured output
 )
+STREAM_AGENT_RESPONSES = True  # Streams 'send_message' text to the interface while the response is being generated
+STABLE_PROMPT_PREFIX = True  # Moves external context counts and core memory out of the system prompt into a trailing note so that Ollama can reuse its prompt cache between steps
 
 # USE_SET_STARTING_MESSAGE = True  # Helps because few-shot ig
 # SET_STARTING_MESSAGE = """
@@ -64,6 +68,12 @@ RETRIEVAL_QUERY_DEFAULT_PAGE_SIZE = 5
 # File storage constants
 BLACKLISTED_FOLDERS_OR_FILES = {".git", "file_summaries.json"}
 
+# Embedding constants
+EMBEDDING_BATCH_SIZE = 64  # Texts per /api/embed request
+EMBEDDING_BATCH_MAX_DELAY_SECONDS = 0.005  # Longest a text waits for others to share its request
+MAX_CONCURRENT_EMBEDDING_REQUESTS = 4
+USE_EMBEDDING_CACHE = True  # Keeps every embedded document chunk on disk (persistent_storage/.embedding_cache) so that it is never embedded twice
+
 # Working context constants
 WORKING_CTX_HUMAN_MAX_TOKENS = 500
 WORKING_CTX_PERSONA_MAX_TOKENS = 750
@@ -76,7 +86,9 @@ FUNCTION_PARAM_DESCRIPTION_REQ_HEARTBEAT = "Request an immediate heartbeat after
 # Summarisation constants
 TRUNCATION_TOKEN_FRAC = 0.5
 SUMMARY_WORD_LIMIT = 100
+SUMMARY_TREE_FAN_OUT = 4
 LAST_N_MESSAGES_TO_PRESERVE = 3
+BACKGROUND_SUMMARISATION_THREAD_POOL_SIZE = 2
 
 # JSON schema type maps
 PY_TO_JSON_TYPE_MAP = {
@@ -102,3 +114,23 @@ JSON_TO_PY_TYPE_MAP = {
 # Memory pressure constants
 WARNING_TOKEN_FRAC = 0.95
 FLUSH_TOKEN_FRAC = 0.98
+
+# Server concurrency constants
+MAX_CONCURRENT_AGENT_STEPS = 4  # Should match OLLAMA_NUM_PARALLEL on the Ollama host
+AGENT_STEP_THREAD_POOL_SIZE = 8
+
+# Loaded agent cache constants
+MAX_LOADED_AGENTS = 16
+LOADED_AGENT_IDLE_TIMEOUT_SECONDS = 30 * 60
+
+# Conversation state persistence constants
+PERSISTENT_STORAGE_PATH = path.join(
+    path.dirname(path.dirname(__file__)), "persistent_storage"
+)  # Conversations, the embedding cache and the function schema index (read when llm_os modules are imported)
+CONVERSATION_STORAGE_BACKEND = "sqlite"  # Backend for new conversations ("sqlite" or "json"), existing ones keep theirs until migrated (python3 -m llm_os.memory.migrate_storage)
+STATE_STORE_FSYNC = False  # fsync conversation state on every commit (survives power loss at the cost of slower steps)
+
+# Instrumentation constants
+INCLUDE_TRACES_IN_STREAM = True  # Adds each step's phase timings to the server's NDJSON stream
+TRACE_EXPORT_URL = None  # OTLP/HTTP JSON endpoint to export step traces to (e.g. "http://127.0.0.1:4318/v1/traces")
+TRACE_SERVICE_NAME = "llm_agent"
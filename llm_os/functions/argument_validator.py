@@ -0,0 +1,77 @@
+from llm_os.constants import (
+    FUNCTION_PARAM_NAME_REQ_HEARTBEAT,
+    JSON_TO_PY_TYPE_MAP,
+    PY_TO_JSON_TYPE_MAP,
+)
+
+ARRAY_ELEMENT_TYPE = JSON_TO_PY_TYPE_MAP["array"].__args__[0]
+
+
+class ArgumentValidator:
+    # Compiled once per function from its JSON schema; checks unknown, missing and mistyped arguments in a single pass over the given arguments
+    def __init__(self, function_name, json_schema):
+        self.function_name = function_name
+        self.parameter_types = {
+            parameter_name: parameter["type"]
+            for parameter_name, parameter in json_schema["parameters"][
+                "properties"
+            ].items()
+        }
+        self.required_parameter_names = list(json_schema["parameters"]["required"])
+        self.required_parameter_name_set = frozenset(self.required_parameter_names)
+        self.required_arguments_str = ",".join(
+            f"'{arg_name}'" for arg_name in self.required_parameter_names
+        )
+
+    def __type_error(self, argument_name, argument_value):
+        required_param_type = self.parameter_types[argument_name]
+
+        if type(argument_value) is list:
+            if required_param_type != "array":
+                return f'Function "{self.function_name}" does not accept argument "{argument_name}" of type "array" (expected type "{required_param_type}").'
+            for elem in argument_value:
+                if type(elem) is not ARRAY_ELEMENT_TYPE:
+                    return f'Function "{self.function_name}" does not accept argument "{argument_name}" of type "array" (some or all elements are not of type {PY_TO_JSON_TYPE_MAP[ARRAY_ELEMENT_TYPE]}).'
+            return None
+
+        argument_value_type = PY_TO_JSON_TYPE_MAP.get(type(argument_value), None)
+        if required_param_type == "array":
+            return f'Function "{self.function_name}" does not accept argument "{argument_name}" of type "{argument_value_type}" (expected type "array").'
+        if argument_value_type != required_param_type:
+            return f'Function "{self.function_name}" does not accept argument "{argument_name}" of type "{argument_value_type}" (expected type "{required_param_type}").'
+        return None
+
+    def validate(self, arguments, function_call):
+        # Returns an error message for the model, or None if the arguments are valid
+        # Errors are reported in the same order of precedence as before: unknown argument, too few arguments, missing required argument, wrong type
+        unknown_argument_error = None
+        type_error = None
+        no_required_arguments_given = 0
+
+        for argument_name, argument_value in arguments.items():
+            if argument_name not in self.parameter_types:
+                unknown_argument_error = f'Function "{self.function_name}" does not accept argument "{argument_name}".'
+                break
+            if argument_name in self.required_parameter_name_set:
+                no_required_arguments_given += 1
+            if type_error is None:
+                type_error = self.__type_error(argument_name, argument_value)
+
+        if unknown_argument_error:
+            return unknown_argument_error
+
+        if len(arguments) < len(self.required_parameter_names):
+            error = f'Function "{self.function_name}" requires at least {len(self.required_parameter_names)} arguments ({len(arguments)} given, missing arguments are {list(self.required_parameter_name_set - set(arguments))}).'
+            if (
+                function_call.get(FUNCTION_PARAM_NAME_REQ_HEARTBEAT, (None, 0))
+                != (None, 0)
+                and FUNCTION_PARAM_NAME_REQ_HEARTBEAT in self.required_parameter_name_set
+            ):
+                error += f' Please move the "{FUNCTION_PARAM_NAME_REQ_HEARTBEAT}" argument into the "arguments" field.'
+            return error
+
+        if no_required_arguments_given < len(self.required_parameter_name_set):
+            given_arguments_str = ",".join(f"'{arg_name}'" for arg_name in arguments)
+            return f'Function "{self.function_name}" requires at least the arguments {self.required_arguments_str} ({given_arguments_str} given).'
+
+        return type_error
@@ -180,6 +180,46 @@ def file_memory_browse_files(self: Agent, page: Optional[int] = 0) -> Optional[s
     return results_str
 
 
+def file_memory_embedding_search_files(
+    self: Agent, query: str, page: Optional[int] = 0
+) -> Optional[str]:
+    """
+    Search all files in the folder assigned to your chat with the user you last conversed with using semantic (embedding-based) search.
+
+    Args:
+        query (str): String to search for.
+        page (Optional[int]): Allows you to page through results. Only use on a follow-up query. Defaults to 0 (first page).
+
+    Returns:
+        str: Query result string
+    """
+    if page is None or (isinstance(page, str) and page.lower().strip() == "none"):
+        page = 0
+    try:
+        page = int(page)
+    except:
+        raise ValueError(f"'page' argument must be an integer")
+    count = RETRIEVAL_QUERY_DEFAULT_PAGE_SIZE
+    results, total = self.memory.file_storage.embedding_search_files(
+        self.memory.working_context.last_2_human_ids[-1],
+        query,
+        count=count,
+        start=page * count,
+    )
+    num_pages = math.ceil(total / count) - 1  # 0 index
+    if len(results) == 0:
+        results_str = f"No results found."
+    else:
+        results_pref = (
+            f"Showing {len(results)} of {total} results (page {page}/{num_pages}):"
+        )
+        results_formatted = [
+            f"file_path_parts: {res[0]}, text: ```{res[1]}```" for res in results
+        ]
+        results_str = f"{results_pref} {json.dumps(results_formatted, ensure_ascii=JSON_ENSURE_ASCII)}"
+    return results_str
+
+
 def file_memory_read_file(
     self: Agent, file_rel_path_parts: list[str], page: Optional[int] = 0
 ) -> Optional[str]:
@@ -219,6 +259,46 @@ def file_memory_read_file(
     return results_str
 
 
+def file_memory_embedding_search_file(
+    self: Agent, file_rel_path_parts: list[str], query: str, page: Optional[int] = 0
+) -> Optional[str]:
+    """
+    Search a file in the folder assigned to your chat with the user you last conversed with using semantic (embedding-based) search.
+
+    Args:
+        file_rel_path_parts (list[str]): Relative path parts of the file with the root directory being the assigned folder.
+        query (str): String to search for.
+        page (Optional[int]): Allows you to page through results. Only use on a follow-up query. Defaults to 0 (first page).
+
+    Returns:
+        str: Query result string
+    """
+    if page is None or (isinstance(page, str) and page.lower().strip() == "none"):
+        page = 0
+    try:
+        page = int(page)
+    except:
+        raise ValueError(f"'page' argument must be an integer")
+    count = RETRIEVAL_QUERY_DEFAULT_PAGE_SIZE
+    results, total = self.memory.file_storage.embedding_search_file(
+        self.memory.working_context.last_2_human_ids[-1],
+        file_rel_path_parts,
+        query,
+        count=count,
+        start=page * count,
+    )
+    num_pages = math.ceil(total / count) - 1  # 0 index
+    if len(results) == 0:
+        results_str = f"No results found."
+    else:
+        results_pref = (
+            f"Showing {len(results)} of {total} results (page {page}/{num_pages}):"
+        )
+        results_formatted = [res[1] for res in results]
+        results_str = f"{results_pref} {json.dumps(results_formatted, ensure_ascii=JSON_ENSURE_ASCII)}"
+    return results_str
+
+
 def file_memory_revert_n_commits(self: Agent, n: Optional[int] = 1) -> Optional[str]:
     """
     Undos n edits (commits) in the folder assigned to your chat with the user you last conversed with by creating n new edits that reverse the last n edits.
@@ -15,7 +15,7 @@ def conversation_search(
     self: Agent, query: str, page: Optional[int] = 0
 ) -> Optional[str]:
     """
-    Search prior conversation history with the user you last conversed with using case-insensitive string matching.
+    Search prior conversation history with the user you last conversed with using case-insensitive keyword matching. Results contain every word in the query and are ranked by relevance.
 
     Args:
         query (str): String to search for.
@@ -59,8 +59,8 @@ def conversation_search_date(
     Search prior conversation history with the user you last conversed with using a date range.
 
     Args:
-        start_date (str): The start of the date range to search, in the format 'YYYY-MM-DD'.
-        end_date (str): The end of the date range to search, in the format 'YYYY-MM-DD'.
+        start_date (str): The start of the date range to search, in the format 'YYYY-MM-DD' or 'YYYY-MM-DDTHH:MM:SS'.
+        end_date (str): The end of the date range to search (inclusive), in the format 'YYYY-MM-DD' or 'YYYY-MM-DDTHH:MM:SS'.
         page (int): Allows you to page through results. Only use on a follow-up query. Defaults to 0 (first page).
 
     Returns:
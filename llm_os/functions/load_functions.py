@@ -2,10 +2,17 @@ import importlib
 import inspect
 import os
 import sys
+from functools import cached_property
+from threading import Lock
+from types import MappingProxyType
 
 from llm_os.constants import IN_CONTEXT_FUNCTION_SETS
+from llm_os.functions.argument_validator import ArgumentValidator
 from llm_os.functions.schema_generator import generate_schema
 
+FUNCTION_SETS_PATH = os.path.join(os.path.dirname(__file__), "function_sets")
+USER_FUNCTIONS_PATH = os.path.join(FUNCTION_SETS_PATH, "user_functions")
+
 
 class FunctionSet:
     def __init__(self, path):
@@ -17,7 +24,7 @@ class FunctionSet:
         sys.modules[self.module_name] = self.module
         spec.loader.exec_module(self.module)
 
-    @property
+    @cached_property
     def function_dict(self):
         func_dict = {}
         for func_name, func in inspect.getmembers(self.module, inspect.isfunction):
@@ -28,50 +35,49 @@ class FunctionSet:
             raise Exception(f"No functions found in {self.path}")
         return func_dict
 
-    @property
+    @cached_property
     def function_schemas_and_functions(self):
-        return {
-            func_name: {
+        function_schemas_and_functions = {}
+        for func_name, func in self.function_dict.items():
+            json_schema = generate_schema(func)
+            function_schemas_and_functions[func_name] = {
                 "python_function": func,
-                "json_schema": generate_schema(func),
+                "json_schema": json_schema,
+                "argument_validator": ArgumentValidator(func_name, json_schema),
             }
-            for func_name, func in self.function_dict.items()
-        }
-
+        return function_schemas_and_functions
 
-def load_all_function_sets():
-    # functions_path = os.path.join(
-    #    os.path.dirname(__file__), "llm_os", "functions", "function_sets"
-    # )
-
-    functions_path = os.path.join(os.path.dirname(__file__), "function_sets")
-    user_functions_path = os.path.join(functions_path, "user_functions")
 
+def load_function_sets_from_path(path):
     function_set_dict = {}
 
-    for path in [functions_path, user_functions_path]:
-        for filename in os.listdir(path):
-            filepath = os.path.join(path, filename)
-            if (
-                os.path.isfile(filepath)
-                and filename.endswith(".py")
-                and not (filename.startswith("_") or filename.startswith("."))
-            ):
-                try:
-                    function_set_dict[filename] = FunctionSet(filepath)
-                    print(f"Loaded function set {filename}")
-                except SyntaxError as e:
-                    print(
-                        f"Skipped loading function set {filename} due to a syntax error: {e}"
-                    )
-                except Exception as e:
-                    print(
-                        f"Skipped loading function set {filename} due to an error: {e}"
-                    )
+    for filename in os.listdir(path):
+        filepath = os.path.join(path, filename)
+        if (
+            os.path.isfile(filepath)
+            and filename.endswith(".py")
+            and not (filename.startswith("_") or filename.startswith("."))
+        ):
+            try:
+                function_set_dict[filename] = FunctionSet(filepath)
+                print(f"Loaded function set {filename}")
+            except SyntaxError as e:
+                print(
+                    f"Skipped loading function set {filename} due to a syntax error: {e}"
+                )
+            except Exception as e:
+                print(f"Skipped loading function set {filename} due to an error: {e}")
 
     return function_set_dict
 
 
+def load_all_function_sets():
+    return {
+        **load_function_sets_from_path(FUNCTION_SETS_PATH),
+        **load_function_sets_from_path(USER_FUNCTIONS_PATH),
+    }
+
+
 def get_function_dats_from_function_sets(function_set_dict):
     in_context_func_dict = {}
     out_of_context_func_dict = {}
@@ -91,3 +97,54 @@ def get_function_dats_from_function_sets(function_set_dict):
                 if function_set_name not in out_of_context_func_sets:
                     out_of_context_func_sets.append(function_set_name)
     return in_context_func_dict, out_of_context_func_dict, out_of_context_func_sets
+
+
+class FunctionRegistry:
+    # Loads function sets and generates their schemas once per process; user function sets are reloaded when their files change
+    def __init__(self):
+        self.lock = Lock()
+        self.builtin_function_sets = None
+        self.user_functions_signature = None
+        self.function_dats = None
+
+    @staticmethod
+    def get_user_functions_signature():
+        return tuple(
+            sorted(
+                (entry.name, entry.stat().st_mtime_ns)
+                for entry in os.scandir(USER_FUNCTIONS_PATH)
+                if entry.is_file() and entry.name.endswith(".py")
+            )
+        )
+
+    def get_function_dats(self):
+        # Returns: in_context_function_dats, out_of_context_function_dats, out_of_context_function_sets (all read-only)
+        with self.lock:
+            if self.builtin_function_sets is None:
+                self.builtin_function_sets = load_function_sets_from_path(
+                    FUNCTION_SETS_PATH
+                )
+
+            user_functions_signature = FunctionRegistry.get_user_functions_signature()
+            if user_functions_signature != self.user_functions_signature:
+                (
+                    in_context_function_dats,
+                    out_of_context_function_dats,
+                    out_of_context_function_sets,
+                ) = get_function_dats_from_function_sets(
+                    {
+                        **self.builtin_function_sets,
+                        **load_function_sets_from_path(USER_FUNCTIONS_PATH),
+                    }
+                )
+                self.function_dats = (
+                    MappingProxyType(in_context_function_dats),
+                    MappingProxyType(out_of_context_function_dats),
+                    tuple(out_of_context_function_sets),
+                )
+                self.user_functions_signature = user_functions_signature
+
+            return self.function_dats
+
+
+FUNCTION_REGISTRY = FunctionRegistry()
@@ -32,6 +32,18 @@ class CLIInterface:
     def assistant_message(msg: str, end="\n"):
         print(emojize(f":robot: {msg}"), end=end, flush=True)
 
+    @staticmethod
+    def partial_assistant_message(msg: str, is_start: bool):
+        pass  # The whole message is printed by assistant_message once the step completes
+
+    @staticmethod
+    def end_partial_assistant_message():
+        pass
+
+    @staticmethod
+    def retract_partial_assistant_message():
+        pass
+
     @staticmethod
     def memory_message(msg: str, end="\n"):
         print(emojize(f":brain: {msg}"), end=end, flush=True)
@@ -78,6 +90,11 @@ class ServerInterface:
     def __init__(self):
         self.server_message_stack = []
 
+        # Partial messages bypass the stack and are sent to the client as soon as they are generated
+        # streamed_assistant_message stays None until a non-empty partial message has been sent
+        self.partial_message_callback = None
+        self.streamed_assistant_message = None
+
     def warning_message(self, msg: str, end="\n"):
         self.server_message_stack.append(
             {"type": "warning_message", "arguments": {"msg": msg, "end": end}}
@@ -105,9 +122,49 @@ class ServerInterface:
             {"type": "internal_monologue", "arguments": {"msg": msg, "end": end}}
         )
 
+    def partial_assistant_message(self, msg: str, is_start: bool):
+        if not self.partial_message_callback:
+            return
+        if is_start or self.streamed_assistant_message is None:
+            self.streamed_assistant_message = ""
+        self.streamed_assistant_message += msg
+
+        self.partial_message_callback(
+            {
+                "type": "partial_assistant_message",
+                "arguments": {"msg": msg, "is_start": is_start},
+            }
+        )
+
+    def end_partial_assistant_message(self):
+        if not self.partial_message_callback:
+            return
+
+        self.partial_message_callback(
+            {"type": "end_partial_assistant_message", "arguments": {}}
+        )
+
+    def retract_partial_assistant_message(self):
+        # Called at the end of every step; if streamed text was not followed by the assistant_message it belonged to (the send_message call was rejected), the client is told to discard it
+        if self.streamed_assistant_message is None:
+            return
+        self.streamed_assistant_message = None
+        if not self.partial_message_callback:
+            return
+
+        self.partial_message_callback(
+            {"type": "retract_partial_assistant_message", "arguments": {}}
+        )
+
     def assistant_message(self, msg: str, end="\n"):
+        was_streamed = msg == self.streamed_assistant_message
+        self.streamed_assistant_message = None
+
         self.server_message_stack.append(
-            {"type": "assistant_message", "arguments": {"msg": msg, "end": end}}
+            {
+                "type": "assistant_message",
+                "arguments": {"msg": msg, "end": end, "was_streamed": was_streamed},
+            }
         )
 
     def memory_message(self, msg: str, end="\n"):
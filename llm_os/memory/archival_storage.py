@@ -3,10 +3,10 @@ from datetime import datetime
 from os import path
 
 import chromadb
-from chromadb.utils.embedding_functions import OllamaEmbeddingFunction
 from host import HOST_URL
-from llm_os.tokenisers import NOMIC_EMBED_TEXT_TOKENIZER
-from semantic_text_splitter import TextSplitter
+from llm_os.constants import PERSISTENT_STORAGE_PATH
+from llm_os.memory.embedding_batcher import BatchedOllamaEmbeddingFunction
+from llm_os.tokenisers import get_nomic_embed_text_tokeniser, get_splitter
 
 
 class ArchivalStorage:
@@ -14,13 +14,11 @@ class ArchivalStorage:
         self.top_k = top_k
 
         self.client = chromadb.PersistentClient(
-            path=path.join(
-                path.dirname(path.dirname(path.dirname(__file__))),
-                "persistent_storage",
-                conv_name,
-            )
+            path=path.join(PERSISTENT_STORAGE_PATH, conv_name)
+        )
+        self.ef = BatchedOllamaEmbeddingFunction(
+            url=HOST_URL, model_name="nomic-embed-text"
         )
-        self.ef = OllamaEmbeddingFunction(url=HOST_URL, model_name="nomic-embed-text")
         self.collection = self.client.get_or_create_collection(
             name="archival_storage", embedding_function=self.ef
         )
@@ -28,12 +26,16 @@ class ArchivalStorage:
     def __len__(self):
         return self.collection.count()
 
+    def close(self):
+        # Chroma has no public close, so drop the references and let the client be garbage collected
+        self.collection = None
+        self.client = None
+
     def insert(self, user_id: int, content: str, return_ids: bool = False):
         try:
-            splitter = TextSplitter.from_huggingface_tokenizer(
-                NOMIC_EMBED_TEXT_TOKENIZER, 8192
-            )
-            chunk_list = splitter.chunks(content)
+            splitter = get_splitter(get_nomic_embed_text_tokeniser(), 8192)
+            # Identical chunks would share an id
+            chunk_list = list(dict.fromkeys(splitter.chunks(content)))
 
             hex_stringify = lambda chunk: hashlib.md5(chunk.encode("UTF-8")).hexdigest()
             ids = [hex_stringify(chunk) for chunk in chunk_list]
@@ -58,10 +60,13 @@ class ArchivalStorage:
     def search(self, query: str, user_id: int, count: str, start: str):
         try:
             query_res = self.collection.query(
-                query_texts=[query], n_results=self.top_k, where={"user_id": user_id}
+                query_embeddings=self.ef.embed_queries([query]),
+                n_results=self.top_k,
+                where={"user_id": user_id},
             )
-            documents = query_res["documents"]
-            metadatas = query_res["metadatas"]
+            # Chroma returns one list of results per query text
+            documents = query_res["documents"][0]
+            metadatas = query_res["metadatas"][0]
 
             start = int(start) if start else 0
             count = int(count) if count else self.top_k
@@ -0,0 +1,156 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock, Timer
+
+import numpy as np
+from chromadb.utils.embedding_functions import OllamaEmbeddingFunction
+from host import HOST
+
+from llm_os.constants import (
+    EMBEDDING_BATCH_MAX_DELAY_SECONDS,
+    EMBEDDING_BATCH_SIZE,
+    MAX_CONCURRENT_EMBEDDING_REQUESTS,
+    USE_EMBEDDING_CACHE,
+)
+from llm_os.memory.embedding_cache import EmbeddingCache
+
+
+class EmbeddingBatcher:
+    # Process-wide batching of texts to be embedded by one model.
+    # Texts from every caller are coalesced into /api/embed requests of at most max_batch_size texts, and a batch that is not full is sent max_batch_delay seconds after its first text arrived.
+    # Identical texts that are waiting or already being embedded share a single embedding, and up to max_concurrent_requests batches are sent at once
+    # Texts found in the embedding cache are never sent
+    def __init__(
+        self,
+        model_name,
+        max_batch_size=EMBEDDING_BATCH_SIZE,
+        max_batch_delay=EMBEDDING_BATCH_MAX_DELAY_SECONDS,
+        max_concurrent_requests=MAX_CONCURRENT_EMBEDDING_REQUESTS,
+        use_cache=USE_EMBEDDING_CACHE,
+    ):
+        self.model_name = model_name
+        self.cache = EmbeddingCache(model_name) if use_cache else None
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent_requests)
+
+        self.lock = Lock()
+        self.pending = {}  # text -> future, not sent yet
+        self.in_flight = {}  # text -> future, being embedded
+        self.texts_to_cache = set()  # Pending or in flight texts whose embeddings are to be cached
+        self.flush_timer = None
+        self.no_requests = 0
+        self.no_embedded_texts = 0
+
+    def embed(self, texts, cache_results=True):
+        # Blocks until every text is embedded; embeddings are returned in the order of texts
+        # cache_results=False still reads from the cache but does not add to it (for one-off texts such as search queries)
+        cached_embeddings = self.cache.get_many(texts) if self.cache is not None else {}
+
+        futures = []
+        with self.lock:
+            for text in texts:
+                if text in cached_embeddings:
+                    futures.append(None)
+                    continue
+                if cache_results:
+                    self.texts_to_cache.add(text)
+                future = self.pending.get(text) or self.in_flight.get(text)
+                if future is None:
+                    future = Future()
+                    self.pending[text] = future
+                    if len(self.pending) >= self.max_batch_size:
+                        self.__flush()
+                futures.append(future)
+
+            if self.pending and self.flush_timer is None:
+                self.flush_timer = Timer(self.max_batch_delay, self.__flush_after_delay)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+        return [
+            cached_embeddings[text] if future is None else future.result()
+            for text, future in zip(texts, futures)
+        ]
+
+    def __flush_after_delay(self):
+        with self.lock:
+            self.flush_timer = None
+            if self.pending:
+                self.__flush()
+
+    def __flush(self):
+        # Must be called with the lock held
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+        batch = self.pending
+        self.pending = {}
+        self.in_flight.update(batch)
+        self.executor.submit(self.__embed_batch, batch)
+
+    def __embed_batch(self, batch):
+        texts = list(batch.keys())
+        try:
+            embeddings = HOST.embed(model=self.model_name, input=texts)["embeddings"]
+            if len(embeddings) != len(texts):
+                raise RuntimeError(
+                    f"Expected {len(texts)} embeddings from Ollama, got {len(embeddings)}"
+                )
+        except Exception as e:
+            print("Embedding error", e)
+            for future in batch.values():
+                future.set_exception(e)
+        else:
+            if self.cache is not None:
+                with self.lock:
+                    texts_to_cache = [
+                        (text, embedding)
+                        for text, embedding in zip(texts, embeddings)
+                        if text in self.texts_to_cache
+                    ]
+                if texts_to_cache:
+                    try:
+                        self.cache.put_many(*zip(*texts_to_cache))
+                    except Exception as e:
+                        print("Embedding cache error", e)
+            for text, embedding in zip(texts, embeddings):
+                batch[text].set_result(embedding)
+        finally:
+            with self.lock:
+                self.no_requests += 1
+                self.no_embedded_texts += len(texts)
+                for text, future in batch.items():
+                    if self.in_flight.get(text) is future:
+                        del self.in_flight[text]
+                        self.texts_to_cache.discard(text)
+
+
+embedding_batchers = {}
+embedding_batchers_lock = Lock()
+
+
+def get_embedding_batcher(model_name):
+    with embedding_batchers_lock:
+        if model_name not in embedding_batchers:
+            embedding_batchers[model_name] = EmbeddingBatcher(model_name)
+        return embedding_batchers[model_name]
+
+
+class BatchedOllamaEmbeddingFunction(OllamaEmbeddingFunction):
+    # Drop-in replacement for Chroma's Ollama embedding function (so collections keep the same stored configuration) that embeds through the shared batcher instead of one request per call
+    def __call__(self, input):
+        return [
+            np.array(embedding, dtype=np.float32)
+            for embedding in get_embedding_batcher(self.model_name).embed(list(input))
+        ]
+
+    def embed_queries(self, queries):
+        # Chroma embeds query_texts through __call__, which would cache them, so searches embed their queries here and pass query_embeddings instead
+        # Queries are rarely repeated, so they are not added to the embedding cache
+        return [
+            np.array(embedding, dtype=np.float32)
+            for embedding in get_embedding_batcher(self.model_name).embed(
+                list(queries), cache_results=False
+            )
+        ]
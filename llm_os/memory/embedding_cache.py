@@ -0,0 +1,122 @@
+import hashlib
+import json
+import re
+from os import makedirs, path
+from threading import Lock
+
+import numpy as np
+
+from llm_os.constants import PERSISTENT_STORAGE_PATH
+
+KEY_SIZE = hashlib.sha256().digest_size
+
+
+class EmbeddingCache:
+    # On-disk cache of embeddings keyed by (model, sha256 of the text), shared by every conversation and collection.
+    # Embeddings are the rows of a float32 matrix (embeddings.f32, memory-mapped for reads) and keys.bin holds the sha256 digest of each row's text in the same order.
+    # Both files are only ever appended to, the matrix first, so a crash at worst leaves a row without a key, which is dropped on the next load (the cache is not meant to be written by more than one process at a time)
+    def __init__(self, model_name):
+        self.cache_path = path.join(
+            PERSISTENT_STORAGE_PATH,
+            ".embedding_cache",
+            re.sub(r"[^a-zA-Z0-9_-]", "-", model_name),
+        )
+        makedirs(self.cache_path, exist_ok=True)
+        self.embeddings_path = path.join(self.cache_path, "embeddings.f32")
+        self.keys_path = path.join(self.cache_path, "keys.bin")
+        self.meta_path = path.join(self.cache_path, "meta.json")
+
+        self.lock = Lock()
+        self.rows = {}  # sha256 digest -> row
+        self.dimensions = None
+        self.matrix = None  # Memory map of the first no_mapped_rows rows
+        self.no_mapped_rows = 0
+        self.no_hits = 0
+        self.no_misses = 0
+        self.__load()
+
+    def __len__(self):
+        return len(self.rows)
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha256(text.encode("UTF-8")).digest()
+
+    def __load(self):
+        if not path.exists(self.meta_path):
+            return
+        with open(self.meta_path, "r") as f:
+            self.dimensions = json.loads(f.read())["dimensions"]
+        if not path.exists(self.keys_path) or not path.exists(self.embeddings_path):
+            return
+
+        with open(self.keys_path, "rb") as f:
+            keys = f.read()
+        no_rows = min(
+            len(keys) // KEY_SIZE,
+            path.getsize(self.embeddings_path) // (4 * self.dimensions),
+        )
+
+        # Drops anything past the last complete row so that later appends stay aligned
+        with open(self.keys_path, "r+b") as f:
+            f.truncate(no_rows * KEY_SIZE)
+        with open(self.embeddings_path, "r+b") as f:
+            f.truncate(no_rows * 4 * self.dimensions)
+
+        for row in range(no_rows):
+            self.rows[keys[row * KEY_SIZE : (row + 1) * KEY_SIZE]] = row
+
+    def get_many(self, texts):
+        # Returns {text: embedding} for the texts that are cached
+        keys = {text: EmbeddingCache.key(text) for text in texts}
+        with self.lock:
+            hits = {
+                text: self.rows[key] for text, key in keys.items() if key in self.rows
+            }
+            self.no_hits += len(hits)
+            self.no_misses += len(keys) - len(hits)
+            if not hits:
+                return {}
+
+            if max(hits.values()) >= self.no_mapped_rows:
+                self.no_mapped_rows = len(self.rows)
+                self.matrix = np.memmap(
+                    self.embeddings_path,
+                    dtype=np.float32,
+                    mode="r",
+                    shape=(self.no_mapped_rows, self.dimensions),
+                )
+            return {text: np.array(self.matrix[row]) for text, row in hits.items()}
+
+    def put_many(self, texts, embeddings):
+        with self.lock:
+            new_keys = []
+            new_key_set = set()
+            new_embeddings = []
+            for text, embedding in zip(texts, embeddings):
+                key = EmbeddingCache.key(text)
+                if key not in self.rows and key not in new_key_set:
+                    new_keys.append(key)
+                    new_key_set.add(key)
+                    new_embeddings.append(embedding)
+            if not new_keys:
+                return
+
+            matrix = np.asarray(new_embeddings, dtype=np.float32)
+            if self.dimensions is None:
+                self.dimensions = matrix.shape[1]
+                with open(self.meta_path, "w") as f:
+                    f.write(json.dumps({"dimensions": self.dimensions}))
+            elif matrix.shape[1] != self.dimensions:
+                print(
+                    f"Embedding cache error: expected {self.dimensions} dimensions, got {matrix.shape[1]}"
+                )
+                return
+
+            with open(self.embeddings_path, "ab") as f:
+                f.write(matrix.tobytes())
+            with open(self.keys_path, "ab") as f:
+                f.write(b"".join(new_keys))
+
+            for key in new_keys:
+                self.rows[key] = len(self.rows)
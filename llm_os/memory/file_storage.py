@@ -1,4 +1,4 @@
-from os import path, mkdir, remove
+from os import listdir, path, mkdir, remove
 from datetime import datetime
 from shutil import rmtree
 import json
@@ -6,14 +6,18 @@ import pathlib
 import hashlib
 
 import chromadb
-from chromadb.utils.embedding_functions import OllamaEmbeddingFunction
-from semantic_text_splitter import MarkdownSplitter
 from git import Repo
 
 from llm_os.constants import (
     BLACKLISTED_FOLDERS_OR_FILES,
+    PERSISTENT_STORAGE_PATH,
+)
+from llm_os.memory.embedding_batcher import BatchedOllamaEmbeddingFunction
+from llm_os.tokenisers import (
+    get_qwen_2_5_tokeniser,
+    get_nomic_embed_text_tokeniser,
+    get_splitter,
 )
-from llm_os.tokenisers import QWEN_2_5_TOKENIZER, NOMIC_EMBED_TEXT_TOKENIZER
 from llm_os.prompts.spr.spr import spr_compress
 
 from host import HOST_URL, HOST
@@ -24,41 +28,43 @@ class FileStorage:
         self.top_k = top_k
         self.agent_tokeniser = tokeniser._tokenizer
 
-        self.folder_path = path.join(
-            path.dirname(path.dirname(path.dirname(__file__))),
-            "persistent_storage",
-            conv_name,
-            "files",
-        )
+        self.folder_path = path.join(PERSISTENT_STORAGE_PATH, conv_name, "files")
         if not path.exists(self.folder_path):
             mkdir(self.folder_path)
 
         self.client = chromadb.PersistentClient(
             path=path.join(
-                path.dirname(path.dirname(path.dirname(__file__))),
-                "persistent_storage",
-                conv_name,
-                "file_storage_embeddings",
+                PERSISTENT_STORAGE_PATH, conv_name, "file_storage_embeddings"
             )
         )
-        self.ef = OllamaEmbeddingFunction(
+        self.ef = BatchedOllamaEmbeddingFunction(
             model_name="nomic-embed-text",
             url=f"{HOST_URL}/api/embed",
         )
         self.collection = self.client.get_or_create_collection(
             name="file_storage_embeddings", embedding_function=self.ef
         )
+        self.embedding_index_synced_user_ids = set()
 
     def __len__(self):
         return sum(
             map(
                 lambda id: len(self.get_file_rel_paths(id)),
-                self.get_all_user_ids_with_folders,
+                self.get_all_user_ids_with_folders(),
             )
         )
 
+    def close(self):
+        # Chroma has no public close, so drop the references and let the client be garbage collected
+        self.collection = None
+        self.client = None
+
     def get_all_user_ids_with_folders(self):
-        return [f for f in os.listdir(self.folder_path) if path.isdir(f)]
+        return [
+            f
+            for f in listdir(self.folder_path)
+            if path.isdir(path.join(self.folder_path, f))
+        ]
 
     def __write_file_summaries(
         self, user_id, hashes, file_rel_path_parts=None, edit_mode=None
@@ -101,9 +107,7 @@ class FileStorage:
             and summaries[file_rel_path_parts_tuple]["file_hash"] == file_hash
         ):
             summaries[file_rel_path_parts_tuple] = {"file_hash": file_hash}
-            splitter = MarkdownSplitter.from_huggingface_tokenizer(
-                QWEN_2_5_TOKENIZER, 8192
-            )
+            splitter = get_splitter(get_qwen_2_5_tokeniser(), 8192, "markdown")
             summary = ""
 
             with open(file_path, "r") as f:
@@ -155,7 +159,7 @@ class FileStorage:
         return [
             str(item.relative_to(repo_pathlib_dir))
             for item in repo_pathlib_dir.rglob("*")
-            if item.is_file() and item.parts.isdisjoint(BLACKLISTED_FOLDERS_OR_FILES)
+            if item.is_file() and BLACKLISTED_FOLDERS_OR_FILES.isdisjoint(item.parts)
         ]
 
     def get_file_paths(self, user_id):
@@ -164,7 +168,7 @@ class FileStorage:
         return [
             str(item)
             for item in repo_pathlib_dir.rglob("*")
-            if item.is_file() and item.parts.isdisjoint(BLACKLISTED_FOLDERS_OR_FILES)
+            if item.is_file() and BLACKLISTED_FOLDERS_OR_FILES.isdisjoint(item.parts)
         ]
 
     def get_file_rel_paths_parts(self, user_id):
@@ -173,7 +177,7 @@ class FileStorage:
         return [
             item.relative_to(repo_pathlib_dir).parts
             for item in repo_pathlib_dir.rglob("*")
-            if item.is_file() and item.parts.isdisjoint(BLACKLISTED_FOLDERS_OR_FILES)
+            if item.is_file() and BLACKLISTED_FOLDERS_OR_FILES.isdisjoint(item.parts)
         ]
 
     # * File Memory creation functions
@@ -204,6 +208,7 @@ class FileStorage:
         self.__write_file_summaries(
             user_id, summaries, new_file_rel_path_parts, "Created"
         )
+        self.index_file(user_id, new_file_rel_path_parts)
 
     def make_folder(self, user_id, folder_rel_path_parts):
         repo_path = self.__get_repo_path_from_user_id(user_id)
@@ -231,6 +236,7 @@ class FileStorage:
         del summaries[file_rel_path_parts_tuple]
 
         self.__write_file_summaries(user_id, summaries, file_rel_path_parts, "Removed")
+        self.unindex_file(user_id, file_rel_path_parts)
 
     def remove_folder(self, user_id, folder_rel_path_parts):
         repo_path = self.__get_repo_path_from_user_id(user_id)
@@ -253,6 +259,7 @@ class FileStorage:
         self.__write_file_summaries(
             user_id, summaries, folder_rel_path_parts, "Removed"
         )
+        self.unindex_folder(user_id, folder_rel_path_parts)
 
     # * File Memory edit functions
     def append_to_file(self, user_id, file_rel_path_parts, text):
@@ -265,6 +272,7 @@ class FileStorage:
             f.write(text)
 
         self.get_file_summary(user_id, file_rel_path_parts, "Modified")
+        self.index_file(user_id, file_rel_path_parts)
 
     def replace_first_in_file(self, user_id, file_rel_path_parts, old_text, new_text):
         repo_path = self.__get_repo_path_from_user_id(user_id)
@@ -277,6 +285,7 @@ class FileStorage:
             f.write(file_contents)
 
         self.get_file_summary(user_id, file_rel_path_parts, "Modified")
+        self.index_file(user_id, file_rel_path_parts)
 
     def replace_all_in_file(self, user_id, file_rel_path_parts, old_text, new_text):
         repo_path = self.__get_repo_path_from_user_id(user_id)
@@ -289,39 +298,141 @@ class FileStorage:
             f.write(file_contents)
 
         self.get_file_summary(user_id, file_rel_path_parts, "Modified")
+        self.index_file(user_id, file_rel_path_parts)
 
     # * File Memory embedding functions
-    def initialise_embedding_collection(self):
-        client = chromadb.EphemeralClient()
-        ef = OllamaEmbeddingFunction(
-            model_name="nomic-embed-text",
-            url=f"{HOST_URL}/api/embed",
-        )
-        collection = client.get_or_create_collection(
-            name="file_memory_embeddings", embedding_function=ef
-        )
-        return collection
+    # Every user's files are indexed in the persistent file_storage_embeddings collection, one entry per chunk tagged with the file's hash.
+    # The index is updated file by file as files are edited, so searches only embed the query
+    @staticmethod
+    def __file_path_key(file_rel_path_parts):
+        return "/".join(file_rel_path_parts)
+
+    @staticmethod
+    def __file_where(user_id, file_rel_path_parts):
+        return {
+            "$and": [
+                {"user_id": str(user_id)},
+                {"file_path": FileStorage.__file_path_key(file_rel_path_parts)},
+            ]
+        }
 
-    def populate_embedding_collection(self, user_id, collection):
-        splitter = MarkdownSplitter.from_huggingface_tokenizer(
-            NOMIC_EMBED_TEXT_TOKENIZER, 128
-        )
+    def __get_indexed_file_hashes(self, user_id):
+        # file path -> file hash of every file indexed for the user
+        metadatas = self.collection.get(
+            where={"user_id": str(user_id)}, include=["metadatas"]
+        )["metadatas"]
+        return {metadata["file_path"]: metadata["file_hash"] for metadata in metadatas}
+
+    def __index_files(self, user_id, file_rel_path_parts_list):
+        # (Re-)indexes the given files in a single add; chunks that were embedded before come from the embedding cache
+        repo_path = self.__get_repo_path_from_user_id(user_id)
+        splitter = get_splitter(get_nomic_embed_text_tokeniser(), 128, "markdown")
+
+        documents = []
+        metadatas = []
+        ids = []
+        for file_rel_path_parts in file_rel_path_parts_list:
+            file_path = path.join(repo_path, *file_rel_path_parts)
+            file_path_key = FileStorage.__file_path_key(file_rel_path_parts)
+            file_hash = self.__compute_file_hash(file_path)
 
-        for file_path, file_rel_path_parts in zip(
-            self.get_file_paths(user_id), self.get_file_rel_paths_parts(user_id)
-        ):
             with open(file_path, "r") as f:
-                chunk_list = splitter.chunks(f.read())
+                chunks = splitter.chunks(f.read())
 
-            hex_stringify = lambda chunk: hashlib.md5(chunk.encode("UTF-8")).hexdigest()
-            ids = [hex_stringify(chunk) for chunk in chunk_list]
-            metadatas = [
-                {"file_rel_path_parts": file_rel_path_parts}
-                for _ in range(len(chunk_list))
-            ]
-            collection.add(documents=chunk_list, metadatas=metadatas, ids=ids)
+            self.collection.delete(
+                where=FileStorage.__file_where(user_id, file_rel_path_parts)
+            )
+            for chunk_no, chunk in enumerate(chunks):
+                documents.append(chunk)
+                metadatas.append(
+                    {
+                        "user_id": str(user_id),
+                        "file_path": file_path_key,
+                        "file_hash": file_hash,
+                        "chunk_no": chunk_no,
+                    }
+                )
+                ids.append(
+                    hashlib.md5(
+                        f"{user_id}\n{file_path_key}\n{chunk_no}".encode("UTF-8")
+                    ).hexdigest()
+                )
+
+        if ids:
+            self.collection.add(documents=documents, metadatas=metadatas, ids=ids)
+
+    def index_file(self, user_id, file_rel_path_parts):
+        self.__index_files(user_id, [file_rel_path_parts])
+
+    def unindex_file(self, user_id, file_rel_path_parts):
+        self.collection.delete(
+            where=FileStorage.__file_where(user_id, file_rel_path_parts)
+        )
+
+    def unindex_folder(self, user_id, folder_rel_path_parts):
+        folder_path_prefix = FileStorage.__file_path_key(folder_rel_path_parts) + "/"
+        for file_path_key in self.__get_indexed_file_hashes(user_id):
+            if file_path_key.startswith(folder_path_prefix):
+                self.unindex_file(user_id, file_path_key.split("/"))
+
+    def sync_embedding_index(self, user_id):
+        # Reconciles the index with every file of the user (after edits made outside of the edit functions, such as reverts and resets); only files whose hash changed are re-indexed
+        repo_path = self.__get_repo_path_from_user_id(user_id)
+        indexed_file_hashes = self.__get_indexed_file_hashes(user_id)
+
+        file_rel_path_parts_list = self.get_file_rel_paths_parts(user_id)
+        file_path_keys = set()
+        changed_file_rel_path_parts_list = []
+        for file_rel_path_parts in file_rel_path_parts_list:
+            file_path_key = FileStorage.__file_path_key(file_rel_path_parts)
+            file_path_keys.add(file_path_key)
+            file_path = path.join(repo_path, *file_rel_path_parts)
+            if indexed_file_hashes.get(file_path_key) == self.__compute_file_hash(
+                file_path
+            ):
+                continue
+            if file_path_key not in indexed_file_hashes:
+                # Blank files have no chunks and so are never indexed; they are not changed files
+                with open(file_path, "r") as f:
+                    if not f.read().strip():
+                        continue
+            changed_file_rel_path_parts_list.append(file_rel_path_parts)
+
+        for file_path_key in indexed_file_hashes:
+            if file_path_key not in file_path_keys:
+                self.unindex_file(user_id, file_path_key.split("/"))
+
+        self.__index_files(user_id, changed_file_rel_path_parts_list)
+        self.embedding_index_synced_user_ids.add(user_id)
+
+    def __ensure_embedding_index(self, user_id):
+        # Files from before the index existed are indexed on the first search (a user with only blank files still has no entries afterwards, so it is only tried once)
+        if user_id in self.embedding_index_synced_user_ids:
+            return
+        if not self.collection.get(
+            where={"user_id": str(user_id)}, limit=1, include=[]
+        )["ids"]:
+            self.sync_embedding_index(user_id)
+
+    def __embedding_search(self, user_id, query, where, count, start):
+        self.__ensure_embedding_index(user_id)
+        query_res = self.collection.query(
+            query_embeddings=self.ef.embed_queries([query]),
+            n_results=self.top_k,
+            where=where,
+            include=["documents", "metadatas"],
+        )
+        documents = query_res["documents"][0]
+        metadatas = query_res["metadatas"][0]
 
-        return collection
+        start = int(start if start else 0)
+        count = int(count if count else len(documents))
+        end = min(count + start, len(documents))
+
+        return [
+            (metadata["file_path"].split("/"), document)
+            for metadata, document in zip(metadatas[start:end], documents[start:end])
+        ], len(documents)
 
     # * File Memory repository search functions
     def browse_files(self, user_id, count, start):
@@ -341,11 +452,11 @@ class FileStorage:
             )
         ), len(results)
 
-    # def embedding_search_files(self, user_id, query, count, start):
-    #     collection = self.populate_embedding_collection(
-    #         user_id, self.initialise_embedding_collection()
-    #     )
-    #
+    def embedding_search_files(self, user_id, query, count, start):
+        return self.__embedding_search(
+            user_id, query, {"user_id": str(user_id)}, count, start
+        )
+
     # def string_search_files(self, user_id, string, count, start):
     #     pass
 
@@ -353,9 +464,7 @@ class FileStorage:
     def read_file(self, user_id, file_rel_path_parts, count, start):
         repo_path = self.__get_repo_path_from_user_id(user_id)
 
-        splitter = MarkdownSplitter.from_huggingface_tokenizer(
-            self.agent_tokeniser, 128
-        )
+        splitter = get_splitter(self.agent_tokeniser, 128, "markdown")
 
         with open(path.join(repo_path, *file_rel_path_parts), "r"):
             results = splitter.chunks(f.read())
@@ -366,11 +475,15 @@ class FileStorage:
 
         return results[start:end], len(results)
 
-    # def embedding_search_file(self, user_id, query, count, start):
-    #     collection = self.populate_embedding_collection(
-    #         user_id, self.initialise_embedding_collection()
-    #     )
-    #
+    def embedding_search_file(self, user_id, file_rel_path_parts, query, count, start):
+        return self.__embedding_search(
+            user_id,
+            query,
+            FileStorage.__file_where(user_id, file_rel_path_parts),
+            count,
+            start,
+        )
+
     # def string_search_file(self, user_id, string, count, start):
     #     pass
 
@@ -381,12 +494,14 @@ class FileStorage:
 
         for commit in repo.iter_commits(f"HEAD~{n}..HEAD"):
             repo.git.revert(commit, no_edit=True)
+        self.sync_embedding_index(user_id)
 
     def reset_n_commits(self, user_id, n):  # Resets to HEAD~n
         repo_path = self.__get_repo_path_from_user_id(user_id)
         repo = self.__load_repo(repo_path)
 
         repo.git.reset("--hard", f"HEAD~{n}")
+        self.sync_embedding_index(user_id)
 
     def get_diff(self, user_id, n):  # Returns diff between HEAD and HEAD~n
         repo_path = self.__get_repo_path_from_user_id(user_id)
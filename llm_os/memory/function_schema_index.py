@@ -0,0 +1,132 @@
+import hashlib
+import re
+from os import path
+from threading import Lock
+
+import chromadb
+from host import HOST_URL
+
+from llm_os.constants import PERSISTENT_STORAGE_PATH
+from llm_os.memory.embedding_batcher import BatchedOllamaEmbeddingFunction
+from llm_os.tokenisers import get_nomic_embed_text_tokeniser, split_texts
+
+
+class FunctionSchemaIndex:
+    # Process-wide, on-disk index of out-of-context function descriptions shared by every conversation
+    def __init__(self, embedding_model_name):
+        self.embedding_model_name = embedding_model_name
+        self.index_path = path.join(
+            PERSISTENT_STORAGE_PATH, ".function_schema_embeddings"
+        )
+
+        self.lock = Lock()
+        self.ef = None
+        self.collection = None
+        self.indexed_ids = set()
+        # Hashes of (function name, description) already indexed in this process
+        self.indexed_description_ids = set()
+
+    def get_collection(self):
+        with self.lock:
+            if self.collection is None:
+                client = chromadb.PersistentClient(path=self.index_path)
+                self.ef = BatchedOllamaEmbeddingFunction(
+                    model_name=self.embedding_model_name,
+                    url=f"{HOST_URL}/api/embed",
+                )
+                # One collection per embedding model, since embedding dimensions differ between models
+                collection_name = "out_of_context_functions--" + re.sub(
+                    r"[^a-zA-Z0-9_-]", "-", self.embedding_model_name
+                )
+                self.collection = client.get_or_create_collection(
+                    name=collection_name, embedding_function=self.ef
+                )
+            return self.collection
+
+    @staticmethod
+    def get_description_id(function_name, description):
+        return hashlib.md5(
+            f"{function_name}\n{description}".encode("UTF-8")
+        ).hexdigest()
+
+    def populate(self, function_dats):
+        # Descriptions indexed earlier in this process are skipped before being split, since populate runs for every agent
+        description_ids = {
+            function_name: FunctionSchemaIndex.get_description_id(
+                function_name, function_dat["json_schema"]["description"]
+            )
+            for function_name, function_dat in function_dats.items()
+        }
+        function_names = [
+            function_name
+            for function_name, description_id in description_ids.items()
+            if description_id not in self.indexed_description_ids
+        ]
+        if not function_names:
+            return
+
+        collection = self.get_collection()
+        chunk_lists = split_texts(
+            get_nomic_embed_text_tokeniser(),
+            8192,
+            [
+                function_dats[function_name]["json_schema"]["description"]
+                for function_name in function_names
+            ],
+        )
+
+        documents = []
+        metadatas = []
+        ids = []
+        for function_name, chunk_list in zip(function_names, chunk_lists):
+            for chunk in chunk_list:
+                chunk_id = hashlib.md5(
+                    f"{function_name}\n{chunk}".encode("UTF-8")
+                ).hexdigest()
+                if chunk_id in self.indexed_ids or chunk_id in ids:
+                    continue
+                documents.append(chunk)
+                metadatas.append({"function_name": function_name})
+                ids.append(chunk_id)
+
+        if ids:
+            self.__add_new_chunks(collection, documents, metadatas, ids)
+
+        self.indexed_description_ids.update(
+            description_ids[function_name] for function_name in function_names
+        )
+
+    def __add_new_chunks(self, collection, documents, metadatas, ids):
+        # Descriptions embedded by an earlier process are already on disk and are not embedded again
+        existing_ids = set(collection.get(ids=ids, include=[])["ids"])
+        new_entries = [
+            (document, metadata, chunk_id)
+            for document, metadata, chunk_id in zip(documents, metadatas, ids)
+            if chunk_id not in existing_ids
+        ]
+        if new_entries:
+            new_documents, new_metadatas, new_ids = map(list, zip(*new_entries))
+            collection.add(
+                documents=new_documents, metadatas=new_metadatas, ids=new_ids
+            )
+
+        self.indexed_ids.update(ids)
+
+    def search(self, query, function_names, n_results):
+        if not function_names:
+            return []
+
+        collection = self.get_collection()
+        query_res = collection.query(
+            query_embeddings=self.ef.embed_queries([query]),
+            n_results=n_results,
+            where={"function_name": {"$in": list(function_names)}},
+        )
+        return list(
+            dict.fromkeys(
+                [metadata["function_name"] for metadata in query_res["metadatas"][0]]
+            )
+        )
+
+
+FUNCTION_SCHEMA_INDEX = FunctionSchemaIndex("nomic-embed-text")
@@ -1,23 +1,15 @@
-import hashlib
-import json
 from collections import deque
 from dataclasses import dataclass
-from os import path
-from pathlib import Path
-
-import chromadb
-from chromadb.utils.embedding_functions import OllamaEmbeddingFunction
-from host import HOST_URL
-from semantic_text_splitter import TextSplitter
 
+from llm_os.constants import STABLE_PROMPT_PREFIX
 from llm_os.memory.archival_storage import ArchivalStorage
 from llm_os.memory.file_storage import FileStorage
+from llm_os.memory.function_schema_index import FUNCTION_SCHEMA_INDEX
 from llm_os.memory.recall_storage import RecallStorage
+from llm_os.memory.state_store import StateStore
+from llm_os.memory.summary_tree import SummaryTree
 from llm_os.memory.working_context import WorkingContext
-from llm_os.tokenisers import (
-    NOMIC_EMBED_TEXT_TOKENIZER,
-    get_tokeniser_and_context_window,
-)
+from llm_os.tokenisers import get_tokeniser_and_context_window
 
 
 class Memory:
@@ -35,165 +27,323 @@ class Memory:
         file_storage: FileStorage,
         function_schema_search_top_k: int = 10,
     ):
-        self.fq_path = path.join(
-            path.dirname(path.dirname(path.dirname(__file__))),
-            "persistent_storage",
-            conv_name,
-            "fifo_queue.json",
-        )
+        # Conversation state (and recall storage messages), written once per agent step
+        self.state_store = StateStore(conv_name)
+        self.state_store.register("fifo_queue", lambda: self.fq_state)
 
         # Function data
         self.in_context_function_dats = in_context_function_dats
         self.out_of_context_function_dats = out_of_context_function_dats
         self.out_of_context_function_sets = out_of_context_function_sets
+        self.function_dats = {
+            **in_context_function_dats,
+            **out_of_context_function_dats,
+        }  # Every callable function by name
         self.function_schema_search_top_k = function_schema_search_top_k
 
         # Function description embeddings
-        self.client = chromadb.EphemeralClient()
-        self.ef = OllamaEmbeddingFunction(
-            model_name="nomic-embed-text",
-            url=f"{HOST_URL}/api/embed",
-        )
-        self.collection = self.client.get_or_create_collection(
-            name="out_of_context_functions", embedding_function=self.ef
-        )
+        self.populate_function_description_embeddings()
 
         # Main context
         self.system_instructions = system_instructions
         self.working_context = working_context
-        if path.exists(self.fq_path):
-            self.__save_fq_path_dat_to_fq()
+        self.working_context.attach_state_store(self.state_store)
+        fq_info = self.state_store.load("fifo_queue")
+        if fq_info is not None:
+            self.fifo_queue = deque(fq_info["fifo_queue"])
+            self.total_no_messages = fq_info["total_no_messages"]
+            self.no_messages_in_queue = fq_info["no_messages_in_queue"]
         else:
             self.fifo_queue = deque()
             self.total_no_messages = 0
             self.no_messages_in_queue = 0
             self.write_fq_to_fq_path()
+        self.summary_tree = SummaryTree(conv_name, state_store=self.state_store)
 
         # External context
         self.archival_storage = archival_storage
         self.recall_storage = recall_storage
+        self.recall_storage.attach_state_store(self.state_store)
         self.file_storage = file_storage
 
         self.tokenizer, self.ctx_window, self.num_token_func, self.ct_num_token_func = (
             get_tokeniser_and_context_window(model_name)
         )
 
-    def populate_function_description_embeddings(self):
-        splitter = TextSplitter.from_huggingface_tokenizer(
-            NOMIC_EMBED_TEXT_TOKENIZER, 8192
+        # Token accounting caches
+        self.__system_message_no_tokens = None
+        self.__system_message_no_tokens_key = None
+        self.__template_overhead_no_tokens = (
+            self.__compute_template_overhead_no_tokens()
         )
 
-        for dat in self.out_of_context_function_dats.values():
-            content = dat["json_schema"]["description"]
-            chunk_list = splitter.chunks(content)
+        # The translated FIFO queue, kept in step with fifo_queue so that appends and pops only retranslate and recount the tail or head user buffer
+        # Each entry is [message, no_tokens, parts], where parts is the list of messages merged into a user buffer (None for assistant messages)
+        self.__translated_entries = deque()
+        self.__fq_no_tokens = 0
+        self.__translate_fifo_queue()
 
-            hex_stringify = lambda chunk: hashlib.md5(chunk.encode("UTF-8")).hexdigest()
-            ids = [hex_stringify(chunk) for chunk in chunk_list]
-            metadatas = [
-                {"function_schema": dat["json_schema"]} for _ in range(len(chunk_list))
-            ]
-            self.collection.add(documents=chunk_list, metadatas=metadatas, ids=ids)
+    def populate_function_description_embeddings(self):
+        FUNCTION_SCHEMA_INDEX.populate(self.out_of_context_function_dats)
 
     def search_function_description_embeddings(self, query, count, start):
         try:
-            query_res = self.collection.query(
-                query_texts=[query], n_results=self.function_schema_search_top_k
+            function_names = FUNCTION_SCHEMA_INDEX.search(
+                query,
+                self.out_of_context_function_dats.keys(),
+                self.function_schema_search_top_k,
             )
-            documents = query_res["documents"]
-            metadatas = query_res["metadatas"]
 
             start = int(start) if start else 0
             count = int(count) if count else self.function_schema_search_top_k
-            end = min(count + start, len(documents))
+            end = min(count + start, len(function_names))
 
-            results = list(
-                dict.fromkeys([metadata["function_schema"] for metadata in metadatas])
-            )[start:end]
+            results = [
+                self.out_of_context_function_dats[function_name]["json_schema"]
+                for function_name in function_names[start:end]
+            ]
 
-            return results, len(results)
+            return results, len(function_names)
         except Exception as e:
-            print("Archival search error", e)
+            print("Function schema search error", e)
             raise e
 
+    @property
+    def fq_state(self):
+        return {
+            "fifo_queue": list(self.fifo_queue),
+            "total_no_messages": self.total_no_messages,
+            "no_messages_in_queue": self.no_messages_in_queue,
+        }
+
     def write_fq_to_fq_path(self):
-        plf = Path(self.fq_path)
-        plf.touch(exist_ok=True)
-        with open(self.fq_path, "w") as f:
-            f.write(
-                json.dumps(
-                    {
-                        "fifo_queue": list(self.fifo_queue),
-                        "total_no_messages": self.total_no_messages,
-                        "no_messages_in_queue": self.no_messages_in_queue,
-                    }
-                )
-            )
+        # Deferred until the end of the step when called during one
+        self.state_store.mark_dirty("fifo_queue")
 
-    def __save_fq_path_dat_to_fq(self):
-        with open(self.fq_path, "r") as f:
-            fq_info = json.loads(f.read())
-            self.fifo_queue = deque(fq_info["fifo_queue"])
-            self.total_no_messages = fq_info["total_no_messages"]
-            self.no_messages_in_queue = fq_info["no_messages_in_queue"]
+    def close(self):
+        self.write_fq_to_fq_path()
+        self.state_store.close()
+        self.archival_storage.close()
+        self.file_storage.close()
 
     def append_messaged_to_fq_and_rs(self, messaged):
         # note: messaged must be in the form {'type': type, 'user_id': user_id, 'message': {'role': role, 'content': content}}
         self.fifo_queue.append(messaged)
+        self.__translate_append(messaged)
         self.recall_storage.insert(messaged)
         self.total_no_messages += 1
         self.no_messages_in_queue += 1
         self.write_fq_to_fq_path()
 
+    def pop_oldest_messaged_from_fq(self):
+        self.no_messages_in_queue -= 1
+        messaged = self.fifo_queue.popleft()
+        self.__translate_popleft(messaged)
+        return messaged
+
+    def push_oldest_messaged_to_fq(self, messaged):
+        self.no_messages_in_queue += 1
+        self.fifo_queue.appendleft(messaged)
+        self.__translate_appendleft(messaged)
+
     @property
     def main_context_system_message(self):
+        if STABLE_PROMPT_PREFIX:
+            return self.stable_system_message
+        return f"""{self.stable_system_message}
+        {self.volatile_context}"""
+
+    @property
+    def stable_system_message(self):
+        # Function data is read-only once loaded, so the prompt prefix stays byte-identical between steps
         newline = "\n"
         return f"""# SYSTEM INSTRUCTIONS
         {self.system_instructions}
         # IN-CONTEXT FUNCTION JSON SCHEMAS (some functions are stored out of context and not visible here)
         {newline.join([str(dat["json_schema"]) for dat in self.in_context_function_dats.values()])}
         # OUT-OF-CONTEXT FUNCTION SETS
-        {newline.join(self.out_of_context_function_sets)}
-        # EXTERNAL CONTEXT INFORMATION
+        {newline.join(self.out_of_context_function_sets)}"""
+
+    @property
+    def volatile_context(self):
+        return f"""# EXTERNAL CONTEXT INFORMATION
         {len(self.recall_storage)} previous messages between you and the user are stored in recall storage (use functions to access them)
         {len(self.archival_storage)} total memories you created are stored in archival storage (use functions to access them)
         # CORE MEMORY (limited in size, additional information stored in archival/recall storage)
         {str(self.working_context)}"""
 
     @property
-    def main_ctx_message_seq(self):
+    def volatile_context_message(self):
+        return {
+            "role": "user",
+            "content": f"❮SYSTEM MESSAGE❯ {self.volatile_context}",
+        }
+
+    @property
+    def translated_messages(self):
+        return [entry[0] for entry in self.__translated_entries]
+
+    @staticmethod
+    def user_buffer_part(messaged):
         # note: messaged must be in the form {'type': type, 'user_id': user_id, 'message': {'role': role, 'content': content}}
-        translated_messages = []
+        # Returns None for assistant messages, which are not merged into user buffers
+        if messaged["type"] == "system":
+            return f"❮SYSTEM MESSAGE❯ {messaged['message']['content']}"
+        elif messaged["type"] == "tool":
+            return f"❮TOOL MESSAGE for conversation with user with id '{messaged['user_id']}'❯ {messaged['message']['content']}"
+        elif messaged["type"] == "user":
+            return f"❮USER MESSAGE for conversation with user with id '{messaged['user_id']}'❯ {messaged['message']['content']}"
+        return None
+
+    def __user_buffer_entry(self, parts):
+        message = {"role": "user", "content": "\n\n".join(parts)}
+        return [message, self.__message_no_tokens(message), parts]
+
+    def __assistant_entry(self, messaged):
+        return [
+            messaged["message"],
+            self.__message_no_tokens(messaged["message"]),
+            None,
+        ]
+
+    def __push_entry(self, entry, left=False):
+        if left:
+            self.__translated_entries.appendleft(entry)
+        else:
+            self.__translated_entries.append(entry)
+        self.__fq_no_tokens += entry[1]
+
+    def __pop_entry(self, left=False):
+        if left:
+            entry = self.__translated_entries.popleft()
+        else:
+            entry = self.__translated_entries.pop()
+        self.__fq_no_tokens -= entry[1]
+        return entry
+
+    def __replace_entry(self, index, entry):
+        self.__fq_no_tokens += entry[1] - self.__translated_entries[index][1]
+        self.__translated_entries[index] = entry
+
+    def __translate_fifo_queue(self):
+        # Every user buffer (run of non-assistant messages) becomes one user message, and every assistant message is preceded by one (possibly empty)
+        self.__translated_entries = deque()
+        self.__fq_no_tokens = 0
         user_role_buf = []
 
         for messaged in self.fifo_queue:
-            if messaged["type"] == "system":
-                user_role_buf.append(
-                    f"❮SYSTEM MESSAGE❯ {messaged['message']['content']}"
-                )
-            elif messaged["type"] == "tool":
-                user_role_buf.append(
-                    f"❮TOOL MESSAGE for conversation with user with id '{messaged['user_id']}'❯ {messaged['message']['content']}"
-                )
-            elif messaged["type"] == "user":
-                user_role_buf.append(
-                    f"❮USER MESSAGE for conversation with user with id '{messaged['user_id']}'❯ {messaged['message']['content']}"
-                )
+            part = Memory.user_buffer_part(messaged)
+            if part is not None:
+                user_role_buf.append(part)
             else:
-                translated_messages.append(
-                    {"role": "user", "content": "\n\n".join(user_role_buf)}
-                )
-                translated_messages.append(messaged["message"])
+                self.__push_entry(self.__user_buffer_entry(user_role_buf))
+                self.__push_entry(self.__assistant_entry(messaged))
                 user_role_buf = []
 
         if user_role_buf:
-            translated_messages.append(
-                {"role": "user", "content": "\n\n".join(user_role_buf)}
-            )
+            self.__push_entry(self.__user_buffer_entry(user_role_buf))
 
-        return [
+    def __translate_append(self, messaged):
+        entries = self.__translated_entries
+        part = Memory.user_buffer_part(messaged)
+        # The last entry is an open user buffer if it is not an assistant message
+        has_open_user_buffer = bool(entries) and entries[-1][2] is not None
+
+        if part is None:
+            if not has_open_user_buffer:
+                self.__push_entry(self.__user_buffer_entry([]))
+            self.__push_entry(self.__assistant_entry(messaged))
+        elif has_open_user_buffer:
+            self.__replace_entry(-1, self.__user_buffer_entry(entries[-1][2] + [part]))
+        else:
+            self.__push_entry(self.__user_buffer_entry([part]))
+
+    def __translate_popleft(self, messaged):
+        # The first entry is always a user buffer, whose first part is messaged unless messaged is an assistant message (then the buffer is empty)
+        entries = self.__translated_entries
+
+        if Memory.user_buffer_part(messaged) is None:
+            self.__pop_entry(left=True)
+            self.__pop_entry(left=True)
+            if entries and entries[0][2] is None:
+                self.__push_entry(self.__user_buffer_entry([]), left=True)
+        elif len(entries[0][2]) > 1 or len(entries) > 1:
+            self.__replace_entry(0, self.__user_buffer_entry(entries[0][2][1:]))
+        else:
+            self.__pop_entry(left=True)
+
+    def __translate_appendleft(self, messaged):
+        entries = self.__translated_entries
+        part = Memory.user_buffer_part(messaged)
+
+        if part is None:
+            self.__push_entry(self.__assistant_entry(messaged), left=True)
+            self.__push_entry(self.__user_buffer_entry([]), left=True)
+        elif entries:
+            self.__replace_entry(0, self.__user_buffer_entry([part] + entries[0][2]))
+        else:
+            self.__push_entry(self.__user_buffer_entry([part]), left=True)
+
+    @property
+    def main_ctx_message_seq(self):
+        main_ctx_message_seq = [
             {"role": "system", "content": self.main_context_system_message}
-        ] + translated_messages
+        ] + self.translated_messages
+        if STABLE_PROMPT_PREFIX:
+            # Trails the conversation so that only the tail of the prompt has to be re-evaluated
+            # Merged into the last user buffer if there is one, since some chat templates require user and assistant messages to alternate
+            volatile_context_message = self.volatile_context_message
+            if (
+                len(main_ctx_message_seq) > 1
+                and main_ctx_message_seq[-1]["role"] == "user"
+            ):
+                main_ctx_message_seq[-1] = {
+                    "role": "user",
+                    "content": main_ctx_message_seq[-1]["content"]
+                    + "\n\n"
+                    + volatile_context_message["content"],
+                }
+            else:
+                main_ctx_message_seq.append(volatile_context_message)
+        return main_ctx_message_seq
+
+    def __compute_template_overhead_no_tokens(self):
+        # Tokens the chat template adds once per conversation (e.g. BOS/EOS), which must not be counted once per message
+        message = {"role": "user", "content": "hello"}
+        try:
+            return 2 * self.ct_num_token_func([message]) - self.ct_num_token_func(
+                [message, message]
+            )
+        except Exception:
+            return 0
+
+    def __message_no_tokens(self, message):
+        return self.ct_num_token_func([message]) - self.__template_overhead_no_tokens
+
+    @property
+    def system_message_no_tokens(self):
+        key = (
+            self.working_context.version,
+            len(self.recall_storage),
+            len(self.archival_storage),
+        )
+        if self.__system_message_no_tokens_key != key:
+            self.__system_message_no_tokens = self.ct_num_token_func(
+                [{"role": "system", "content": self.main_context_system_message}]
+            )
+            if STABLE_PROMPT_PREFIX:
+                # Counted as a message of its own, which slightly overestimates it when it is merged into the last user buffer
+                self.__system_message_no_tokens += (
+                    self.ct_num_token_func([self.volatile_context_message])
+                    - self.__template_overhead_no_tokens
+                )
+            self.__system_message_no_tokens_key = key
+        return self.__system_message_no_tokens
+
+    @property
+    def fq_no_tokens(self):
+        return self.__fq_no_tokens
 
     @property
     def main_ctx_message_seq_no_tokens(self):
-        return self.ct_num_token_func(self.main_ctx_message_seq)
+        return self.system_message_no_tokens + self.fq_no_tokens
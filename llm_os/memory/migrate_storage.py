@@ -0,0 +1,85 @@
+import argparse
+from os import listdir, path
+
+from llm_os.constants import CONVERSATION_STORAGE_BACKEND, PERSISTENT_STORAGE_PATH
+from llm_os.memory.storage_backends import (
+    CONVERSATION_DOCUMENT_NAMES,
+    STORAGE_BACKENDS,
+    detect_storage_backend_name,
+    open_storage_backend,
+)
+
+
+def migrate_conv(conv_name, to_backend_name):
+    # Copies a conversation's documents and recall storage messages into another backend and removes the old files once the copy has been read back
+    # Returns False if there is nothing to migrate
+    conv_path = path.join(PERSISTENT_STORAGE_PATH, conv_name)
+    if not listdir(conv_path):
+        return False
+    from_backend_name = detect_storage_backend_name(conv_path)
+    if from_backend_name == to_backend_name:
+        return False
+
+    source = open_storage_backend(conv_path, True, from_backend_name)
+    documents = {}
+    for name in CONVERSATION_DOCUMENT_NAMES:
+        document = source.load_document(name)
+        if document is not None:
+            documents[name] = document
+    recall_messageds = source.load_recall_messageds()
+
+    target = open_storage_backend(conv_path, True, to_backend_name)
+    try:
+        target.rewrite_recall_messageds(recall_messageds)
+        target.commit(documents, [])
+        if target.load_recall_messageds() != recall_messageds or any(
+            target.load_document(name) != document
+            for name, document in documents.items()
+        ):
+            raise RuntimeError(f"Migrated data of {conv_name} does not match")
+    except Exception:
+        target.remove_files()
+        source.close()
+        raise
+
+    target.close()
+    source.remove_files()
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Migrates conversations in persistent_storage to another storage backend (stop the server first)"
+    )
+    parser.add_argument(
+        "conv_names",
+        nargs="*",
+        help="Conversations to migrate (default: all)",
+    )
+    parser.add_argument(
+        "--to",
+        choices=list(STORAGE_BACKENDS),
+        default=CONVERSATION_STORAGE_BACKEND,
+        help="Backend to migrate to (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    conv_names = args.conv_names or sorted(
+        conv_name
+        for conv_name in listdir(PERSISTENT_STORAGE_PATH)
+        if conv_name[0] != "."
+        and path.isdir(path.join(PERSISTENT_STORAGE_PATH, conv_name))
+    )
+
+    for conv_name in conv_names:
+        try:
+            if migrate_conv(conv_name, args.to):
+                print(f"Migrated {conv_name} to {args.to}")
+            else:
+                print(f"Skipped {conv_name} (already {args.to} or empty)")
+        except Exception as e:
+            print(f"Failed to migrate {conv_name}:", e)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+from datetime import date, datetime, time
+import heapq
+import math
+import re
+
+# Shared by RecallStorage's in-memory indexes and the storage backends that index recall storage messages themselves
+
+TOKEN_PATTERN = re.compile(r"\w+")
+DATE_FORMAT = "%Y-%m-%d"
+
+
+def tokenise_for_index(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def parse_datetime(timestamp):
+    # Accepts ISO 8601 dates and datetimes, falling back to the DATE_FORMAT dates used to be parsed with (which also allows unpadded months and days); naive values are taken as local time
+    # Returns (datetime, whether only a date was given)
+    timestamp = timestamp.strip()
+    try:
+        return datetime.combine(date.fromisoformat(timestamp), time()), True
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(timestamp), False
+    except ValueError:
+        return datetime.strptime(timestamp, DATE_FORMAT), True
+
+
+def parse_timestamp(timestamp):
+    return parse_datetime(timestamp)[0].timestamp()
+
+
+def is_conv_messaged(messaged):
+    return messaged["type"] not in ["system", "tool"]
+
+
+def is_text_indexed_messaged(messaged):
+    return is_conv_messaged(messaged) and messaged["message"]["content"] is not None
+
+
+def rank_by_tf_idf(postings, no_messageds, count=None, start=None):
+    # postings holds one {message index: term frequency} dict per query term, over no_messageds indexed messages
+    # Messages must contain every query term; results are ranked by TF-IDF (ties broken by recency)
+    # Returns (the requested page of message indices, total number of matching messages)
+    postings = sorted(postings, key=len)
+    if not postings or not postings[0]:
+        return [], 0
+
+    idfs = [math.log(1 + no_messageds / len(posting)) for posting in postings]
+
+    scores = {}
+    for idx, tf in postings[0].items():
+        score = (1 + math.log(tf)) * idfs[0]
+        for posting, idf in zip(postings[1:], idfs[1:]):
+            other_tf = posting.get(idx, None)
+            if other_tf is None:
+                break
+            score += (1 + math.log(other_tf)) * idf
+        else:
+            scores[idx] = score
+
+    total = len(scores)
+
+    start = int(start if start else 0)
+    count = int(count if count else total)
+    end = min(count + start, total)
+
+    top_idxs = heapq.nlargest(end, scores, key=lambda idx: (scores[idx], idx))
+
+    return top_idxs[start:end], total
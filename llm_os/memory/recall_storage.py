@@ -1,52 +1,118 @@
-from os import path
-from datetime import datetime
-import json
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+import heapq
+
+from llm_os.memory.recall_index import (
+    is_conv_messaged,
+    is_text_indexed_messaged,
+    parse_datetime,
+    parse_timestamp,
+    rank_by_tf_idf,
+    tokenise_for_index,
+)
+from llm_os.memory.state_store import StateStore
 
 
 class RecallStorage:
     def __init__(self, conv_name):
-        self.rc_path = path.join(
-            path.dirname(path.dirname(path.dirname(__file__))),
-            "persistent_storage",
-            conv_name,
-            "recall_storage.json",
-        )
-        if path.exists(self.rc_path):
-            self.__save_rc_path_dat_to_rs_cache()
+        # Messages are persisted straight away until an agent's memory attaches its own (batched) state store
+        self.state_store = StateStore(conv_name)
+
+        # Backends that index recall storage messages themselves (SQLite) are searched directly; otherwise every message is loaded and indexed in memory
+        self.in_memory = not self.state_store.backend.indexes_recall_messageds
+
+        # Inverted index over conversation messages: user_id -> token -> {rs_cache index: term frequency}
+        self.text_index = defaultdict(lambda: defaultdict(dict))
+        self.no_indexed_messageds = Counter()
+
+        # Date index over conversation messages: user_id -> (sorted POSIX timestamps, rs_cache indices)
+        self.date_index = defaultdict(lambda: (array("d"), array("q")))
+
+        if self.in_memory:
+            self.rs_cache = self.state_store.load_recall_messageds()
+            for idx, messaged in enumerate(self.rs_cache):
+                self.__index_messaged(idx, messaged)
+            self.no_messageds = len(self.rs_cache)
         else:
-            self.rs_cache = []
-            self.__write_rs_cache_to_rc_path()
+            self.rs_cache = None
+            self.no_messageds = self.state_store.backend.count_recall_messageds()
 
     def __len__(self):
-        return len(self.rs_cache)
+        return self.no_messageds
 
-    def __write_rs_cache_to_rc_path(self):
-        if not path.exists(self.rc_path):
-            f = open(self.rc_path, "x")
-            f.close()
-        with open(self.rc_path, "w") as f:
-            f.write(json.dumps(self.rs_cache))
+    def attach_state_store(self, state_store):
+        self.state_store.close()
+        self.state_store = state_store
 
-    def __save_messaged(self, messaged):
-        self.rs_cache.append(messaged)
-        self.__write_rs_cache_to_rc_path()
+    @staticmethod
+    def is_conv_messaged(messaged):
+        return is_conv_messaged(messaged)
+
+    def __index_messaged(self, idx, messaged):
+        if not RecallStorage.is_conv_messaged(messaged):
+            return
+
+        timestamps, idxs = self.date_index[messaged["user_id"]]
+        timestamp = parse_timestamp(messaged["timestamp"])
+        if not timestamps or timestamps[-1] <= timestamp:
+            timestamps.append(timestamp)
+            idxs.append(idx)
+        else:  # Out of order (e.g. clock change), keep the arrays sorted
+            pos = bisect_right(timestamps, timestamp)
+            timestamps.insert(pos, timestamp)
+            idxs.insert(pos, idx)
 
-    def __save_rc_path_dat_to_rs_cache(self):
-        with open(self.rc_path, "r") as f:
-            self.rs_cache = json.loads(f.read())
+        if messaged["message"]["content"] is None:
+            return
+
+        user_index = self.text_index[messaged["user_id"]]
+        for token, tf in Counter(
+            tokenise_for_index(messaged["message"]["content"])
+        ).items():
+            user_index[token][idx] = tf
+        self.no_indexed_messageds[messaged["user_id"]] += 1
+
+    def __save_messaged(self, messaged):
+        if self.in_memory:
+            self.rs_cache.append(messaged)
+            self.__index_messaged(len(self.rs_cache) - 1, messaged)
+        self.no_messageds += 1
+        self.state_store.append_recall_messaged(messaged)
 
     @property
     def conv_messageds(self):
+        if self.in_memory:
+            messageds = self.rs_cache
+        else:
+            with self.state_store.recall_query() as (backend, pending_messageds):
+                messageds = backend.load_recall_messageds() + pending_messageds
         return [
             messaged
-            for messaged in self.rs_cache
-            if messaged["type"] not in ["system", "tool"]
+            for messaged in messageds
+            if RecallStorage.is_conv_messaged(messaged)
         ]
 
+    def __user_conv_messageds(self, for_user_id):
+        if self.in_memory:
+            return [
+                messaged
+                for messaged in self.conv_messageds
+                if messaged["user_id"] == for_user_id
+            ]
+        with self.state_store.recall_query() as (backend, pending_messageds):
+            return backend.load_conv_recall_messageds(for_user_id) + [
+                messaged
+                for messaged in pending_messageds
+                if RecallStorage.is_conv_messaged(messaged)
+                and messaged["user_id"] == for_user_id
+            ]
+
     def insert(self, messaged):
         # note: messaged must be in the form {'type': type, 'user_id': user_id, 'message': {'role': role, 'content': content}}
         recall_messaged = {
-            "timestamp": datetime.now().astimezone().strftime("%Y-%m-%d"),
+            "timestamp": datetime.now().astimezone().isoformat(timespec="seconds"),
             "user_id": messaged["user_id"],
             "type": messaged["type"],
             "message": messaged["message"],
@@ -54,35 +120,121 @@ class RecallStorage:
         self.__save_messaged(recall_messaged)
 
     def text_search(self, query_string, for_user_id, count=None, start=None):
-        results = [
-            messaged
-            for messaged in self.conv_messageds
-            if messaged["message"]["content"] is not None
-            and query_string.lower() in messaged["message"]["content"].lower()
-            and messaged["user_id"] == for_user_id
-        ]
+        # Messages must contain every query term; results are ranked by TF-IDF (ties broken by recency)
+        query_tokens = set(tokenise_for_index(query_string))
 
-        start = int(start if start else 0)
-        count = int(count if count else len(results))
-        end = min(count + start, len(results))
+        if not query_tokens:
+            # Nothing indexable in the query (e.g. punctuation only), fall back to substring matching
+            results = [
+                messaged
+                for messaged in self.__user_conv_messageds(for_user_id)
+                if messaged["message"]["content"] is not None
+                and query_string.lower() in messaged["message"]["content"].lower()
+            ]
+
+            start = int(start if start else 0)
+            count = int(count if count else len(results))
+            end = min(count + start, len(results))
+
+            return results[start:end], len(results)
+
+        if self.in_memory:
+            user_index = self.text_index.get(for_user_id, {})
+            idxs, total = rank_by_tf_idf(
+                [user_index.get(token, {}) for token in query_tokens],
+                self.no_indexed_messageds[for_user_id],
+                count,
+                start,
+            )
+            return [self.rs_cache[idx] for idx in idxs], total
 
-        return results[start:end], len(results)
+        with self.state_store.recall_query() as (backend, pending_messageds):
+            query_tokens = list(query_tokens)
+            postings, no_messageds = backend.load_recall_postings(
+                for_user_id, query_tokens
+            )
+
+            # Messages not committed yet are indexed here, with the idxs they are going to get
+            next_idx = backend.next_recall_idx()
+            pending_by_idx = {}
+            for i, messaged in enumerate(pending_messageds):
+                if (
+                    not is_text_indexed_messaged(messaged)
+                    or messaged["user_id"] != for_user_id
+                ):
+                    continue
+                pending_by_idx[next_idx + i] = messaged
+                no_messageds += 1
+                tfs = Counter(tokenise_for_index(messaged["message"]["content"]))
+                for token, posting in zip(query_tokens, postings):
+                    if token in tfs:
+                        posting[next_idx + i] = tfs[token]
+
+            idxs, total = rank_by_tf_idf(postings, no_messageds, count, start)
+            messageds = backend.load_recall_messageds_by_idx(
+                [idx for idx in idxs if idx not in pending_by_idx]
+            )
+        messageds.update(pending_by_idx)
+        return [messageds[idx] for idx in idxs], total
 
     def date_search(self, start_date, end_date, for_user_id, count=None, start=None):
-        start_dt = datetime.strptime(start_date, "%Y-%m-%d")
-        end_dt = datetime.strptime(end_date, "%Y-%m-%d")
+        start_ts = parse_timestamp(start_date)
+        end_dt, end_is_date = parse_datetime(end_date)
+        if end_is_date:  # The whole end day is included, up to midnight of the next day
+            end_ts = (end_dt + timedelta(days=1)).timestamp()
+            bisect_end = bisect_left
+        else:
+            end_ts = end_dt.timestamp()
+            bisect_end = bisect_right
 
-        results = [
-            messaged
-            for messaged in self.conv_messageds
-            if start_dt
-            <= datetime.strptime(messaged["timestamp"], "%Y-%m-%d")
-            <= end_dt
-            and messaged["user_id"] == for_user_id
-        ]
+        if not self.in_memory:
+            return self.__backend_date_search(
+                start_ts, end_ts, bisect_end is bisect_right, for_user_id, count, start
+            )
+
+        timestamps, idxs = self.date_index.get(for_user_id, (array("d"), array("q")))
+        lo = bisect_left(timestamps, start_ts)
+        hi = max(lo, bisect_end(timestamps, end_ts))
+        total = hi - lo
 
         start = int(start if start else 0)
-        count = int(count if count else len(results))
-        end = min(count + start, len(results))
+        count = int(count if count else total)
+        end = min(count + start, total)
+
+        return [self.rs_cache[idx] for idx in idxs[lo + start : lo + end]], total
+
+    def __backend_date_search(
+        self, start_ts, end_ts, include_end, for_user_id, count, start
+    ):
+        start = int(start if start else 0)
+        with self.state_store.recall_query() as (backend, pending_messageds):
+            rows, total = backend.search_recall_dates(
+                for_user_id,
+                start_ts,
+                end_ts,
+                include_end,
+                start + int(count) if count else -1,  # -1 is no limit
+            )
+
+            # Messages not committed yet are merged in by (timestamp, idx), with the idxs they are going to get
+            next_idx = backend.next_recall_idx()
+            pending_rows = []
+            for i, messaged in enumerate(pending_messageds):
+                if (
+                    not RecallStorage.is_conv_messaged(messaged)
+                    or messaged["user_id"] != for_user_id
+                ):
+                    continue
+                timestamp = parse_timestamp(messaged["timestamp"])
+                if start_ts <= timestamp and (
+                    timestamp <= end_ts if include_end else timestamp < end_ts
+                ):
+                    pending_rows.append((timestamp, next_idx + i, messaged))
+        pending_rows.sort(key=lambda row: row[:2])
+
+        total += len(pending_rows)
+        count = int(count if count else total)
+        end = min(count + start, total)
 
-        return results[start:end], len(results)
+        rows = list(heapq.merge(rows, pending_rows, key=lambda row: row[:2]))
+        return [messaged for _, _, messaged in rows[start:end]], total
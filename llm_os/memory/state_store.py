@@ -0,0 +1,105 @@
+from contextlib import contextmanager
+from os import path
+from threading import RLock
+
+from llm_os.constants import PERSISTENT_STORAGE_PATH, STATE_STORE_FSYNC
+from llm_os.memory.storage_backends import open_storage_backend
+
+
+class StateStore:
+    # Per-conversation state (the fifo_queue, working_context, misc_info and summary_tree documents plus new recall storage messages) persisted write-behind through a storage backend (see storage_backends.py).
+    # Owners register a function returning a document's current contents and mark it dirty whenever they change it.
+    # Outside of a batch changes are written straight away; inside one (an agent step) writes are deferred and everything is committed together when the outermost batch ends, so a step costs one write per changed document instead of one per change.
+    def __init__(
+        self,
+        conv_name: str,
+        fsync_on_commit: bool = STATE_STORE_FSYNC,
+        backend_name: str = None,
+    ):
+        self.conv_path = path.join(PERSISTENT_STORAGE_PATH, conv_name)
+        self.backend = open_storage_backend(
+            self.conv_path, fsync_on_commit, backend_name
+        )
+        self.lock = RLock()
+        self.serialisers = {}  # document name -> () -> JSON serialisable contents
+        self.dirty = set()
+        self.pending_recall_messageds = []
+        self.batch_depth = 0
+        self.no_commits = 0
+
+    def load(self, name):
+        # Returns None if the document has never been written
+        with self.lock:
+            return self.backend.load_document(name)
+
+    def load_recall_messageds(self):
+        with self.lock:
+            return self.backend.load_recall_messageds()
+
+    @contextmanager
+    def recall_query(self):
+        # Yields the backend and the recall messages not yet committed to it (newest last), with the lock held so that no commit happens in between
+        with self.lock:
+            yield self.backend, list(self.pending_recall_messageds)
+
+    def register(self, name, serialiser):
+        with self.lock:
+            self.serialisers[name] = serialiser
+
+    def mark_dirty(self, name):
+        with self.lock:
+            self.dirty.add(name)
+            if self.batch_depth == 0:
+                self.commit()
+
+    def append_recall_messaged(self, messaged):
+        with self.lock:
+            self.pending_recall_messageds.append(messaged)
+            if self.batch_depth == 0:
+                self.commit()
+
+    def begin_batch(self):
+        with self.lock:
+            self.batch_depth += 1
+
+    def end_batch(self):
+        with self.lock:
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                self.commit()
+
+    @contextmanager
+    def batch(self):
+        self.begin_batch()
+        try:
+            yield self
+        finally:
+            self.end_batch()
+
+    def commit(self):
+        with self.lock:
+            if not self.dirty and not self.pending_recall_messageds:
+                return
+            names = sorted(self.dirty)
+            recall_messageds = self.pending_recall_messageds
+            self.dirty = set()
+            self.pending_recall_messageds = []
+
+            try:
+                self.backend.commit(
+                    {name: self.serialisers[name]() for name in names},
+                    recall_messageds,
+                )
+            except Exception:
+                # Retried on the next commit
+                self.dirty.update(names)
+                self.pending_recall_messageds = (
+                    recall_messageds + self.pending_recall_messageds
+                )
+                raise
+            self.no_commits += 1
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.backend.close()
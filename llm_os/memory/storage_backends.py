@@ -0,0 +1,395 @@
+import json
+import sqlite3
+from collections import Counter
+from os import O_RDONLY, close, fsync, open as os_open, path, remove, replace
+
+from llm_os.constants import CONVERSATION_STORAGE_BACKEND
+from llm_os.memory.recall_index import (
+    is_text_indexed_messaged,
+    parse_timestamp,
+    tokenise_for_index,
+)
+
+# Documents kept by StateStore (see memory.py, working_context.py, agent.py and summary_tree.py for their contents)
+CONVERSATION_DOCUMENT_NAMES = (
+    "fifo_queue",
+    "working_context",
+    "misc_info",
+    "summary_tree",
+)
+
+
+class JSONFilesBackend:
+    # The original layout: one JSON file per document and a JSONL journal of recall storage messages
+    name = "json"
+    indexes_recall_messageds = (
+        False  # RecallStorage loads every message and indexes them in memory
+    )
+
+    def __init__(self, conv_path: str, fsync_on_commit: bool):
+        self.conv_path = conv_path
+        self.fsync_on_commit = fsync_on_commit
+        self.rc_path = path.join(conv_path, "recall_storage.jsonl")
+        self.legacy_rc_path = path.join(conv_path, "recall_storage.json")
+
+    @staticmethod
+    def file_names():
+        return [f"{name}.json" for name in CONVERSATION_DOCUMENT_NAMES] + [
+            "recall_storage.jsonl",
+            "recall_storage.json",
+        ]
+
+    def document_path(self, name):
+        return path.join(self.conv_path, f"{name}.json")
+
+    def load_document(self, name):
+        # Returns None if the document has never been written
+        if not path.exists(self.document_path(name)):
+            return None
+        with open(self.document_path(name), "r") as f:
+            return json.loads(f.read())
+
+    def load_recall_messageds(self):
+        if path.exists(self.legacy_rc_path) and not path.exists(self.rc_path):
+            # Converts a recall_storage.json file (single JSON list) into the journal format
+            with open(self.legacy_rc_path, "r") as f:
+                messageds = json.loads(f.read())
+            self.rewrite_recall_messageds(messageds)
+            remove(self.legacy_rc_path)
+            return messageds
+
+        if not path.exists(self.rc_path):
+            return []
+
+        messageds = []
+        no_corrupted_lines = 0
+        with open(self.rc_path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    messageds.append(json.loads(line))
+                except ValueError:
+                    # Only a torn final write is expected here, but any unreadable line is dropped
+                    no_corrupted_lines += 1
+
+        if no_corrupted_lines:
+            print(
+                f"Recovered recall storage journal {self.rc_path} (dropped {no_corrupted_lines} corrupted lines)"
+            )
+            self.rewrite_recall_messageds(messageds)
+
+        return messageds
+
+    def rewrite_recall_messageds(self, messageds):
+        # Rewrites the journal (write to temp then rename so that a crash never leaves a half-written journal)
+        # Only needed after tail recovery and when migrating: messages are never edited or deleted, so an appended journal has nothing to compact
+        tmp_path = self.rc_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for messaged in messageds:
+                f.write(json.dumps(messaged) + "\n")
+            f.flush()
+            fsync(f.fileno())
+        replace(tmp_path, self.rc_path)
+
+    def commit(self, documents, recall_messageds):
+        # New recall messages are appended to the journal, then every document is written to a temporary file and only then are they all renamed into place, so that a crash never leaves a half-written document
+        if recall_messageds:
+            with open(self.rc_path, "a") as f:
+                f.write(
+                    "".join(
+                        json.dumps(messaged) + "\n" for messaged in recall_messageds
+                    )
+                )
+                if self.fsync_on_commit:
+                    f.flush()
+                    fsync(f.fileno())
+
+        tmp_paths = []
+        for name, contents in documents.items():
+            tmp_path = self.document_path(name) + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps(contents))
+                if self.fsync_on_commit:
+                    f.flush()
+                    fsync(f.fileno())
+            tmp_paths.append((tmp_path, self.document_path(name)))
+
+        for tmp_path, document_path in tmp_paths:
+            replace(tmp_path, document_path)
+        if self.fsync_on_commit and tmp_paths:
+            self.__fsync_conv_dir()
+
+    def __fsync_conv_dir(self):
+        # Makes the renames themselves durable
+        fd = os_open(self.conv_path, O_RDONLY)
+        try:
+            fsync(fd)
+        finally:
+            close(fd)
+
+    def remove_files(self):
+        for file_name in JSONFilesBackend.file_names():
+            if path.exists(path.join(self.conv_path, file_name)):
+                remove(path.join(self.conv_path, file_name))
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend:
+    # Every document and the recall storage messages in a single SQLite database (WAL mode), so that a step commits in one transaction and readers never block the agent
+    name = "sqlite"
+    file_name = "conversation.sqlite3"
+    schema_version = (
+        1  # Stored as PRAGMA user_version; 1 added the recall storage text index
+    )
+    indexes_recall_messageds = True  # RecallStorage searches through the indexes below instead of loading every message
+
+    def __init__(self, conv_path: str, fsync_on_commit: bool):
+        self.db_path = path.join(conv_path, SQLiteBackend.file_name)
+        # Steps move between executor threads; StateStore's lock keeps the connection to one thread at a time
+        self.connection = sqlite3.connect(
+            self.db_path, isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # NORMAL only loses the latest transactions on power loss (never consistency), FULL syncs on every commit
+        self.connection.execute(
+            f"PRAGMA synchronous={'FULL' if fsync_on_commit else 'NORMAL'}"
+        )
+        # recall_terms is an inverted index of the conversation messages with content (token -> message idx and term frequency) and recall_text_index_sizes counts them per user, for TF-IDF ranking
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                name TEXT PRIMARY KEY,
+                contents TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS recall_messages (
+                idx INTEGER PRIMARY KEY,
+                user_id,
+                type TEXT NOT NULL,
+                timestamp REAL NOT NULL,
+                messaged TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS recall_conv_messages_by_user_and_timestamp
+                ON recall_messages (user_id, timestamp)
+                WHERE type NOT IN ('system', 'tool');
+            CREATE TABLE IF NOT EXISTS recall_terms (
+                user_id NOT NULL,
+                token TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (user_id, token, idx)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS recall_text_index_sizes (
+                user_id PRIMARY KEY,
+                no_messageds INTEGER NOT NULL
+            );
+            """)
+        if (
+            self.connection.execute("PRAGMA user_version").fetchone()[0]
+            < SQLiteBackend.schema_version
+        ):
+            # Databases from before the text index have it built from their messages (and their index over every recall message replaced by the one over conversation messages)
+            with self.__transaction():
+                self.connection.execute(
+                    "DROP INDEX IF EXISTS recall_messages_by_user_and_timestamp"
+                )
+                self.__rebuild_recall_text_index()
+                self.connection.execute(
+                    f"PRAGMA user_version = {SQLiteBackend.schema_version}"
+                )
+
+    def load_document(self, name):
+        # Returns None if the document has never been written
+        row = self.connection.execute(
+            "SELECT contents FROM documents WHERE name = ?", (name,)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def load_recall_messageds(self):
+        return [
+            json.loads(messaged)
+            for (messaged,) in self.connection.execute(
+                "SELECT messaged FROM recall_messages ORDER BY idx"
+            )
+        ]
+
+    def count_recall_messageds(self):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM recall_messages"
+        ).fetchone()[0]
+
+    def next_recall_idx(self):
+        # The idx the next inserted message will get
+        return self.connection.execute(
+            "SELECT COALESCE(MAX(idx), 0) + 1 FROM recall_messages"
+        ).fetchone()[0]
+
+    def load_conv_recall_messageds(self, user_id):
+        # Conversation messages (not system or tool messages) of a user, oldest first
+        return [
+            json.loads(messaged)
+            for (messaged,) in self.connection.execute(
+                "SELECT messaged FROM recall_messages WHERE user_id IS ? AND type NOT IN ('system', 'tool') ORDER BY idx",
+                (user_id,),
+            )
+        ]
+
+    def search_recall_dates(self, user_id, start_ts, end_ts, include_end, limit):
+        # Returns the first limit (timestamp, idx, messaged) of a user's conversation messages from start_ts up to end_ts in time order, and how many there are in total
+        where = f"user_id IS ? AND type NOT IN ('system', 'tool') AND timestamp >= ? AND timestamp {'<=' if include_end else '<'} ?"
+        params = (user_id, start_ts, end_ts)
+        total = self.connection.execute(
+            f"SELECT COUNT(*) FROM recall_messages WHERE {where}", params
+        ).fetchone()[0]
+        rows = [
+            (timestamp, idx, json.loads(messaged))
+            for timestamp, idx, messaged in self.connection.execute(
+                f"SELECT timestamp, idx, messaged FROM recall_messages WHERE {where} ORDER BY timestamp, idx LIMIT ?",
+                params + (limit,),
+            )
+        ]
+        return rows, total
+
+    def load_recall_postings(self, user_id, tokens):
+        # Returns one {idx: term frequency} dict per token and the number of text indexed messages of the user
+        postings = [
+            dict(
+                self.connection.execute(
+                    "SELECT idx, tf FROM recall_terms WHERE user_id IS ? AND token = ?",
+                    (user_id, token),
+                )
+            )
+            for token in tokens
+        ]
+        row = self.connection.execute(
+            "SELECT no_messageds FROM recall_text_index_sizes WHERE user_id IS ?",
+            (user_id,),
+        ).fetchone()
+        return postings, row[0] if row is not None else 0
+
+    def load_recall_messageds_by_idx(self, idxs):
+        messageds = {}
+        idxs = list(idxs)
+        for i in range(0, len(idxs), 500):
+            chunk = idxs[i : i + 500]
+            messageds.update(
+                (idx, json.loads(messaged))
+                for idx, messaged in self.connection.execute(
+                    f"SELECT idx, messaged FROM recall_messages WHERE idx IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+        return messageds
+
+    @staticmethod
+    def recall_row(messaged):
+        return (
+            messaged["user_id"],
+            messaged["type"],
+            parse_timestamp(messaged["timestamp"]),
+            json.dumps(messaged),
+        )
+
+    def __index_recall_messaged(self, idx, messaged):
+        user_id = messaged["user_id"]
+        if not is_text_indexed_messaged(messaged) or user_id is None:
+            return
+        self.connection.executemany(
+            "INSERT INTO recall_terms (user_id, token, idx, tf) VALUES (?, ?, ?, ?)",
+            [
+                (user_id, token, idx, tf)
+                for token, tf in Counter(
+                    tokenise_for_index(messaged["message"]["content"])
+                ).items()
+            ],
+        )
+        if not self.connection.execute(
+            "UPDATE recall_text_index_sizes SET no_messageds = no_messageds + 1 WHERE user_id IS ?",
+            (user_id,),
+        ).rowcount:
+            self.connection.execute(
+                "INSERT INTO recall_text_index_sizes (user_id, no_messageds) VALUES (?, 1)",
+                (user_id,),
+            )
+
+    def __rebuild_recall_text_index(self):
+        self.connection.execute("DELETE FROM recall_terms")
+        self.connection.execute("DELETE FROM recall_text_index_sizes")
+        for idx, messaged in self.connection.execute(
+            "SELECT idx, messaged FROM recall_messages ORDER BY idx"
+        ).fetchall():
+            self.__index_recall_messaged(idx, json.loads(messaged))
+
+    def __insert_recall_messageds(self, messageds):
+        for messaged in messageds:
+            idx = self.connection.execute(
+                "INSERT INTO recall_messages (user_id, type, timestamp, messaged) VALUES (?, ?, ?, ?)",
+                SQLiteBackend.recall_row(messaged),
+            ).lastrowid
+            self.__index_recall_messaged(idx, messaged)
+
+    def rewrite_recall_messageds(self, messageds):
+        with self.__transaction():
+            self.connection.execute("DELETE FROM recall_messages")
+            self.connection.execute("DELETE FROM recall_terms")
+            self.connection.execute("DELETE FROM recall_text_index_sizes")
+            self.__insert_recall_messageds(messageds)
+
+    def commit(self, documents, recall_messageds):
+        with self.__transaction():
+            self.connection.executemany(
+                "INSERT INTO documents (name, contents) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET contents = excluded.contents",
+                [(name, json.dumps(contents)) for name, contents in documents.items()],
+            )
+            self.__insert_recall_messageds(recall_messageds)
+
+    def __transaction(self):
+        return SQLiteTransaction(self.connection)
+
+    def remove_files(self):
+        self.close()
+        for suffix in ["", "-wal", "-shm"]:
+            if path.exists(self.db_path + suffix):
+                remove(self.db_path + suffix)
+
+    def close(self):
+        self.connection.close()
+
+
+class SQLiteTransaction:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+STORAGE_BACKENDS = {
+    JSONFilesBackend.name: JSONFilesBackend,
+    SQLiteBackend.name: SQLiteBackend,
+}
+
+
+def detect_storage_backend_name(conv_path):
+    # Existing conversations keep the layout they were created with (until migrated); new ones use CONVERSATION_STORAGE_BACKEND
+    if path.exists(path.join(conv_path, SQLiteBackend.file_name)):
+        return SQLiteBackend.name
+    if any(
+        path.exists(path.join(conv_path, file_name))
+        for file_name in JSONFilesBackend.file_names()
+    ):
+        return JSONFilesBackend.name
+    return CONVERSATION_STORAGE_BACKEND
+
+
+def open_storage_backend(conv_path, fsync_on_commit, backend_name=None):
+    backend_name = backend_name or detect_storage_backend_name(conv_path)
+    if backend_name not in STORAGE_BACKENDS:
+        raise ValueError(
+            f"Invalid conversation storage backend '{backend_name}' (must be one of {list(STORAGE_BACKENDS)})"
+        )
+    return STORAGE_BACKENDS[backend_name](conv_path, fsync_on_commit)
@@ -0,0 +1,98 @@
+from llm_os.constants import SUMMARY_TREE_FAN_OUT
+from llm_os.memory.state_store import StateStore
+
+
+class SummaryTree:
+    # Summaries of messages evicted from the FIFO queue.
+    # Level 0 holds one leaf summary per evicted segment and every SUMMARY_TREE_FAN_OUT consecutive nodes of a level are merged into one node of the level above.
+    # All nodes are kept so that older summaries stay retrievable by message range; nodes cover [start, end) in the order messages were evicted.
+    def __init__(
+        self,
+        conv_name: str,
+        fan_out: int = SUMMARY_TREE_FAN_OUT,
+        state_store: StateStore = None,
+    ):
+        self.state_store = state_store or StateStore(conv_name)
+        self.state_store.register("summary_tree", lambda: self.state)
+        self.fan_out = fan_out
+
+        state = self.state_store.load("summary_tree")
+        if state is not None:
+            self.commit(state, write=False)
+        else:
+            self.commit({"no_summarised_messages": 0, "levels": [[]]})
+
+    def __len__(self):
+        return self.no_summarised_messages
+
+    @property
+    def state(self):
+        return {
+            "no_summarised_messages": self.no_summarised_messages,
+            "levels": self.levels,
+        }
+
+    def write_summary_tree_to_summary_tree_path(self):
+        self.state_store.mark_dirty("summary_tree")
+
+    def commit(self, state, write=True):
+        self.no_summarised_messages = state["no_summarised_messages"]
+        self.levels = state["levels"]
+        if write:
+            self.write_summary_tree_to_summary_tree_path()
+
+    def with_segment(self, no_messages, summary, merge_summaries):
+        # Returns the state after adding a leaf for the next no_messages evicted messages without modifying the tree, so that it can be built off the agent's thread and committed later.
+        # merge_summaries(list of summaries) -> summary is only called for groups that have just filled up; lower levels are reused as they are
+        levels = [list(level) for level in self.levels]
+        start = self.no_summarised_messages
+        levels[0].append(
+            {"start": start, "end": start + no_messages, "summary": summary}
+        )
+
+        level_no = 0
+        while len(levels[level_no]) >= self.fan_out * (
+            (len(levels[level_no + 1]) if level_no + 1 < len(levels) else 0) + 1
+        ):
+            if level_no + 1 == len(levels):
+                levels.append([])
+            group = levels[level_no][
+                len(levels[level_no + 1]) * self.fan_out : (len(levels[level_no + 1]) + 1)
+                * self.fan_out
+            ]
+            levels[level_no + 1].append(
+                {
+                    "start": group[0]["start"],
+                    "end": group[-1]["end"],
+                    "summary": merge_summaries([node["summary"] for node in group]),
+                }
+            )
+            level_no += 1
+
+        return {"no_summarised_messages": start + no_messages, "levels": levels}
+
+    @property
+    def frontier(self):
+        # The fewest nodes that together cover every summarised message, oldest first
+        nodes = []
+        no_merged_nodes = 0
+        for level_no in reversed(range(len(self.levels))):
+            nodes += self.levels[level_no][no_merged_nodes:]
+            if level_no > 0:
+                no_merged_nodes = len(self.levels[level_no]) * self.fan_out
+        return nodes
+
+    def get_summaries(self, start, end, level_no=0):
+        if level_no >= len(self.levels):
+            return []
+        return [
+            node
+            for node in self.levels[level_no]
+            if node["start"] < end and node["end"] > start
+        ]
+
+    def __str__(self):
+        return "\n".join(
+            f"Messages {node['start']+1} to {node['end']}: {node['summary']}"
+            for node in self.frontier
+        )
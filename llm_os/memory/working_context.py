@@ -1,6 +1,4 @@
-from os import path
-import json
-
+from llm_os.memory.state_store import StateStore
 from llm_os.tokenisers import get_tokeniser_and_context_window
 from llm_os.constants import (
     WORKING_CTX_PERSONA_MAX_TOKENS,
@@ -17,21 +15,18 @@ class WorkingContext:
         initial_human_id: int,
         initial_human_persona: str,
     ):
-        self.wc_path = path.join(
-            path.dirname(path.dirname(path.dirname(__file__))),
-            "persistent_storage",
-            conv_name,
-            "working_context.json",
-        )
+        # Writes go straight to disk until an agent's memory attaches its own (batched) state store
+        self.state_store = StateStore(conv_name)
+        self.state_store.register("working_context", lambda: self.state)
         _, _, self.no_token_func, _ = get_tokeniser_and_context_window(model_name)
-
-        if path.exists(self.wc_path):
-            with open(self.wc_path, "r") as f:
-                wc_cache = json.loads(f.read())
-                self.last_2_human_ids = wc_cache["last_2_human_ids"]
-                self.persona = wc_cache["persona"]
-                self.humans = {int(k): v for k, v in wc_cache["humans"].items()}
-            self.__update_working_context_ps()
+        self.version = 0  # Incremented on every change so that dependents can invalidate caches
+
+        wc_cache = self.state_store.load("working_context")
+        if wc_cache is not None:
+            self.last_2_human_ids = wc_cache["last_2_human_ids"]
+            self.persona = wc_cache["persona"]
+            self.humans = {int(k): v for k, v in wc_cache["humans"].items()}
+            self.version += 1
         else:
             self.last_2_human_ids = []
             self.persona = persona
@@ -72,7 +67,26 @@ class WorkingContext:
         self.humans[int(human_id)] = human
         self.__update_working_context_ps()
 
+    @property
+    def state(self):
+        return {
+            "last_2_human_ids": self.last_2_human_ids,
+            "persona": self.persona,
+            "humans": self.humans,
+        }
+
+    def close(self):
+        # Only needed for a working context whose state store was never replaced by an agent's memory (which closes its own)
+        self.state_store.close()
+
+    def attach_state_store(self, state_store):
+        self.state_store.close()
+        self.state_store = state_store
+        self.state_store.register("working_context", lambda: self.state)
+
     def submit_used_human_id(self, human_id):
+        if self.last_2_human_ids and self.last_2_human_ids[-1] == human_id:
+            return  # Already the current human, nothing to persist
         if human_id in self.last_2_human_ids:
             self.last_2_human_ids.remove(human_id)
         self.last_2_human_ids.append(human_id)
@@ -81,19 +95,8 @@ class WorkingContext:
         self.__update_working_context_ps()
 
     def __update_working_context_ps(self):
-        if not path.exists(self.wc_path):
-            f = open(self.wc_path, "x")
-            f.close()
-        with open(self.wc_path, "w") as f:
-            f.write(
-                json.dumps(
-                    {
-                        "last_2_human_ids": self.last_2_human_ids,
-                        "persona": self.persona,
-                        "humans": self.humans,
-                    }
-                )
-            )
+        self.version += 1
+        self.state_store.mark_dirty("working_context")
 
     def edit_persona(self, new_persona):
         no_tokens_new_persona = self.no_token_func(new_persona)
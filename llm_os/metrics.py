@@ -0,0 +1,282 @@
+from bisect import bisect_left
+from threading import Lock
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+)
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in pairs)
+        + "}"
+    )
+
+
+class Histogram:
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.lock = Lock()
+        self.series = {}  # label values -> [per-bucket counts (last one is +Inf), sum, count]
+
+    def observe(self, value, **labels):
+        label_values = tuple(str(labels.get(name, "")) for name in self.label_names)
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self.series[label_values] = series
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self.lock:
+            series_items = [
+                (label_values, list(counts), total, count)
+                for label_values, (counts, total, count) in self.series.items()
+            ]
+
+        for label_values, counts, total, count in series_items:
+            cumulative = 0
+            for upper_bound, bucket_count in zip(
+                [str(bound) for bound in self.buckets] + ["+Inf"], counts
+            ):
+                cumulative += bucket_count
+                lines.append(
+                    f"{self.name}_bucket{format_labels(self.label_names, label_values, [('le', upper_bound)])} {cumulative}"
+                )
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                format_labels(self.label_names, label_values) or "{}": {
+                    "count": count,
+                    "sum": total,
+                }
+                for label_values, (_, total, count) in self.series.items()
+            }
+
+
+class Counter:
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.lock = Lock()
+        self.series = {}  # label values -> value
+
+    def inc(self, value=1, **labels):
+        label_values = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + value
+
+    def remove(self, **labels):
+        # Drops every series matching the given labels (e.g. all series of an unloaded conversation)
+        with self.lock:
+            for label_values in list(self.series.keys()):
+                if all(
+                    label_values[self.label_names.index(name)] == str(value)
+                    for name, value in labels.items()
+                ):
+                    del self.series[label_values]
+
+    @property
+    def type(self):
+        return "counter"
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self.lock:
+            series_items = list(self.series.items())
+        for label_values, value in series_items:
+            lines.append(
+                f"{self.name}{format_labels(self.label_names, label_values)} {value}"
+            )
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                format_labels(self.label_names, label_values) or "{}": value
+                for label_values, value in self.series.items()
+            }
+
+
+class Gauge(Counter):
+    def set(self, value, **labels):
+        label_values = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self.lock:
+            self.series[label_values] = value
+
+    @property
+    def type(self):
+        return "gauge"
+
+
+class CallbackMetric:
+    # Values are computed when the registry is rendered, for state that is already tracked elsewhere (cache sizes, storage sizes)
+    def __init__(self, name, description, metric_type, label_names, callback):
+        self.name = name
+        self.description = description
+        self.type = metric_type
+        self.label_names = tuple(label_names)
+        self.callback = callback  # () -> iterable of (label values, value)
+
+    def collect(self):
+        try:
+            return [
+                (tuple(str(v) for v in label_values), value)
+                for label_values, value in self.callback()
+            ]
+        except Exception as e:
+            print("Metric collection error", self.name, e)
+            return []
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for label_values, value in self.collect():
+            lines.append(
+                f"{self.name}{format_labels(self.label_names, label_values)} {value}"
+            )
+        return lines
+
+    def snapshot(self):
+        return {
+            format_labels(self.label_names, label_values) or "{}": value
+            for label_values, value in self.collect()
+        }
+
+
+class MetricsRegistry:
+    # In-process metrics shared by every agent; rendered in the Prometheus text format by the server's /metrics endpoint
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics = {}
+
+    def __get_or_create(self, metric_class, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, *args, **kwargs)
+                self.metrics[name] = metric
+            return metric
+
+    def histogram(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.__get_or_create(Histogram, name, description, label_names, buckets)
+
+    def counter(self, name, description, label_names=()):
+        return self.__get_or_create(Counter, name, description, label_names)
+
+    def gauge(self, name, description, label_names=()):
+        return self.__get_or_create(Gauge, name, description, label_names)
+
+    def callback(self, name, description, metric_type, label_names, callback):
+        # Replaces any earlier callback with the same name (e.g. when the server module is reloaded)
+        metric = CallbackMetric(name, description, metric_type, label_names, callback)
+        with self.lock:
+            self.metrics[name] = metric
+        return metric
+
+    def remove_conv(self, conv_name):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            if isinstance(metric, Counter) and "conv_name" in metric.label_names:
+                metric.remove(conv_name=conv_name)
+
+    def render_prometheus(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+
+METRICS = MetricsRegistry()
+
+STEP_PHASE_DURATION = METRICS.histogram(
+    "llm_agent_step_phase_duration_seconds",
+    "Time spent in each phase of an agent step",
+    ["phase"],
+)
+FUNCTION_CALL_DURATION = METRICS.histogram(
+    "llm_agent_function_call_duration_seconds",
+    "Time spent executing each function called by the agent",
+    ["function", "failed"],
+)
+FUNCTION_CALL_REJECTIONS = METRICS.counter(
+    "llm_agent_function_call_rejections_total",
+    "Function calls rejected before execution (malformed call, unknown function, invalid arguments)",
+    ["function"],
+)
+STEPS = METRICS.counter(
+    "llm_agent_steps_total",
+    "Agent steps, by outcome (ok, function_failed or invalid_response)",
+    ["conv_name", "outcome"],
+)
+LLM_TOKENS = METRICS.counter(
+    "llm_agent_llm_tokens_total",
+    "Prompt (in) and generated (out) tokens reported by Ollama",
+    ["conv_name", "direction"],
+)
+CONTEXT_FILL_RATIO = METRICS.gauge(
+    "llm_agent_context_fill_ratio",
+    "Tokens in the main context divided by the context window after the last step",
+    ["conv_name"],
+)
+SUMMARISATION_DURATION = METRICS.histogram(
+    "llm_agent_summarisation_duration_seconds",
+    "Time spent summarising evicted messages",
+    ["mode"],
+)
+SUMMARISATIONS = METRICS.counter(
+    "llm_agent_summarisations_total",
+    "Summaries produced, by whether they were swapped into the message queue",
+    ["outcome"],
+)
@@ -20,3 +20,17 @@ Only output the summary, do NOT include anything else in your output.
 
 def get_summarise_system_prompt():
     return SYSTEM.replace("<<SUMMARY_WORD_LIMIT>>", str(SUMMARY_WORD_LIMIT))
+
+
+MERGE_SYSTEM = """
+Your job is to merge consecutive summaries of a conversation between an AI persona and a human into a single summary.
+Each summary covers a range of earlier messages and the summaries are given in chronological order, oldest first.
+The summaries were written by the AI in the first person, keep using the first person.
+Keep the events that matter for continuing the conversation and drop details that later summaries make irrelevant. Do NOT attempt to CONTINUE the conversation, SUMMARIZE IT!
+Keep your summary less than <<SUMMARY_WORD_LIMIT>> words, do NOT exceed this word limit.
+Only output the summary, do NOT include anything else in your output.
+"""
+
+
+def get_merge_summaries_system_prompt():
+    return MERGE_SYSTEM.replace("<<SUMMARY_WORD_LIMIT>>", str(SUMMARY_WORD_LIMIT))
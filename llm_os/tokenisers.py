@@ -1,7 +1,19 @@
+from os import path
+from threading import Lock
+
 from config import CONFIG
+from semantic_text_splitter import MarkdownSplitter, TextSplitter
 from tokenizers import Tokenizer
 from transformers import AutoTokenizer
 
+SPLITTER_CLASSES = {"text": TextSplitter, "markdown": MarkdownSplitter}
+
+# Process-wide registry so that every tokeniser is loaded at most once and shared by all agents
+# tokeniser_registry_lock guards the two dicts only and is never held while loading
+tokeniser_registry_lock = Lock()
+tokeniser_registry = {}
+tokeniser_load_locks = {}  # key -> lock held while that key is loaded
+
 
 def mistral_format_system(conv):
     if not conv:
@@ -22,28 +34,72 @@ def mistral_format_system(conv):
     return conv
 
 
+def get_tokeniser_source(repo_id):
+    # Prefers an offline copy at <tokenisers_path>/<repo_id> over downloading from Hugging Face
+    if CONFIG["tokenisers_path"]:
+        local_path = path.join(CONFIG["tokenisers_path"], repo_id)
+        if path.isdir(local_path):
+            return local_path
+    return repo_id
+
+
+def get_registered_tokeniser(key, load_func):
+    # Loading (e.g. downloading from Hugging Face) holds only the lock of its own key, so it does not block lookups of other keys (such as splitters of tokenisers already loaded)
+    with tokeniser_registry_lock:
+        if key in tokeniser_registry:
+            return tokeniser_registry[key]
+        load_lock = tokeniser_load_locks.setdefault(key, Lock())
+
+    with load_lock:
+        with tokeniser_registry_lock:
+            if key in tokeniser_registry:  # Loaded by another thread while waiting
+                return tokeniser_registry[key]
+        tokeniser = load_func()
+        with tokeniser_registry_lock:
+            tokeniser_registry[key] = tokeniser
+            del tokeniser_load_locks[key]
+        return tokeniser
+
+
+def load_hf_tokenizers_tokeniser(repo_id):
+    source = get_tokeniser_source(repo_id)
+    if source != repo_id:
+        return Tokenizer.from_file(path.join(source, "tokenizer.json"))
+    return Tokenizer.from_pretrained(
+        repo_id, token=CONFIG["huggingface_user_access_token"]
+    )
+
+
+def load_auto_tokeniser(repo_id, **kwargs):
+    return AutoTokenizer.from_pretrained(
+        get_tokeniser_source(repo_id),
+        token=CONFIG["huggingface_user_access_token"],
+        **kwargs,
+    )
+
+
 def get_tokeniser_and_context_window(model_name):
+    return get_registered_tokeniser(
+        ("model", model_name),
+        lambda: load_tokeniser_and_context_window(model_name),
+    )
+
+
+def load_tokeniser_and_context_window(model_name):
     match model_name:
         case "deepseek-v2:16b-lite-chat-q4_0":
-            tokenizer = AutoTokenizer.from_pretrained(
-                "deepseek-ai/DeepSeek-V2-Lite-Chat",
-                token=CONFIG["huggingface_user_access_token"],
-            )
+            tokenizer = load_auto_tokeniser("deepseek-ai/DeepSeek-V2-Lite-Chat")
             ctx_window = 8192  # reduced to lower RAM usage
             num_token_func = lambda text: len(tokenizer.encode(text))
             ct_num_token_func = lambda conv: len(tokenizer.apply_chat_template(conv))
         case "openhermes":
-            tokenizer = AutoTokenizer.from_pretrained(
-                "teknium/OpenHermes-2.5-Mistral-7B",
-                token=CONFIG["huggingface_user_access_token"],
-            )
+            tokenizer = load_auto_tokeniser("teknium/OpenHermes-2.5-Mistral-7B")
             ctx_window = 8192  # usually 32768 but reduced to lower RAM usage
             num_token_func = lambda text: len(tokenizer.encode(text))
             ct_num_token_func = lambda conv: len(tokenizer.apply_chat_template(conv))
         case "gemma2:2b-instruct-q5_0":
-            tokenizer = AutoTokenizer.from_pretrained(
+            tokenizer = load_auto_tokeniser(
                 "google/gemma-2-2b",
-                token=CONFIG["huggingface_user_access_token"],
                 chat_template="{% for message in messages %}{% if message['role'] == 'user' %}{{ ' ' }}{% endif %}{{ message['content'] }}{% if not loop.last %}{{ ' ' }}{% endif %}{% endfor %}{{ eos_token }}",
             )
             ctx_window = 8192
@@ -55,12 +111,33 @@ def get_tokeniser_and_context_window(model_name):
     return tokenizer, ctx_window, num_token_func, ct_num_token_func
 
 
-NOMIC_EMBED_TEXT_TOKENIZER = Tokenizer.from_pretrained(
-    "nomic-ai/nomic-embed-text-v1.5",
-    token=CONFIG["huggingface_user_access_token"],
-)
+def get_nomic_embed_text_tokeniser():
+    return get_registered_tokeniser(
+        ("tokenizers", "nomic-ai/nomic-embed-text-v1.5"),
+        lambda: load_hf_tokenizers_tokeniser("nomic-ai/nomic-embed-text-v1.5"),
+    )
+
+
+def get_qwen_2_5_tokeniser():
+    return get_registered_tokeniser(
+        ("tokenizers", "Qwen/Qwen2.5-0.5B-Instruct"),
+        lambda: load_hf_tokenizers_tokeniser("Qwen/Qwen2.5-0.5B-Instruct"),
+    )
+
+
+def get_splitter(tokenizer, capacity, kind="text"):
+    # Splitters are cached per (tokenizer, capacity, kind); tokenizers come from the registry, so their identity is stable
+    key = ("splitter", kind, id(tokenizer), capacity)
+    return get_registered_tokeniser(
+        key,
+        lambda: (
+            tokenizer,  # Kept alive so that its id cannot be reused by another tokenizer
+            SPLITTER_CLASSES[kind].from_huggingface_tokenizer(tokenizer, capacity),
+        ),
+    )[1]
+
 
-QWEN_2_5_TOKENIZER = Tokenizer.from_pretrained(
-    "Qwen/Qwen2.5-0.5B-Instruct",
-    token=CONFIG["huggingface_user_access_token"],
-)
+def split_texts(tokenizer, capacity, texts, kind="text"):
+    # Returns one chunk list per text
+    splitter = get_splitter(tokenizer, capacity, kind)
+    return [splitter.chunks(text) for text in texts]
@@ -0,0 +1,157 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import httpx
+
+from llm_os.constants import TRACE_EXPORT_URL, TRACE_SERVICE_NAME
+from llm_os.metrics import STEP_PHASE_DURATION
+
+trace_export_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def otlp_value(value):
+    # OTLP/JSON AnyValue encoding
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_span_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent_span_id
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+        self.start_time_unix_nano = time.time_ns()
+        self.start_time = time.perf_counter()
+        self.end_time = None
+
+    @property
+    def duration(self):
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, error):
+        self.error = str(error)
+
+    def end(self):
+        if self.end_time is None:
+            self.end_time = time.perf_counter()
+
+    def to_otlp(self):
+        dat = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(self.start_time_unix_nano),
+            "endTimeUnixNano": str(
+                self.start_time_unix_nano + int(self.duration * 1_000_000_000)
+            ),
+            "attributes": [
+                {"key": key, "value": otlp_value(value)}
+                for key, value in self.attributes.items()
+            ],
+            "status": (
+                {"code": 2, "message": self.error} if self.error else {"code": 1}
+            ),
+        }
+        if self.parent_span_id:
+            dat["parentSpanId"] = self.parent_span_id
+        return dat
+
+
+class Trace:
+    # Spans recorded during a single agent step
+    # A step moves between the event loop and executor threads but never runs two phases at once, so nesting is tracked with a plain stack rather than thread-local context
+    def __init__(self, name, **attributes):
+        self.trace_id = os.urandom(16).hex()
+        self.root = Span(name, self.trace_id, attributes=attributes)
+        self.stack = [self.root]
+        self.spans = []
+
+    @contextmanager
+    def span(self, name, **attributes):
+        span = Span(name, self.trace_id, self.stack[-1].span_id, attributes)
+        self.stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error(e)
+            raise
+        finally:
+            self.stack.pop()
+            span.end()
+            self.spans.append(span)
+            STEP_PHASE_DURATION.observe(span.duration, phase=name)
+
+    def end(self):
+        self.root.end()
+        STEP_PHASE_DURATION.observe(self.root.duration, phase=self.root.name)
+        if TRACE_EXPORT_URL:
+            trace_export_executor.submit(export_trace, self.to_otlp())
+
+    def to_summary(self):
+        # Compact form sent to clients in the NDJSON stream
+        span_names = {self.root.span_id: self.root.name}
+        span_names.update({span.span_id: span.name for span in self.spans})
+        return {
+            "trace_id": self.trace_id,
+            "duration_ms": round(self.root.duration * 1000, 3),
+            "spans": [
+                {
+                    "name": span.name,
+                    "parent": span_names.get(span.parent_span_id),
+                    "offset_ms": round(
+                        (span.start_time - self.root.start_time) * 1000, 3
+                    ),
+                    "duration_ms": round(span.duration * 1000, 3),
+                    **({"attributes": span.attributes} if span.attributes else {}),
+                    **({"error": span.error} if span.error else {}),
+                }
+                for span in sorted(self.spans, key=lambda span: span.start_time)
+            ],
+        }
+
+    def to_otlp(self):
+        # OTLP/JSON ExportTraceServiceRequest, accepted by OpenTelemetry collectors on /v1/traces
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": otlp_value(TRACE_SERVICE_NAME),
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "llm_os"},
+                            "spans": [
+                                span.to_otlp() for span in [self.root] + self.spans
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+
+
+def export_trace(otlp_dat):
+    try:
+        httpx.post(TRACE_EXPORT_URL, json=otlp_dat, timeout=5).raise_for_status()
+    except Exception as e:
+        print("Trace export error", e)
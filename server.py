@@ -1,36 +1,216 @@
 import json
-from asyncio import Semaphore
+from asyncio import (
+    FIRST_COMPLETED,
+    CancelledError,
+    Lock,
+    Queue,
+    Semaphore,
+    ensure_future,
+    get_running_loop,
+    shield,
+    wait,
+)
+from collections import OrderedDict
+from contextlib import aclosing, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from functools import partial
 from os import listdir, mkdir, path, rmdir
-from time import time
+from threading import Lock as ThreadLock
+from time import monotonic, time
 from uuid import uuid4
 
 import uvicorn
 from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
 from config import CONFIG
 from llm_os.agent import Agent
-from llm_os.functions.load_functions import (
-    get_function_dats_from_function_sets,
-    load_all_function_sets,
+from llm_os.constants import (
+    AGENT_STEP_THREAD_POOL_SIZE,
+    INCLUDE_TRACES_IN_STREAM,
+    LOADED_AGENT_IDLE_TIMEOUT_SECONDS,
+    MAX_CONCURRENT_AGENT_STEPS,
+    MAX_LOADED_AGENTS,
+    PERSISTENT_STORAGE_PATH,
 )
+from llm_os.functions.load_functions import FUNCTION_REGISTRY
 from llm_os.interface import CLIInterface, ServerInterface
 from llm_os.memory.archival_storage import ArchivalStorage
 from llm_os.memory.file_storage import FileStorage
 from llm_os.memory.memory import Memory
 from llm_os.memory.recall_storage import RecallStorage
 from llm_os.memory.working_context import WorkingContext
+from llm_os.metrics import METRICS
 from llm_os.prompts.gpt_system import get_system_text
 from llm_os.tokenisers import get_tokeniser_and_context_window
 from llm_os.web_interface import WebInterface
 
 app = FastAPI()
 
-sem = Semaphore(1)
+# Serialises requests within a single conversation: conv_name -> [lock, number of requests holding or waiting for it]
+conv_locks = {}
+admission_sem = Semaphore(MAX_CONCURRENT_AGENT_STEPS)  # Caps agent steps in flight
+step_executor = ThreadPoolExecutor(max_workers=AGENT_STEP_THREAD_POOL_SIZE)
+
+
+class AgentCache:
+    # LRU cache of live agents; evicted agents are flushed and closed, then reloaded from disk on their next request
+    def __init__(self, max_size, idle_timeout, is_busy):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.is_busy = is_busy  # Busy agents (e.g. mid-step) are never evicted
+
+        self.lock = ThreadLock()
+        self.agents = OrderedDict()  # conv_name -> (agent, last_used)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.agents)
+
+    def __evict(self, conv_name):
+        agent, _ = self.agents.pop(conv_name)
+        agent.close()
+        self.evictions += 1
+
+    def __evict_idle_and_excess(self):
+        now = monotonic()
+        for conv_name, (_, last_used) in list(self.agents.items()):
+            if now - last_used > self.idle_timeout and not self.is_busy(conv_name):
+                self.__evict(conv_name)
+
+        for conv_name in list(self.agents.keys()):
+            if len(self.agents) <= self.max_size:
+                break
+            if not self.is_busy(conv_name):
+                self.__evict(conv_name)
+
+    def get(self, conv_name):
+        with self.lock:
+            self.__evict_idle_and_excess()
+            if conv_name not in self.agents:
+                self.misses += 1
+                return None
+            self.hits += 1
+            agent, _ = self.agents[conv_name]
+            self.agents[conv_name] = (agent, monotonic())
+            self.agents.move_to_end(conv_name)
+            return agent
+
+    def put(self, conv_name, agent):
+        with self.lock:
+            self.agents[conv_name] = (agent, monotonic())
+            self.agents.move_to_end(conv_name)
+            self.__evict_idle_and_excess()
+
+    def discard(self, conv_name):
+        with self.lock:
+            if conv_name in self.agents:
+                self.__evict(conv_name)
+
+    def items(self):
+        with self.lock:
+            return [(conv_name, agent) for conv_name, (agent, _) in self.agents.items()]
+
+    @property
+    def stats(self):
+        return {
+            "size": len(self.agents),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def is_conv_busy(conv_name):
+    # Called from worker threads, so the entry is read once
+    conv_lock_entry = conv_locks.get(conv_name)
+    return conv_lock_entry is not None and conv_lock_entry[0].locked()
+
+
+loaded_agents = AgentCache(
+    MAX_LOADED_AGENTS,
+    LOADED_AGENT_IDLE_TIMEOUT_SECONDS,
+    is_conv_busy,
+)
+
+# Metrics
+LOCK_WAIT = METRICS.histogram(
+    "llm_agent_lock_wait_seconds",
+    "Time requests wait for a conversation lock or for an admission slot",
+    ["lock"],
+)
+METRICS.callback(
+    "llm_agent_loaded_agents",
+    "Agents currently loaded in memory",
+    "gauge",
+    [],
+    lambda: [((), len(loaded_agents))],
+)
+METRICS.callback(
+    "llm_agent_cache_events_total",
+    "Loaded-agent cache hits, misses and evictions",
+    "counter",
+    ["event"],
+    lambda: [
+        (("hit",), loaded_agents.hits),
+        (("miss",), loaded_agents.misses),
+        (("eviction",), loaded_agents.evictions),
+    ],
+)
+
+
+def get_storage_sizes():
+    # Each storage is measured on its own, so that one failing does not hide the others
+    storage_sizes = []
+    for conv_name, agent in loaded_agents.items():
+        for storage_name, storage in [
+            ("recall", agent.memory.recall_storage),
+            ("archival", agent.memory.archival_storage),
+            ("file", agent.memory.file_storage),
+        ]:
+            try:
+                storage_sizes.append(((conv_name, storage_name), len(storage)))
+            except Exception as e:
+                print("Storage size error", conv_name, storage_name, e)
+    return storage_sizes
+
+
+METRICS.callback(
+    "llm_agent_storage_size",
+    "Entries in each storage of each loaded conversation",
+    "gauge",
+    ["conv_name", "storage"],
+    get_storage_sizes,
+)
+
 
-loaded_agents = {}
+@asynccontextmanager
+async def waited_for(lock, lock_name):
+    # Holds an asyncio lock or semaphore while recording how long it took to acquire
+    start_time = monotonic()
+    async with lock:
+        LOCK_WAIT.observe(monotonic() - start_time, lock=lock_name)
+        yield
+
+
+@asynccontextmanager
+async def conv_lock(conv_name):
+    # Entries are dropped once no request holds or waits for them, so the locks of deleted and evicted conversations do not pile up
+    conv_lock_entry = conv_locks.setdefault(conv_name, [Lock(), 0])
+    conv_lock_entry[1] += 1
+    try:
+        async with waited_for(conv_lock_entry[0], "conversation"):
+            yield
+    finally:
+        conv_lock_entry[1] -= 1
+        if conv_lock_entry[1] == 0:
+            del conv_locks[conv_name]
 
 
 class InitAgentRequestParams(BaseModel):
@@ -56,8 +236,9 @@ class SendMessageParams(BaseModel):
 def get_agent(conv_name):
     global loaded_agents
 
-    if conv_name in loaded_agents:
-        return loaded_agents[conv_name]
+    agent = loaded_agents.get(conv_name)
+    if agent is not None:
+        return agent
 
     # Load system instructions
     system_instructions = get_system_text("llm_agent_chat")
@@ -67,7 +248,7 @@ def get_agent(conv_name):
         in_context_function_dats,
         out_of_context_function_dats,
         out_of_context_function_sets,
-    ) = get_function_dats_from_function_sets(load_all_function_sets())
+    ) = FUNCTION_REGISTRY.get_function_dats()
 
     # Load interfaces
     interface = ServerInterface()
@@ -96,7 +277,7 @@ def get_agent(conv_name):
         file_storage,
     )
 
-    loaded_agents[conv_name] = agent
+    loaded_agents.put(conv_name, agent)
 
     return agent
 
@@ -133,7 +314,7 @@ def init_agent(agent_persona_name, human_persona_name):
         in_context_function_dats,
         out_of_context_function_dats,
         out_of_context_function_sets,
-    ) = get_function_dats_from_function_sets(load_all_function_sets())
+    ) = FUNCTION_REGISTRY.get_function_dats()
 
     # Load interfaces
     interface = ServerInterface()
@@ -143,7 +324,7 @@ def init_agent(agent_persona_name, human_persona_name):
     ps_folders = list(
         filter(
             lambda s: s[0] != ".",
-            listdir(path.join(path.dirname(__file__), "persistent_storage")),
+            listdir(PERSISTENT_STORAGE_PATH),
         )
     )
 
@@ -152,7 +333,7 @@ def init_agent(agent_persona_name, human_persona_name):
     while conv_name in ps_folders:
         conv_name = f"{agent_persona_name.split('.')[0]}--{human_persona_name.split('.')[0]}@{uuid4().hex}-{uuid4().hex}"
 
-    mkdir(path.join(path.dirname(__file__), "persistent_storage", conv_name))
+    mkdir(path.join(PERSISTENT_STORAGE_PATH, conv_name))
 
     # Create agent
     working_context = WorkingContext(
@@ -179,23 +360,138 @@ def init_agent(agent_persona_name, human_persona_name):
         file_storage,
     )
 
-    loaded_agents[conv_name] = agent
+    loaded_agents.put(conv_name, agent)
 
     return conv_name
 
 
+async def wait_until_done(future):
+    # Waits for a future even if cancelled again in the meantime; its result or exception is left to whoever awaits it next
+    while not future.done():
+        try:
+            await shield(future)
+        except (CancelledError, Exception):
+            pass
+
+
+async def run_in_step_executor(func, *args, **kwargs):
+    # Work keeps running in its worker thread even if the client disconnects, so wait for it before any conversation lock is released
+    future = get_running_loop().run_in_executor(
+        step_executor, partial(func, *args, **kwargs)
+    )
+    try:
+        return await shield(future)
+    except CancelledError:
+        await wait_until_done(future)
+        raise
+
+
+def get_ctx_info(agent):
+    return {
+        "current_ctx_token_count": agent.memory.main_ctx_message_seq_no_tokens,
+        "ctx_window": agent.memory.ctx_window,
+    }
+
+
+async def generate_agent_responses(agent, user_id, is_first_message=False):
+    total_start_time = time()
+
+    # Partial messages may be produced in a worker thread, so they are handed to the event loop through this queue
+    loop = get_running_loop()
+    partial_message_queue = Queue()
+    agent.interface.partial_message_callback = lambda partial_message: (
+        loop.call_soon_threadsafe(partial_message_queue.put_nowait, partial_message)
+    )
+
+    heartbeat_request = True
+    while heartbeat_request:
+        async with waited_for(admission_sem, "admission"):
+            start_time = time()
+            step_task = ensure_future(
+                agent.astep(
+                    user_id, is_first_message=is_first_message, executor=step_executor
+                )
+            )
+            get_task = None
+            try:
+                while not step_task.done():
+                    get_task = ensure_future(partial_message_queue.get())
+                    done, _ = await wait(
+                        {step_task, get_task}, return_when=FIRST_COMPLETED
+                    )
+                    if get_task in done:
+                        yield json.dumps(
+                            {"partial_server_message": get_task.result()}
+                        ) + "\n"
+                    else:
+                        get_task.cancel()
+            except BaseException:
+                # CancelledError, or GeneratorExit if the client disconnected at a yield: the step keeps changing memory in a worker thread, so it must finish before the conversation lock is released
+                if get_task is not None:
+                    get_task.cancel()
+                await wait_until_done(step_task)
+                raise
+            while not partial_message_queue.empty():
+                yield json.dumps(
+                    {"partial_server_message": partial_message_queue.get_nowait()}
+                ) + "\n"
+            _, heartbeat_request, _ = step_task.result()
+            end_time = time()
+
+            ctx_info = await run_in_step_executor(get_ctx_info, agent)
+
+        server_message_stack = agent.interface.server_message_stack.copy()
+        agent.interface.server_message_stack = []
+
+        step_info = {
+            "server_message_stack": server_message_stack,
+            "ctx_info": ctx_info,
+            "duration": str(timedelta(seconds=round(end_time - start_time, 2))),
+        }
+        if INCLUDE_TRACES_IN_STREAM and agent.last_step_trace is not None:
+            step_info["trace"] = agent.last_step_trace.to_summary()
+
+        yield json.dumps(step_info) + "\n"
+
+    agent.interface.partial_message_callback = None
+
+    total_end_time = time()
+
+    yield json.dumps(
+        {
+            "total_duration": str(
+                timedelta(seconds=round(total_end_time - total_start_time, 2))
+            )
+        }
+    ) + "\n"
+
+
 @app.get("/conversation-ids")
 async def get_existing_conversation_ids():
     return {
         "conv_ids": list(
             filter(
                 lambda s: s[0] != ".",
-                listdir(path.join(path.dirname(__file__), "persistent_storage")),
+                listdir(PERSISTENT_STORAGE_PATH),
             )
         )
     }
 
 
+@app.get("/agents/cache-stats")
+async def get_agent_cache_stats():
+    return loaded_agents.stats
+
+
+@app.get("/metrics")
+async def get_metrics():
+    # Storage sizes may hit Chroma, so the metrics are rendered off the event loop
+    return PlainTextResponse(
+        await run_in_step_executor(METRICS.render_prometheus),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
 @app.get("/personas/agents")
 async def get_agent_personas():
     return {
@@ -219,7 +515,9 @@ async def create_agent(data: InitAgentRequestParams):
     agent_persona_name = data.agent_persona_name
     human_persona_name = data.human_persona_name
 
-    conv_name = init_agent(agent_persona_name, human_persona_name)
+    conv_name = await run_in_step_executor(
+        init_agent, agent_persona_name, human_persona_name
+    )
 
     return {"conv_name": conv_name}
 
@@ -228,9 +526,13 @@ async def create_agent(data: InitAgentRequestParams):
 async def delete_agent(data: ConvNameGenericRequestParams):
     conv_name = data.conv_name
 
+    # Unload agent
+    async with conv_lock(conv_name):
+        await run_in_step_executor(loaded_agents.discard, conv_name)
+
     # Remove conversation
     try:
-        rmdir(path.join(path.dirname(__file__), "persistent_storage", conv_name))
+        rmdir(path.join(PERSISTENT_STORAGE_PATH, conv_name))
         return {"success": True}
     except OSError as error:
         return {"success": False}
@@ -243,8 +545,11 @@ async def get_all_human_ids(data: ConvNameGenericRequestParams):
     # Load working context
     working_context = WorkingContext(CONFIG["model_name"], conv_name, None, None, None)
 
-    # Get all registered human ids
-    human_ids = list(working_context.humans.keys())
+    try:
+        # Get all registered human ids
+        human_ids = list(working_context.humans.keys())
+    finally:
+        working_context.close()
 
     return {"human_ids": human_ids}
 
@@ -254,184 +559,138 @@ async def create_human(data: CreateHumanRequestParams):
     conv_name = data.conv_name
     human_persona_name = data.human_persona_name
 
-    # Load working context
-    working_context = WorkingContext(CONFIG["model_name"], conv_name, None, None, None)
-
-    # Get all registered human ids
-    human_ids = list(working_context.humans.keys())
+    async with conv_lock(conv_name):
+        # Load working context
+        working_context = WorkingContext(
+            CONFIG["model_name"], conv_name, None, None, None
+        )
 
-    # Load human persona
-    human_persona_fp = path.join(
-        path.dirname(__file__),
-        "llm_os",
-        "personas",
-        "humans",
-        human_persona_name,
-    )
+        try:
+            # Get all registered human ids
+            human_ids = list(working_context.humans.keys())
+
+            # Load human persona
+            human_persona_fp = path.join(
+                path.dirname(__file__),
+                "llm_os",
+                "personas",
+                "humans",
+                human_persona_name,
+            )
 
-    with open(human_persona_fp, "r") as f:
-        human_persona_str = f.read()
+            with open(human_persona_fp, "r") as f:
+                human_persona_str = f.read()
 
-    # Add new user
-    new_human_id = max(human_ids) + 1
-    working_context.add_new_human_persona(new_human_id, human_persona_str)
+            # Add new user
+            new_human_id = max(human_ids) + 1
+            working_context.add_new_human_persona(new_human_id, human_persona_str)
+        finally:
+            working_context.close()
 
     return {"new_human_id": new_human_id}
 
 
 @app.post("/messages/send")
 async def send_message(data: SendMessageParams):
-    async with sem:
-        # Load data
-        conv_name = data.conv_name
-        user_id = data.user_id
-        message = data.message
-
-        # Load agent
-        agent = get_agent(conv_name)
-
-        # Send message
-        agent.interface.user_message(message)
-        agent.memory.append_messaged_to_fq_and_rs(
-            {
-                "type": "user",
-                "user_id": user_id,
-                "message": {"role": "user", "content": message},
-            }
-        )
-
-        # Generate agent responses
-        def generate_agent_responses(agent_obj):
-            total_start_time = time()
-
-            heartbeat_request = True
-            while heartbeat_request:
-                start_time = time()
-                _, heartbeat_request, _ = agent_obj.step(user_id)
-                end_time = time()
-
-                server_message_stack = agent_obj.interface.server_message_stack.copy()
-                agent_obj.interface.server_message_stack = []
-
-                yield json.dumps(
-                    {
-                        "server_message_stack": server_message_stack,
-                        "ctx_info": {
-                            "current_ctx_token_count": agent_obj.memory.main_ctx_message_seq_no_tokens,
-                            "ctx_window": agent_obj.memory.ctx_window,
-                        },
-                        "duration": str(
-                            timedelta(seconds=round(end_time - start_time, 2))
-                        ),
-                    }
-                ) + "\n"
-
-            total_end_time = time()
-
-            yield json.dumps(
+    # Load data
+    conv_name = data.conv_name
+    user_id = data.user_id
+    message = data.message
+
+    async def generate_responses():
+        async with conv_lock(conv_name):
+            # Load agent
+            agent = await run_in_step_executor(get_agent, conv_name)
+
+            # Send message
+            agent.interface.user_message(message)
+            await run_in_step_executor(
+                agent.memory.append_messaged_to_fq_and_rs,
                 {
-                    "total_duration": str(
-                        timedelta(seconds=round(total_end_time - total_start_time, 2))
-                    )
-                }
-            ) + "\n"
+                    "type": "user",
+                    "user_id": user_id,
+                    "message": {"role": "user", "content": message},
+                },
+            )
+
+            # Generate agent responses (closed before the lock is released if the client disconnects)
+            async with aclosing(
+                generate_agent_responses(agent, user_id)
+            ) as agent_responses:
+                async for line in agent_responses:
+                    yield line
 
-        return StreamingResponse(generate_agent_responses(agent))
+    return StreamingResponse(generate_responses())
 
 
 @app.post("/messages/send/first-message")
 async def send_first_message(data: SendMessageParams):
-    async with sem:
-        # Load data
-        conv_name = data.conv_name
-        user_id = data.user_id
-        message = data.message
-
-        # Load agent
-        agent = get_agent(conv_name)
-
-        # Send message
-        agent.interface.system_message(message)
-        agent.memory.append_messaged_to_fq_and_rs(
-            {
-                "type": "system",
-                "user_id": "user_id",
-                "message": {"role": "user", "content": message},
-            }
-        )
-
-        # Generate agent responses
-        def generate_agent_responses(agent_obj):
-            total_start_time = time()
-
-            heartbeat_request = True
-            while heartbeat_request:
-                start_time = time()
-                _, heartbeat_request, _ = agent_obj.step(user_id, is_first_message=True)
-                end_time = time()
-
-                server_message_stack = agent_obj.interface.server_message_stack.copy()
-                agent_obj.interface.server_message_stack = []
-
-                yield json.dumps(
-                    {
-                        "server_message_stack": server_message_stack,
-                        "ctx_info": {
-                            "current_ctx_token_count": agent_obj.memory.main_ctx_message_seq_no_tokens,
-                            "ctx_window": agent_obj.memory.ctx_window,
-                        },
-                        "duration": str(
-                            timedelta(seconds=round(end_time - start_time, 2))
-                        ),
-                    }
-                ) + "\n"
-
-            total_end_time = time()
-
-            yield json.dumps(
+    # Load data
+    conv_name = data.conv_name
+    user_id = data.user_id
+    message = data.message
+
+    async def generate_responses():
+        async with conv_lock(conv_name):
+            # Load agent
+            agent = await run_in_step_executor(get_agent, conv_name)
+
+            # Send message
+            agent.interface.system_message(message)
+            await run_in_step_executor(
+                agent.memory.append_messaged_to_fq_and_rs,
                 {
-                    "total_duration": str(
-                        timedelta(seconds=round(total_end_time - total_start_time, 2))
-                    )
-                }
-            ) + "\n"
+                    "type": "system",
+                    "user_id": "user_id",
+                    "message": {"role": "user", "content": message},
+                },
+            )
 
-        return StreamingResponse(generate_agent_responses(agent))
+            # Generate agent responses (closed before the lock is released if the client disconnects)
+            async with aclosing(
+                generate_agent_responses(agent, user_id, is_first_message=True)
+            ) as agent_responses:
+                async for line in agent_responses:
+                    yield line
+
+    return StreamingResponse(generate_responses())
 
 
 @app.post("/messages/send/no-heartbeat")
 async def send_message_without_heartbeat(data: SendMessageParams):
-    async with sem:
-        # Load data
-        conv_name = data.conv_name
-        user_id = data.user_id
-        message = data.message
+    # Load data
+    conv_name = data.conv_name
+    user_id = data.user_id
+    message = data.message
 
+    async with conv_lock(conv_name):
         # Load agent
-        agent = get_agent(conv_name)
+        agent = await run_in_step_executor(get_agent, conv_name)
 
         # Send message
         agent.interface.system_message(message)
-        agent.memory.append_messaged_to_fq_and_rs(
+        await run_in_step_executor(
+            agent.memory.append_messaged_to_fq_and_rs,
             {
                 "type": "system",
                 "user_id": user_id,
                 "message": {"role": "user", "content": message},
-            }
+            },
         )
 
-        agent.memory.working_context.submit_used_human_id(user_id)
+        await run_in_step_executor(
+            agent.memory.working_context.submit_used_human_id, user_id
+        )
 
         server_message_stack = agent.interface.server_message_stack.copy()
         agent.interface.server_message_stack = []
 
-        return {
-            "server_message_stack": server_message_stack,
-            "ctx_info": {
-                "current_ctx_token_count": agent.memory.main_ctx_message_seq_no_tokens,
-                "ctx_window": agent.memory.ctx_window,
-            },
-        }
+        ctx_info = await run_in_step_executor(get_ctx_info, agent)
+
+    return {
+        "server_message_stack": server_message_stack,
+        "ctx_info": ctx_info,
+    }
 
 
 if __name__ == "__main__":
@@ -0,0 +1,74 @@
+import json
+from random import Random
+
+import pytest
+
+from benchmarks.fake_ollama import FakeOllamaServer
+from benchmarks.harness import (
+    create_benchmark_conv,
+    remove_conv,
+    temporary_persistent_storage,
+    use_fake_ollama,
+    use_stub_tokenisers,
+)
+
+
+@pytest.fixture(scope="module")
+def fake_server():
+    # Storage, the Ollama server and the tokenisers must be swapped out before llm_os is imported, so that the tests run offline
+    with (
+        FakeOllamaServer(record_chat_requests=True) as fake_server,
+        temporary_persistent_storage(),
+    ):
+        use_fake_ollama(fake_server.url)
+        use_stub_tokenisers()
+        yield fake_server
+
+
+@pytest.fixture
+def agent(fake_server):
+    from benchmarks.bench_agent import create_benchmark_agent
+
+    conv_name = create_benchmark_conv()
+    agent = create_benchmark_agent(conv_name)
+    try:
+        yield agent
+    finally:
+        agent.close()
+        remove_conv(conv_name)
+
+
+def test_prompt_prefix_is_byte_identical_between_steps(fake_server, agent):
+    from benchmarks.bench_agent import append_user_message
+    from llm_os.constants import STABLE_PROMPT_PREFIX
+
+    if not STABLE_PROMPT_PREFIX:
+        pytest.skip("STABLE_PROMPT_PREFIX is off")
+
+    rng = Random(0)
+    fake_server.chat_requests.clear()
+    for _ in range(4):
+        append_user_message(agent, rng)
+        agent.step(1)
+    prompts = fake_server.chat_requests
+
+    assert len(prompts) == 4
+    for prompt, next_prompt in zip(prompts, prompts[1:]):
+        assert len(next_prompt) > len(prompt)
+        # Everything before the trailing note is sent again unchanged
+        assert json.dumps(next_prompt[: len(prompt) - 1]) == json.dumps(prompt[:-1])
+        assert prompt[-1]["content"].startswith(next_prompt[len(prompt) - 1]["content"])
+
+
+def test_prompt_roles_alternate(fake_server, agent):
+    from benchmarks.bench_agent import append_user_message
+
+    rng = Random(1)
+    for _ in range(3):
+        append_user_message(agent, rng)
+        agent.step(1)
+        roles = [message["role"] for message in agent.memory.main_ctx_message_seq]
+
+        assert roles[0] == "system"
+        assert roles[-1] == "user"
+        assert all(role != next_role for role, next_role in zip(roles[1:], roles[2:]))